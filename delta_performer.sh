@@ -23,68 +23,105 @@ function delete_update_file {
 # DeltaPerformer::Close
 #
 function DeltaPerformer_Close {
-    umount "${install_plan['root_mountpoint']}"
-    # umount "${install_plan['target_partition']}"
     delete_update_file
     rm "${install_plan['kernel_path']}" 2> /dev/null
-    rm "${install_plan['root_path']}" 2> /dev/null
-    rmdir "${install_plan['root_mountpoint']}"
-    # rmdir "${install_plan['target_partition']}"
     return 0
 }
 
 #
-# DeltaPerformer::PreparePartitionsForUpdate
+# DeltaPerformer::Overlay
 #
-function DeltaPerformer_PreparePartitionsForUpdate {
-    # Convert to root.img using paycheck.py
-    install_plan['kernel_path']="${install_plan['download_root']}/kernel"
-    install_plan['root_path']="${install_plan['download_root']}/root.img"
-    install_plan['root_mountpoint']="${install_plan['download_root']}/root"
-    install_plan['target_partition']="${install_plan['download_root']}/target_root"
-    python3 "$SCRIPT_DIR/scripts/paycheck.py" "${install_plan['update_file_path']}" --out_dst_part_paths "${install_plan['kernel_path']}" "${install_plan['root_path']}" --part_names kernel root
+# Adds the host-specific files (kernel, firmware, drivers and configs) to the
+# root filesystem the payload was written to. This is run by paycheck.py
+# through this script once the payload is applied and verified, as
+#   delta_performer.sh overlay PARTITION_NAME PARTITION_PATH
+function DeltaPerformer_Overlay {
+    local part_name="$1"
+    local part_path="$2"
+    [ "${part_name}" == "root" ] || return 0
+    # Chrome OS root filesystems refuse read-write mounts, undo that
+    printf '\000' | dd of="${part_path}" seek=$((0x464 + 3)) conv=notrunc count=1 bs=1 2> /dev/null
+    # Grow the filesystem to the whole slot to make room for the host files
+    e2fsck -fy "${part_path}" > /dev/null 2>&1
+    if [ $? -ge 4 ]; then
+      echo_stderr "Failed to check the new root filesystem."
+      return 1
+    fi
+    resize2fs "${part_path}" > /dev/null 2>&1
     if [ $? -ne 0 ]; then
-      echo_stderr "Failed to extract root image from update."
-      delete_update_file
-      rm "${install_plan['kernel_path']}" 2> /dev/null
-      rm "${install_plan['root_path']}" 2> /dev/null
+      echo_stderr "Failed to resize the new root filesystem."
       return 1
     fi
-    # mount root.img
-    mkdir "${install_plan['root_mountpoint']}"
-    mount -t ext4 -o ro "${install_plan['root_path']}" "${install_plan['root_mountpoint']}"
+    local target="$(mktemp -d)"
+    mount -t ext4 -o rw "${part_path}" "${target}"
     if [ $? -ne 0 ]; then
-      echo_stderr "Failed to mount root image."
-      delete_update_file
-      rm "${install_plan['kernel_path']}" 2> /dev/null
-      rm "${install_plan['root_path']}" 2> /dev/null
-      rmdir "${install_plan['root_mountpoint']}"
+      echo_stderr "Failed to mount the new root filesystem."
+      rmdir "${target}"
       return 1
     fi
-    # mount target partition
+    # Delete kernel modules, firmware and alsa audio config files
+    rm -rf "${target}"/lib/{firmware,modules}
+    rm "${target}/etc/modprobe.d"/alsa*.conf
+    ## Copy required files from current to target partition
+    # Any failure fails the update, as the slot would not boot on this host
+    local failed=0
+    # Copy kernel and bootloaders
+    cp -a /{lib,boot} "${target}/" || failed=1
+    # Copy drivers
+    cp -na /usr/lib64/{dri,va} "${target}/usr/lib64/" || failed=1
+    # Copy write_gpt.sh, the partition map
+    cp -a {,"${target}"}/usr/sbin/write_gpt.sh || failed=1
+    # Copy touchpad config as it could be modified
+    cp -a {,"${target}"}/etc/gesture/40-touchpad-cmt.conf || failed=1
+    # Copy chrome_dev.conf as it could be modified
+    cp -a {,"${target}"}/etc/chrome_dev.conf || failed=1
+    # Copy SELinux config
+    cp -a {,"${target}"}/etc/selinux/config || failed=1
+    # Copy camera config
+    cp -a {,"${target}"}/etc/camera/camera_characteristics.conf || failed=1
+    cp -a {,"${target}"}/lib/udev/rules.d/50-camera.rules || failed=1
+    # Copy mount-internals.conf if present
+    if [ -e /etc/init/mount-internals.conf ]; then
+      cp -a {,"${target}"}/etc/init/mount-internals.conf || failed=1
+    fi
+    umount "${target}" || failed=1
+    rmdir "${target}"
+    if [ ${failed} -ne 0 ]; then
+      echo_stderr "Failed to copy the host files to the new root filesystem."
+      return 1
+    fi
+    return 0
+}
+
+#
+# DeltaPerformer::PreparePartitionsForUpdate
+#
+function DeltaPerformer_PreparePartitionsForUpdate {
+    install_plan['kernel_path']="${install_plan['download_root']}/kernel"
+    install_plan['target_partition']="${install_plan['download_root']}/target_root"
     if [ -z "${install_plan['target_slot']}" ]; then
         echo_stderr "Target slot is empty!"
-        umount "${install_plan['root_mountpoint']}"
         delete_update_file
-        rm "${install_plan['kernel_path']}" 2> /dev/null
-        rm "${install_plan['root_path']}" 2> /dev/null
-        rmdir "${install_plan['root_mountpoint']}"
         return 1
     fi
-    mkdir "${install_plan['target_partition']}"
-    mount -t ext4 -o rw,exec "${install_plan['target_slot']}" "${install_plan['target_partition']}"
+    # The root filesystem is written straight onto the target slot
+    if grep -q "^${install_plan['target_slot']} " /proc/mounts; then
+      umount "${install_plan['target_slot']}"
+    fi
+    python3 "$SCRIPT_DIR/scripts/paycheck.py" "${install_plan['update_file_path']}" --out_dst_part_paths "${install_plan['kernel_path']}" "${install_plan['target_slot']}" --part_names kernel root --overlay-cmd "\"$SCRIPT_DIR/delta_performer.sh\" overlay"
     if [ $? -ne 0 ]; then
-        echo_stderr "${install_plan['target_slot']} is probably broken. Applying fix..."
-        mke2fs "${install_plan['target_slot']}"
-        mount -t ext4 -o rw,exec "${install_plan['target_slot']}" "${install_plan['target_partition']}"
+      echo_stderr "Failed to write the update to ${install_plan['target_slot']}."
+      delete_update_file
+      rm "${install_plan['kernel_path']}" 2> /dev/null
+      return 1
     fi
+    # mount target partition
+    mkdir "${install_plan['target_partition']}"
+    mount -t ext4 -o rw,exec "${install_plan['target_slot']}" "${install_plan['target_partition']}"
     if [ $? -ne 0 ]; then
       echo_stderr "Failed to mount target partition."
-      umount "${install_plan['root_mountpoint']}"
       delete_update_file
       rm "${install_plan['kernel_path']}" 2> /dev/null
-      rm "${install_plan['root_path']}" 2> /dev/null
-      rmdir "${install_plan['root_mountpoint']}"
       rmdir "${install_plan['target_partition']}"
       return 1
     fi
@@ -97,39 +134,15 @@ function DeltaPerformer_PreparePartitionsForUpdate {
 function DeltaPerformer_Write {
     echo_stderr "Updating Chrome OS..."
     DeltaPerformer_PreparePartitionsForUpdate || return 1
-    # TODO: Do some error checking
-    # Copy update files
-    # Copy contents of root.img to the target partition
-    rm -rf "${install_plan['target_partition']}"/*
-    cp -a "${install_plan['root_mountpoint']}"/* "${install_plan['target_partition']}"
-    debug "Image contents: $(ls "${install_plan['root_mountpoint']}")"
     debug "Partition contents: $(ls "${install_plan['target_partition']}")"
-    # Delete kernel modules, firmware and alsa audio config files
-    rm -rf "${install_plan['target_partition']}"/lib/{firmware,modules}
-    rm "${install_plan['target_partition']}/etc/modprobe.d"/alsa*.conf
-    ## Copy required files from current to target partition
-    # Copy kernel and bootloaders
-    cp -a /{lib,boot} "${install_plan['target_partition']}/"
-    # Copy drivers
-    cp -na /usr/lib64/{dri,va} "${install_plan['target_partition']}/usr/lib64/"
-    # Copy write_gpt.sh, the partition map
-    cp -a {,"${install_plan['target_partition']}"}/usr/sbin/write_gpt.sh
-    # Copy touchpad config as it could be modified
-    cp -a {,"${install_plan['target_partition']}"}/etc/gesture/40-touchpad-cmt.conf
-    # Copy chrome_dev.conf as it could be modified
-    cp -a {,"${install_plan['target_partition']}"}/etc/chrome_dev.conf
-    # Copy SELinux config
-    cp -a {,"${install_plan['target_partition']}"}/etc/selinux/config
-    # Copy camera config
-    cp -a {,"${install_plan['target_partition']}"}/etc/camera/camera_characteristics.conf
-    cp -a {,"${install_plan['target_partition']}"}/lib/udev/rules.d/50-camera.rules
-    # FIXME: Check for errors, use && for related commands to check at last and exit
-    # Copy mount-internals.conf if present
-    cp -a {,"${install_plan['target_partition']}"}/etc/init/mount-internals.conf 2> /dev/null
     DeltaPerformer_Close || return 1
 }
 
 # Check environment variables
 if [ "${0##*/}" == "delta_performer.sh" ]; then
+    if [ "$1" == "overlay" ]; then
+        DeltaPerformer_Overlay "$2" "$3"
+        exit $?
+    fi
     ( set -o posix ; set )
 fi
@@ -48,8 +48,24 @@ function DownloadAction_StartDownloading {
     echo_stderr "Update available."
     echo_stderr "Downloading ${ORA_package_name} (${file_size} GB)..."
     install_plan['update_file_path']="${install_plan['download_root']}/${ORA_package_name}"
-    curl -\#L -o "${install_plan['update_file_path']}" "${install_plan['download_url']}" -C -
-    if [ $? -ne 0 ]; then
+    # The payload is fetched with parallel range requests, resuming any
+    # previous download. Its metadata is checked before downloading the rest.
+    local download_args=()
+    if [ -n "${install_plan['payload_size']}" ]; then
+      download_args+=(--payload-size "${install_plan['payload_size']}")
+    fi
+    if [ -n "${install_plan['metadata_size']}" ]; then
+      download_args+=(--metadata-size "${install_plan['metadata_size']}")
+    fi
+    local metadata_sig_file="${install_plan['update_file_path']}.metadata-signature"
+    if [ -n "${install_plan['metadata_signature']}" ]; then
+      echo -n "${install_plan['metadata_signature']}" > "${metadata_sig_file}"
+      download_args+=(--meta-sig "${metadata_sig_file}")
+    fi
+    python3 "$SCRIPT_DIR/scripts/download_payload.py" "${install_plan['download_url']}" "${install_plan['update_file_path']}" "${download_args[@]}"
+    local ret=$?
+    rm -f "${metadata_sig_file}"
+    if [ ${ret} -ne 0 ]; then
       echo_stderr "Failed to download ${ORA_package_name}. Try again."
       return 1
     fi
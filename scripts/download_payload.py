@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""download_payload: Download an update payload with parallel range requests."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import sys
+
+from update_payload import blob_cache as blob_cache_lib
+from update_payload import downloader
+from update_payload import error
+
+
+def ParseArguments(argv):
+  """Parse and validate command-line arguments.
+
+  Args:
+    argv: command-line arguments to parse (excluding the program name)
+
+  Returns:
+    Returns the arguments returned by the argument parser.
+  """
+  parser = argparse.ArgumentParser(
+      description=('Downloads an update payload over HTTP with a number of '
+                   'concurrent range requests, resuming a previous download '
+                   'of the same payload. When a metadata signature, metadata '
+                   'size or public key is given, the payload metadata is '
+                   'checked before downloading the payload data.'))
+  parser.add_argument('url', metavar='URL', help='the payload URL')
+  parser.add_argument('payload', metavar='FILE',
+                      help='the file to download the payload to')
+  parser.add_argument('--payload-size', metavar='NUM', type=int,
+                      help=('the expected payload size (default: as '
+                            'reported by the server)'))
+  parser.add_argument('--workers', metavar='NUM', type=int,
+                      default=downloader.DEFAULT_NUM_WORKERS,
+                      help='number of ranges fetched concurrently')
+  parser.add_argument('--chunk-size', metavar='NUM', type=int,
+                      default=downloader.DEFAULT_CHUNK_SIZE,
+                      help='size of the ranges fetched, in bytes')
+  parser.add_argument('--retries', metavar='NUM', type=int,
+                      default=downloader.DEFAULT_MAX_RETRIES,
+                      help='number of times a range is retried')
+  parser.add_argument('--blob-cache', metavar='DIR',
+                      help=('skip downloading chunks made up of data blobs '
+                            'cached in DIR'))
+  parser.add_argument('--blob-cache-populate', action='store_true',
+                      default=False,
+                      help='add the downloaded data blobs to the blob cache')
+  parser.add_argument('--blob-cache-size', metavar='NUM', type=int,
+                      default=blob_cache_lib.DEFAULT_MAX_SIZE,
+                      help='the maximum size of the blob cache in bytes')
+  parser.add_argument('-k', '--key', metavar='FILE',
+                      help='override standard key used for signature '
+                      'validation')
+  parser.add_argument('-m', '--meta-sig', metavar='FILE',
+                      help='verify metadata against its signature')
+  parser.add_argument('-s', '--metadata-size', metavar='NUM', type=int,
+                      default=0, help='the metadata size to verify with')
+
+  args = parser.parse_args(argv)
+  if args.workers < 1:
+    parser.error('--workers must be positive')
+  if args.chunk_size < 1:
+    parser.error('--chunk-size must be positive')
+  if args.retries < 0:
+    parser.error('--retries must not be negative')
+  if args.blob_cache_size < 1:
+    parser.error('--blob-cache-size must be positive')
+  if args.blob_cache_populate and not args.blob_cache:
+    parser.error('--blob-cache-populate requires --blob-cache')
+  return args
+
+
+def main(argv):
+  # Parse and validate arguments.
+  args = ParseArguments(argv[1:])
+
+  metadata_sig_file = None
+  try:
+    check_args = None
+    if args.key or args.meta_sig or args.metadata_size:
+      metadata_sig_file = args.meta_sig and open(args.meta_sig, 'rb')
+      check_args = {'pubkey_file_name': args.key,
+                    'metadata_sig_file': metadata_sig_file,
+                    'metadata_size': args.metadata_size}
+    blob_cache = (args.blob_cache and
+                  blob_cache_lib.BlobCache(
+                      args.blob_cache, max_size=args.blob_cache_size,
+                      populate=args.blob_cache_populate))
+    downloader.PayloadDownloader(
+        args.url, args.payload, chunk_size=args.chunk_size,
+        num_workers=args.workers, max_retries=args.retries,
+        blob_cache=blob_cache).Download(
+            payload_size=args.payload_size, check_args=check_args)
+  except error.PayloadError as e:
+    sys.stderr.write('Error: %s\n' % e)
+    return 1
+  finally:
+    if metadata_sig_file:
+      metadata_sig_file.close()
+
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -23,7 +23,10 @@ from __future__ import print_function
 # pylint: disable=import-error
 import argparse
 import filecmp
+import io
 import os
+import shlex
+import subprocess
 import sys
 import tempfile
 
@@ -52,6 +55,11 @@ def CheckApplyPayload(args):
   """
   return args.dst_part_paths is not None
 
+def IsPayloadUrl(payload):
+  """Whether the payload argument is an HTTP(S) URL rather than a file."""
+  return payload.startswith(('http://', 'https://'))
+
+
 def ApplyPayload(args):
   """Whether to apply the payload.
 
@@ -64,6 +72,24 @@ def ApplyPayload(args):
   """
   return CheckApplyPayload(args) or args.out_dst_part_paths is not None
 
+def RunOverlayCommand(overlay_cmd, part_name, part_path):
+  """Runs an overlay command on an applied partition.
+
+  Args:
+    overlay_cmd: The command line, to which the partition name and path are
+                 appended.
+    part_name: The name of the partition.
+    part_path: The path the partition was written to.
+
+  Raises:
+    error.PayloadError if the command could not be run or failed.
+  """
+  try:
+    subprocess.check_call(shlex.split(overlay_cmd) + [part_name, part_path])
+  except (OSError, subprocess.CalledProcessError) as e:
+    raise error.PayloadError('Overlay command failed on %s partition: %s' %
+                             (part_name, e))
+
 def ParseArguments(argv):
   """Parse and validate command-line arguments.
 
@@ -97,6 +123,12 @@ def ParseArguments(argv):
                           help='Print a friendly description of the payload.')
   check_args.add_argument('-r', '--report', metavar='FILE',
                           help="dump payload report (`-' for stdout)")
+  check_args.add_argument('--report-format',
+                          choices=update_payload.REPORT_FORMATS,
+                          default=update_payload.checker.REPORT_FORMAT_TEXT,
+                          help=('format of the payload report: aligned text '
+                                '(default), or a JSON object per line for '
+                                'each section'))
   check_args.add_argument('-t', '--type', dest='assert_type',
                           help='assert the payload type',
                           choices=[_TYPE_FULL, _TYPE_DELTA])
@@ -120,6 +152,39 @@ def ParseArguments(argv):
                           ' payload')
   check_args.add_argument('--part_sizes', metavar='NUM', nargs='+', type=int,
                           help='override partition size auto-inference')
+  check_args.add_argument('--hash-workers', metavar='NUM', default=0,
+                          type=int,
+                          help='number of threads hashing data blobs')
+  check_args.add_argument('--check-level',
+                          choices=update_payload.CHECK_LEVELS,
+                          help=('how thoroughly to check the payload: '
+                                'metadata reads no data blobs, sampled '
+                                'verifies a random subset of them, full '
+                                '(default) all of them and the signatures'))
+  check_args.add_argument('--sample-fraction', metavar='FRACTION',
+                          type=float,
+                          help=('fraction of data blobs verified with '
+                                '--check-level=sampled'))
+  check_args.add_argument('--payload-size', metavar='NUM', type=int,
+                          help=('the expected payload size, to check a '
+                                'payload file holding only its metadata '
+                                'with --check-level=metadata'))
+  check_args.add_argument('--metadata-only', action='store_true',
+                          default=False,
+                          help=('the payload file holds only the payload '
+                                'header and manifest, optionally followed by '
+                                'the metadata signature; checking it '
+                                'requires --payload-size'))
+  check_args.add_argument('--single-pass', action='store_true',
+                          default=False,
+                          help=('when checking and applying, verify the '
+                                'payload data while applying it rather than '
+                                'reading it beforehand'))
+  check_args.add_argument('--stream', action='store_true', default=False,
+                          help=('read the payload front to back as a stream '
+                                "(`-' for stdin), applying data blobs as "
+                                'they arrive; implies --single-pass and '
+                                'requires --payload-size'))
 
   apply_args = parser.add_argument_group('Applying payload')
   # TODO(ahassani): Extent extract-bsdiff to puffdiff too.
@@ -131,17 +196,74 @@ def ParseArguments(argv):
                           help='use the specified bspatch binary')
   apply_args.add_argument('--puffpatch-path', metavar='FILE',
                           help='use the specified puffpatch binary')
+  apply_args.add_argument('--patch-backend', default='auto',
+                          choices=update_payload.PATCH_BACKENDS,
+                          help=('apply bsdiff patches in-process (python), '
+                                'with bspatch (external), or in-process '
+                                'where possible (auto)'))
+
+  apply_args.add_argument('--source-verification', default='before',
+                          choices=update_payload.SOURCE_VERIFICATION_MODES,
+                          help=('verify source partitions before or '
+                                'concurrently with applying, or only the '
+                                'source data of each operation'))
+  apply_args.add_argument('--journal', metavar='FILE',
+                          help=('checkpoint progress to FILE, allowing to '
+                                'resume if interrupted'))
+  apply_args.add_argument('--resume', action='store_true', default=False,
+                          help=('skip operations the journal records as '
+                                'applied (default journal: PAYLOAD.journal)'))
+  apply_args.add_argument('--part-workers', metavar='NUM', default=1,
+                          type=int,
+                          help='number of partitions to apply concurrently')
+  apply_args.add_argument('--part-worker-type', default='thread',
+                          choices=update_payload.WORKER_TYPES,
+                          help=('apply partitions concurrently using threads '
+                                'or processes'))
+  apply_args.add_argument('--decompress-workers', metavar='NUM', default=0,
+                          type=int,
+                          help=('number of processes decompressing full '
+                                'update data in parallel'))
 
   apply_args.add_argument('--src_part_paths', metavar='FILE', nargs='+',
                           help='source partitition files')
   apply_args.add_argument('--dst_part_paths', metavar='FILE', nargs='+',
                           help='destination partition files')
   apply_args.add_argument('--out_dst_part_paths', metavar='FILE', nargs='+',
-                          help='created destination partition files')
-
-  parser.add_argument('payload', metavar='PAYLOAD', help='the payload file')
+                          help=('created destination partition files, or '
+                                'block devices to write partitions onto'))
+  apply_args.add_argument('--overlay-cmd', metavar='CMD',
+                          help=('once the payload is applied and verified, '
+                                'run CMD with the name and path of each '
+                                'partition, e.g. to add files to it'))
+
+  parser.add_argument('payload', metavar='PAYLOAD',
+                      help=("the payload file (`-' for stdin with --stream), "
+                            'or an HTTP(S) URL to fetch data blobs from as '
+                            'they are applied'))
   parser.add_argument('--part_names', metavar='NAME', nargs='+',
                       help='names of partitions')
+  parser.add_argument('--mmap', action='store_true', default=False,
+                      help=('map the payload into memory rather than reading '
+                            'data blobs from it'))
+  parser.add_argument('--blob-cache', metavar='DIR',
+                      help=('take data blobs from a cache in DIR, shared '
+                            'across payloads, rather than reading or '
+                            'fetching them'))
+  parser.add_argument('--blob-cache-populate', action='store_true',
+                      default=False,
+                      help=('add the data blobs read or fetched to the blob '
+                            'cache, e.g. when the next payload is expected to '
+                            'share them'))
+  parser.add_argument('--blob-cache-size', metavar='NUM', type=int,
+                      default=update_payload.blob_cache.DEFAULT_MAX_SIZE,
+                      help=('the maximum size of the blob cache in bytes, '
+                            'past which the least recently used blobs are '
+                            'evicted'))
+  parser.add_argument('--cache-decompressed', action='store_true',
+                      default=False,
+                      help=('also cache the decompressed data of compressed '
+                            'blobs, to save decompressing them again'))
 
   # Parse command-line arguments.
   args = parser.parse_args(argv)
@@ -150,7 +272,18 @@ def ParseArguments(argv):
   args.check = (args.check or args.report or args.assert_type or
                 args.block_size or args.allow_unhashed or
                 args.disabled_tests or args.meta_sig or args.key or
-                args.part_sizes is not None or args.metadata_size)
+                args.part_sizes is not None or args.metadata_size or
+                args.hash_workers or args.check_level or
+                args.sample_fraction is not None or
+                args.payload_size is not None)
+
+  if args.sample_fraction is not None:
+    if args.check_level != update_payload.checker.CHECK_LEVEL_SAMPLED:
+      parser.error('--sample-fraction requires --check-level=sampled')
+    if not 0 <= args.sample_fraction <= 1:
+      parser.error('--sample-fraction must be between 0 and 1')
+  else:
+    args.sample_fraction = update_payload.checker.DEFAULT_SAMPLE_FRACTION
 
   # Makes sure the following arguments have the same length as |part_names| if
   # set.
@@ -165,8 +298,81 @@ def ParseArguments(argv):
   def _IsSrcPartPathsProvided(args):
     return args.src_part_paths is not None
 
+  if args.single_pass:
+    if not (args.check and ApplyPayload(args)):
+      parser.error('--single-pass can only be used when checking and '
+                   'applying payloads')
+    if args.part_workers != 1:
+      parser.error('--single-pass applies partitions serially, it cannot be '
+                   'used with --part-workers')
+    if args.hash_workers:
+      parser.error('--single-pass hashes data blobs while applying, it '
+                   'cannot be used with --hash-workers')
+    if args.check_level or args.payload_size is not None:
+      parser.error('--single-pass verifies all the payload data, it cannot '
+                   'be used with --check-level or --payload-size')
+
+  if args.stream:
+    if not ApplyPayload(args):
+      parser.error('--stream can only be used when applying payloads')
+    if args.payload_size is None:
+      parser.error('--stream requires --payload-size')
+    if args.single_pass or args.check_level or args.hash_workers:
+      parser.error('--stream verifies the payload data while applying it, it '
+                   'cannot be used with --single-pass, --check-level or '
+                   '--hash-workers')
+    if args.part_workers != 1:
+      parser.error('--stream applies partitions serially, it cannot be used '
+                   'with --part-workers')
+    if args.mmap or args.metadata_only:
+      parser.error('--stream cannot be used with --mmap or --metadata-only')
+    if args.resume and not args.journal:
+      parser.error('--resume with --stream requires --journal')
+    args.single_pass = True
+  elif args.payload == '-':
+    parser.error('reading the payload from stdin requires --stream')
+
+  if IsPayloadUrl(args.payload):
+    if args.stream or args.mmap or args.metadata_only:
+      parser.error('payload URLs cannot be used with --stream, --mmap or '
+                   '--metadata-only')
+    if ApplyPayload(args) and args.part_workers != 1:
+      parser.error('payload URLs are applied one partition at a time, they '
+                   'cannot be used with --part-workers')
+    if args.resume and not args.journal:
+      parser.error('--resume with a payload URL requires --journal')
+
+  if args.metadata_only:
+    if ApplyPayload(args):
+      parser.error('--metadata-only payloads cannot be applied')
+    if args.check_level not in (None,
+                                update_payload.checker.CHECK_LEVEL_METADATA):
+      parser.error('--metadata-only payloads can only be checked with '
+                   '--check-level=metadata')
+    if args.check and args.payload_size is None:
+      parser.error('checking --metadata-only payloads requires '
+                   '--payload-size')
+
+  if args.blob_cache:
+    if args.stream:
+      parser.error('--blob-cache cannot be used with --stream')
+    if args.blob_cache_size < 1:
+      parser.error('--blob-cache-size must be positive')
+  elif args.cache_decompressed:
+    parser.error('--cache-decompressed requires --blob-cache')
+  elif args.blob_cache_populate:
+    parser.error('--blob-cache-populate requires --blob-cache')
+
+  if args.overlay_cmd and args.out_dst_part_paths is None:
+    parser.error('--overlay-cmd requires --out_dst_part_paths')
+
   # Makes sure parameters are coherent with payload type.
   if ApplyPayload(args):
+    if args.resume:
+      if args.out_dst_part_paths is None:
+        parser.error('--resume requires --out_dst_part_paths')
+      if not args.journal:
+        args.journal = args.payload + '.journal'
     if _IsSrcPartPathsProvided(args):
       if args.assert_type == _TYPE_FULL:
         parser.error('%s payload does not accept source partition arguments'
@@ -187,6 +393,19 @@ def ParseArguments(argv):
       parser.error('--bspatch-path can only be used when applying payloads')
     if args.puffpatch_path:
       parser.error('--puffpatch-path can only be used when applying payloads')
+    if args.source_verification != 'before':
+      parser.error('--source-verification can only be used when applying '
+                   'payloads')
+    if args.journal or args.resume:
+      parser.error('--journal and --resume can only be used when applying '
+                   'payloads')
+    if args.patch_backend != 'auto':
+      parser.error('--patch-backend can only be used when applying payloads')
+    if args.part_workers != 1:
+      parser.error('--part-workers can only be used when applying payloads')
+    if args.decompress_workers:
+      parser.error('--decompress-workers can only be used when applying '
+                   'payloads')
 
   # By default, look for a metadata-signature file with a name based on the name
   # of the payload we are checking. We only do it if check was triggered.
@@ -203,8 +422,28 @@ def main(argv):
   # Parse and validate arguments.
   args = ParseArguments(argv[1:])
 
-  with open(args.payload, 'rb') as payload_file:
-    payload = update_payload.Payload(payload_file)
+  payload_file = None
+  if args.payload == '-':
+    payload_file = io.open(sys.stdin.fileno(), 'rb', closefd=False)
+  elif not IsPayloadUrl(args.payload):
+    payload_file = open(args.payload, 'rb')
+  blob_cache = (args.blob_cache and
+                update_payload.BlobCache(
+                    args.blob_cache, max_size=args.blob_cache_size,
+                    cache_decompressed=args.cache_decompressed,
+                    populate=args.blob_cache_populate))
+  payload = None
+  try:
+    if payload_file is None:
+      payload = update_payload.RemotePayload(args.payload,
+                                             payload_size=args.payload_size,
+                                             blob_cache=blob_cache)
+    elif args.stream:
+      payload = update_payload.StreamingPayload(payload_file)
+    else:
+      payload = update_payload.Payload(payload_file, use_mmap=args.mmap,
+                                       metadata_only=args.metadata_only,
+                                       blob_cache=blob_cache)
     try:
       # Initialize payload.
       payload.Init()
@@ -213,11 +452,11 @@ def main(argv):
         payload.Describe()
 
       # Perform payload integrity checks.
-      if args.check:
-        report_file = None
-        do_close_report_file = False
-        metadata_sig_file = None
-        try:
+      report_file = None
+      do_close_report_file = False
+      metadata_sig_file = None
+      try:
+        if args.check:
           if args.report:
             if args.report == '-':
               report_file = sys.stdout
@@ -228,70 +467,104 @@ def main(argv):
           part_sizes = (args.part_sizes and
                         dict(zip(args.part_names, args.part_sizes)))
           metadata_sig_file = args.meta_sig and open(args.meta_sig, 'rb')
-          payload.Check(
-              pubkey_file_name=args.key,
-              metadata_sig_file=metadata_sig_file,
-              metadata_size=int(args.metadata_size),
-              report_out_file=report_file,
-              assert_type=args.assert_type,
-              block_size=int(args.block_size),
-              part_sizes=part_sizes,
-              allow_unhashed=args.allow_unhashed,
-              disabled_tests=args.disabled_tests)
-        finally:
-          if metadata_sig_file:
-            metadata_sig_file.close()
-          if do_close_report_file:
-            report_file.close()
-
-      # Apply payload.
-      if ApplyPayload(args):
-        dargs = {'bsdiff_in_place': not args.extract_bsdiff}
-        if args.bspatch_path:
-          dargs['bspatch_path'] = args.bspatch_path
-        if args.puffpatch_path:
-          dargs['puffpatch_path'] = args.puffpatch_path
-        if args.assert_type == _TYPE_DELTA:
-          dargs['old_parts'] = dict(zip(args.part_names, args.src_part_paths))
-
-        out_dst_parts = {}
-        file_handles = []
-        if args.out_dst_part_paths is not None:
-          for name, path in zip(args.part_names, args.out_dst_part_paths):
-            handle = open(path, 'wb+')
-            file_handles.append(handle)
-            out_dst_parts[name] = handle.name
-        else:
-          for name in args.part_names:
-            handle = tempfile.NamedTemporaryFile()
-            file_handles.append(handle)
-            out_dst_parts[name] = handle.name
-
-        payload.Apply(out_dst_parts, **dargs)
-
-        # If destination kernel and rootfs partitions are not given, then this
-        # just becomes an apply operation with no check.
-        if CheckApplyPayload(args):
-          # Prior to comparing, add the unused space past the filesystem
-          # boundary in the new target partitions to become the same size as
-          # the given partitions. This will truncate to larger size.
-          for part_name, out_dst_part, dst_part in zip(args.part_names,
-                                                       file_handles,
-                                                       args.dst_part_paths):
-            out_dst_part.truncate(os.path.getsize(dst_part))
-
-            # Compare resulting partitions with the ones from the target image.
-            if not filecmp.cmp(out_dst_part.name, dst_part):
-              raise error.PayloadError(
-                  'Resulting %s partition corrupted.' % part_name)
-
-        # Close the output files. If args.out_dst_* was not given, then these
-        # files are created as temp files and will be deleted upon close().
-        for handle in file_handles:
-          handle.close()
+          check_dargs = {'pubkey_file_name': args.key,
+                         'metadata_sig_file': metadata_sig_file,
+                         'metadata_size': int(args.metadata_size),
+                         'report_out_file': report_file,
+                         'report_format': args.report_format,
+                         'assert_type': args.assert_type,
+                         'block_size': int(args.block_size),
+                         'part_sizes': part_sizes,
+                         'allow_unhashed': args.allow_unhashed,
+                         'disabled_tests': args.disabled_tests}
+          # With --single-pass, the payload is checked while applying it.
+          if not args.single_pass:
+            payload.Check(check_level=args.check_level,
+                          sample_fraction=args.sample_fraction,
+                          payload_size=args.payload_size,
+                          hash_workers=args.hash_workers, **check_dargs)
+
+        # Apply payload.
+        if ApplyPayload(args):
+          dargs = {'bsdiff_in_place': not args.extract_bsdiff,
+                   'part_workers': args.part_workers,
+                   'part_worker_type': args.part_worker_type,
+                   'decompress_workers': args.decompress_workers,
+                   'patch_backend': args.patch_backend,
+                   'journal_file_name': args.journal,
+                   'resume': args.resume,
+                   'source_verification': args.source_verification}
+          if args.bspatch_path:
+            dargs['bspatch_path'] = args.bspatch_path
+          if args.puffpatch_path:
+            dargs['puffpatch_path'] = args.puffpatch_path
+          if args.assert_type == _TYPE_DELTA:
+            dargs['old_parts'] = dict(zip(args.part_names,
+                                          args.src_part_paths))
+
+          out_dst_parts = {}
+          file_handles = []
+          if args.out_dst_part_paths is not None:
+            for name, path in zip(args.part_names, args.out_dst_part_paths):
+              # Resuming builds on the data already written, so existing
+              # partitions must not be truncated.
+              mode = 'r+b' if args.resume and os.path.exists(path) else 'wb+'
+              handle = open(path, mode)
+              file_handles.append(handle)
+              out_dst_parts[name] = handle.name
+          else:
+            for name in args.part_names:
+              handle = tempfile.NamedTemporaryFile()
+              file_handles.append(handle)
+              out_dst_parts[name] = handle.name
+
+          if args.single_pass:
+            dargs.update(check_dargs)
+            dargs['payload_size'] = args.payload_size
+            payload.VerifyAndApply(out_dst_parts, **dargs)
+          else:
+            payload.Apply(out_dst_parts, **dargs)
+
+          # If destination kernel and rootfs partitions are not given, then
+          # this just becomes an apply operation with no check.
+          if CheckApplyPayload(args):
+            # Prior to comparing, add the unused space past the filesystem
+            # boundary in the new target partitions to become the same size
+            # as the given partitions. This will truncate to larger size.
+            for part_name, out_dst_part, dst_part in zip(args.part_names,
+                                                         file_handles,
+                                                         args.dst_part_paths):
+              out_dst_part.truncate(os.path.getsize(dst_part))
+
+              # Compare resulting partitions with the ones from the target
+              # image.
+              if not filecmp.cmp(out_dst_part.name, dst_part):
+                raise error.PayloadError(
+                    'Resulting %s partition corrupted.' % part_name)
+
+          # Close the output files. If args.out_dst_* was not given, then
+          # these files are created as temp files and will be deleted upon
+          # close().
+          for handle in file_handles:
+            handle.close()
+
+          # Overlay the applied partitions, now that they are verified.
+          if args.overlay_cmd:
+            for name in args.part_names:
+              RunOverlayCommand(args.overlay_cmd, name, out_dst_parts[name])
+      finally:
+        if metadata_sig_file:
+          metadata_sig_file.close()
+        if do_close_report_file:
+          report_file.close()
     except error.PayloadError as e:
       sys.stderr.write('Error: %s\n' % e)
       return 1
+  finally:
+    if payload is not None:
+      payload.Close()
+    if payload_file is not None:
+      payload_file.close()
 
   return 0
 
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Unit testing paycheck.py."""
+
+# Disable check for function names to avoid errors based on old code
+# pylint: disable-msg=invalid-name
+
+from __future__ import absolute_import
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock  # pylint: disable=import-error
+
+import paycheck
+
+from update_payload import applier
+from update_payload import common
+from update_payload import test_utils
+from update_payload.error import PayloadError
+
+
+_BLOCK_SIZE = 4096
+
+
+class PaycheckTest(unittest.TestCase):
+  """Tests running paycheck."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.new_data = {}
+    payload_gen = test_utils.EnhancedPayloadGenerator()
+    payload_gen.SetBlockSize(_BLOCK_SIZE)
+    payload_gen.SetMinorVersion(0)
+    for name in (common.KERNEL, common.ROOTFS):
+      blocks = [hashlib.sha256(b'%s %d' % (name.encode(), idx)).digest() *
+                (_BLOCK_SIZE // 32) for idx in range(2)]
+      self.new_data[name] = b''.join(blocks)
+      payload_gen.SetPartInfo(name, True, len(self.new_data[name]),
+                              hashlib.sha256(self.new_data[name]).digest())
+      for idx, block in enumerate(blocks):
+        payload_gen.AddOperationWithData(
+            name, common.OpType.REPLACE, dst_extents=[(idx, 1)],
+            data_blob=block)
+    self.payload_file_name = os.path.join(self.test_dir, 'payload.bin')
+    with open(self.payload_file_name, 'wb') as payload_file:
+      payload_gen.WriteToFileWithData(payload_file)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _Run(self, *extra_args):
+    """Applies the payload with paycheck, returning its exit code."""
+    out_parts = [os.path.join(self.test_dir, name + '.img')
+                 for name in (common.KERNEL, common.ROOTFS)]
+    return paycheck.main(
+        ['paycheck.py', self.payload_file_name,
+         '--part_names', common.KERNEL, common.ROOTFS,
+         '--out_dst_part_paths'] + out_parts + list(extra_args))
+
+  def testResume(self):
+    """Tests resuming an interrupted application onto existing outputs."""
+    journal_file_name = os.path.join(self.test_dir, 'journal')
+    apply_replace = applier.PayloadApplier._ApplyReplaceOperation
+    applied_ops = []
+    interrupted = []
+
+    def _ApplyReplace(self, op, op_name, *args, **kwargs):
+      if op_name == 'root_install_operations[2](REPLACE)' and not interrupted:
+        interrupted.append(op_name)
+        raise PayloadError('interrupted')
+      applied_ops.append(op_name)
+      return apply_replace(self, op, op_name, *args, **kwargs)
+
+    with mock.patch.object(applier, '_JOURNAL_FLUSH_OPS', 1), \
+         mock.patch.object(applier.PayloadApplier, '_ApplyReplaceOperation',
+                           autospec=True, side_effect=_ApplyReplace):
+      self.assertEqual(1, self._Run('--journal', journal_file_name))
+      del applied_ops[:]
+      self.assertEqual(0, self._Run('--journal', journal_file_name,
+                                    '--resume'))
+
+    # Only the interrupted operation was applied again.
+    self.assertEqual(['root_install_operations[2](REPLACE)'], applied_ops)
+    for name, data in self.new_data.items():
+      with open(os.path.join(self.test_dir, name + '.img'), 'rb') as part:
+        self.assertEqual(data, part.read())
+
+  def testRemotePayloadError(self):
+    """Tests that errors setting up remote payloads are not masked."""
+    with mock.patch.object(paycheck.update_payload, 'RemotePayload',
+                           side_effect=PayloadError('no such payload')):
+      with self.assertRaises(PayloadError) as cm:
+        paycheck.main(['paycheck.py', 'http://127.0.0.1:1/payload.bin'])
+    self.assertEqual('no such payload', str(cm.exception))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -22,11 +22,14 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import argparse
+import collections
 import sys
 import textwrap
 
 from six.moves import range
 import update_payload
+from update_payload import format_utils
+from update_payload import histogram
 
 
 MAJOR_PAYLOAD_VERSION_BRILLO = 2
@@ -86,11 +89,14 @@ class PayloadCommand(object):
       DisplayValue('Metadata signatures blob',
                    'file_offset=%d (%d bytes)' %
                    (offset, header.metadata_signature_len))
-      # pylint: disable=invalid-unary-operand-type
-      signatures_blob = self.payload.ReadDataBlob(
-          -header.metadata_signature_len,
-          header.metadata_signature_len)
-      self._DisplaySignaturesBlob('Metadata', signatures_blob)
+      if self.options.metadata_only and not self.payload.metadata_signature:
+        print('Metadata signatures not available in the payload metadata')
+      else:
+        # pylint: disable=invalid-unary-operand-type
+        signatures_blob = self.payload.ReadDataBlob(
+            -header.metadata_signature_len,
+            header.metadata_signature_len)
+        self._DisplaySignaturesBlob('Metadata', signatures_blob)
     else:
       print('No metadata signatures stored in the payload')
 
@@ -100,9 +106,12 @@ class PayloadCommand(object):
       if manifest.signatures_size:
         signature_msg += ' (%d bytes)' % manifest.signatures_size
       DisplayValue('Payload signatures blob', signature_msg)
-      signatures_blob = self.payload.ReadDataBlob(manifest.signatures_offset,
-                                                  manifest.signatures_size)
-      self._DisplaySignaturesBlob('Payload', signatures_blob)
+      if self.options.metadata_only:
+        print('Payload signatures not available in the payload metadata')
+      else:
+        signatures_blob = self.payload.ReadDataBlob(
+            manifest.signatures_offset, manifest.signatures_size)
+        self._DisplaySignaturesBlob('Payload', signatures_blob)
     else:
       print('No payload signatures stored in the payload')
 
@@ -110,7 +119,7 @@ class PayloadCommand(object):
   def _DisplaySignaturesBlob(signature_name, signatures_blob):
     """Show information about the signatures blob."""
     signatures = update_payload.update_metadata_pb2.Signatures()
-    signatures.ParseFromString(signatures_blob)
+    signatures.ParseFromString(bytes(signatures_blob))
     print('%s signatures: (%d entries)' %
           (signature_name, len(signatures.signatures)))
     for signature in signatures.signatures:
@@ -194,9 +203,37 @@ class PayloadCommand(object):
     DisplayValue('Blocks written', stats['written_blocks'])
     DisplayValue('Seeks when writing', stats['num_write_seeks'])
 
+  def _DisplayHistograms(self, manifest):
+    """Show histograms of the operations of each partition."""
+    def _DisplayHistogram(hist):
+      for line in str(hist).splitlines():
+        print('  %s' % line)
+
+    def _FormatSize(size):
+      size_str = format_utils.BytesToHumanReadable(size)
+      return '%d (%s)' % (size, size_str) if size_str else str(size)
+
+    op_names = update_payload.common.OpType.NAMES
+    for partition in manifest.partitions:
+      if not partition.operations:
+        continue
+      op_counts = collections.defaultdict(int)
+      op_data = collections.defaultdict(int)
+      for op in partition.operations:
+        op_counts[op.type] += 1
+        op_data[op.type] += (op.data_length if op.HasField('data_length')
+                             else 0)
+      print('"%s" operations:' % partition.partition_name)
+      _DisplayHistogram(histogram.Histogram.FromCountDict(
+          op_counts, key_names=op_names))
+      print('"%s" data:' % partition.partition_name)
+      _DisplayHistogram(histogram.Histogram.FromCountDict(
+          op_data, formatter=_FormatSize, key_names=op_names))
+
   def Run(self):
     """Parse the update payload and display information from it."""
-    self.payload = update_payload.Payload(self.options.payload_file)
+    self.payload = update_payload.Payload(
+        self.options.payload_file, metadata_only=self.options.metadata_only)
     self.payload.Init()
     self._DisplayHeader()
     self._DisplayManifest()
@@ -204,6 +241,8 @@ class PayloadCommand(object):
       self._DisplaySignatures()
     if self.options.stats:
       self._DisplayStats(self.payload.manifest)
+    if self.options.histograms:
+      self._DisplayHistograms(self.payload.manifest)
     if self.options.list_ops:
       print()
       for partition in self.payload.manifest.partitions:
@@ -222,6 +261,11 @@ def main():
                       help='Show information about overall input/output.')
   parser.add_argument('--signatures', default=False, action='store_true',
                       help='Show signatures stored in the payload.')
+  parser.add_argument('--histograms', default=False, action='store_true',
+                      help='Show histograms of operation types and data.')
+  parser.add_argument('--metadata_only', default=False, action='store_true',
+                      help='The payload file holds only the payload header '
+                      'and manifest, e.g. as fetched with a range request.')
   args = parser.parse_args()
 
   PayloadCommand(args).Run()
@@ -49,6 +49,8 @@ class FakeOption(object):
     self.list_ops = False
     self.stats = False
     self.signatures = False
+    self.histograms = False
+    self.metadata_only = False
     for key, val in kwargs.items():
       setattr(self, key, val)
     if not hasattr(self, 'payload_file'):
@@ -142,6 +144,7 @@ class FakePayload(object):
     self.header = None
     self._manifest = FakeManifest()
     self.manifest = None
+    self.metadata_signature = None
 
     self._blobs = {}
     self._payload_signatures = update_metadata_pb2.Signatures()
@@ -187,6 +190,7 @@ class FakePayload(object):
     blob = self._metadata_signatures.SerializeToString()
     self._header.metadata_signature_len = len(blob)
     self._blobs[-len(blob)] = blob
+    self.metadata_signature = self._metadata_signatures
 
 
 class PayloadCommandTest(unittest.TestCase):
@@ -277,6 +281,29 @@ Minor version:               4
 Blocks read:                 11
 Blocks written:              193
 Seeks when writing:          18
+"""
+    self.TestCommand(payload_cmd, payload, expected_out)
+
+  def testHistograms(self):
+    """Verify that the --histograms option works correctly."""
+    payload_cmd = payload_info.PayloadCommand(
+        FakeOption(histograms=True, action='show'))
+    payload = FakePayload()
+    expected_out = """Payload version:             2
+Manifest length:             222
+Number of partitions:        2
+  Number of "root" ops:      1
+  Number of "kernel" ops:    1
+Block size:                  4096
+Minor version:               4
+"root" operations:
+  REPLACE_BZ |####################| 1 (100%)
+"root" data:
+  REPLACE_BZ |####################| 1 (100%)
+"kernel" operations:
+  SOURCE_COPY |####################| 1 (100%)
+"kernel" data:
+  SOURCE_COPY | 0
 """
     self.TestCommand(payload_cmd, payload, expected_out)
 
@@ -329,6 +356,37 @@ Payload signatures: (2 entries)
 """
     self.TestCommand(payload_cmd, payload, expected_out)
 
+  def testSignaturesMetadataOnly(self):
+    """Verify that --signatures skips signatures missing from metadata."""
+    payload_cmd = payload_info.PayloadCommand(
+        FakeOption(action='show', signatures=True, metadata_only=True))
+    payload = FakePayload()
+    payload.AddPayloadSignature(data=b'I am a signature so access is yes.')
+    payload.AddMetadataSignature(data=b'\x00\x0a\x0c')
+    metadata_out = """Payload version:             2
+Manifest length:             222
+Number of partitions:        2
+  Number of "root" ops:      1
+  Number of "kernel" ops:    1
+Block size:                  4096
+Minor version:               4
+Metadata signatures blob:    file_offset=246 (7 bytes)
+"""
+    payload_out = """Payload signatures blob:     blob_offset=1234 (38 bytes)
+Payload signatures not available in the payload metadata
+"""
+    self.TestCommand(payload_cmd, payload, metadata_out + """\
+Metadata signatures: (1 entries)
+  version=None, hex_data: (3 bytes)
+    00 0a 0c                                        | ...
+""" + payload_out)
+
+    # The metadata signature may be missing from the metadata as well.
+    payload.metadata_signature = None
+    self.TestCommand(payload_cmd, payload, metadata_out + """\
+Metadata signatures not available in the payload metadata
+""" + payload_out)
+
 
 if __name__ == '__main__':
   unittest.main()
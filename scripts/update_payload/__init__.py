@@ -19,6 +19,15 @@
 # Just raise the interface classes to the root namespace.
 from __future__ import absolute_import
 
+from update_payload.applier import PATCH_BACKENDS
+from update_payload.applier import SOURCE_VERIFICATION_MODES
+from update_payload.applier import WORKER_TYPES
+from update_payload.blob_cache import BlobCache
+from update_payload.checker import CHECK_LEVELS
 from update_payload.checker import CHECKS_TO_DISABLE
+from update_payload.checker import REPORT_FORMATS
+from update_payload.downloader import PayloadDownloader
+from update_payload.downloader import RemotePayload
 from update_payload.error import PayloadError
 from update_payload.payload import Payload
+from update_payload.payload import StreamingPayload
@@ -27,9 +27,13 @@ payload. The interface for invoking the applier is as follows:
 from __future__ import absolute_import
 from __future__ import print_function
 
-import array
 import bz2
+import collections
+import ctypes
+import errno
 import hashlib
+import heapq
+import json
 # Not everywhere we can have the lzma library so we ignore it if we didn't have
 # it because it is not going to be used. For example, 'cros flash' uses
 # devserver code which eventually loads this file, but the lzma library is not
@@ -44,14 +48,117 @@ except ImportError:
     from backports import lzma
   except ImportError:
     pass
+import multiprocessing
+from multiprocessing import pool as multiprocessing_pool
 import os
+import stat
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 
+from six.moves import queue
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+from update_payload import bspatch
 from update_payload import common
 from update_payload.error import PayloadError
 
+
+#
+# Constants.
+#
+
+# Kinds of workers that can be used for applying partitions concurrently.
+_WORKER_THREAD = 'thread'
+_WORKER_PROCESS = 'process'
+WORKER_TYPES = (
+    _WORKER_THREAD,
+    _WORKER_PROCESS,
+)
+
+# Ways of applying SOURCE_BSDIFF and BROTLI_BSDIFF patches: in-process where
+# the patch format is supported and the external tool otherwise, always
+# in-process, or always with the external tool.
+_PATCH_BACKEND_AUTO = 'auto'
+_PATCH_BACKEND_PYTHON = 'python'
+_PATCH_BACKEND_EXTERNAL = 'external'
+PATCH_BACKENDS = (
+    _PATCH_BACKEND_AUTO,
+    _PATCH_BACKEND_PYTHON,
+    _PATCH_BACKEND_EXTERNAL,
+)
+
+# Default bound on the amount of data decompressed in one go.
+_DEFAULT_DECOMPRESS_BUFFER_SIZE = 1024 * 1024
+
+# Ways of verifying source partitions: in full before applying, in full
+# while applying, or only the source data of each operation, as it is used.
+_SOURCE_VERIFY_BEFORE = 'before'
+_SOURCE_VERIFY_CONCURRENT = 'concurrent'
+_SOURCE_VERIFY_OPERATIONS = 'operations'
+SOURCE_VERIFICATION_MODES = (
+    _SOURCE_VERIFY_BEFORE,
+    _SOURCE_VERIFY_CONCURRENT,
+    _SOURCE_VERIFY_OPERATIONS,
+)
+
+# Version of the checkpoint journal format.
+_JOURNAL_VERSION = 1
+
+# Number of operations, or bytes written by operations, after which progress
+# is checkpointed to the journal.
+_JOURNAL_FLUSH_OPS = 256
+_JOURNAL_FLUSH_BYTES = 64 * 1024 * 1024
+
+# Errors indicating that copy_file_range(2) cannot copy between two files, as
+# opposed to an actual I/O error.
+_COPY_FILE_RANGE_UNSUPPORTED_ERRNOS = frozenset(
+    getattr(errno, name)
+    for name in ('ENOSYS', 'EXDEV', 'EINVAL', 'EOPNOTSUPP', 'EBADF')
+    if hasattr(errno, name))
+
+# Block device ioctls from linux/fs.h, zeroing and discarding byte ranges.
+_BLKDISCARD = 0x1277
+_BLKZEROOUT = 0x127f
+
+# fallocate(2) flags from linux/falloc.h.
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+
+# Zeros written at most at once when zeroing can't be left to the kernel.
+_ZERO_BUFFER = bytes(bytearray(1024 * 1024))
+
+# Names of the counters kept while applying.
+STAT_SOURCE_COPY_KERNEL_BYTES = 'source_copy_kernel_bytes'
+STAT_SOURCE_COPY_USERSPACE_BYTES = 'source_copy_userspace_bytes'
+STAT_ZERO_KERNEL_BYTES = 'zero_kernel_bytes'
+STAT_ZERO_WRITTEN_BYTES = 'zero_written_bytes'
+STAT_PATCH_IN_PROCESS_OPS = 'patch_in_process_ops'
+STAT_PATCH_TOOL_RUNS = 'patch_tool_runs'
+STAT_VERIFIED_WHILE_WRITING_BYTES = 'verified_while_writing_bytes'
+STAT_VERIFIED_BY_READING_BYTES = 'verified_by_reading_bytes'
+
+
+def _LoadFallocate():
+  """Returns the C library's fallocate(2) wrapper, or None if not found."""
+  try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+  except (AttributeError, OSError):
+    return None
+  fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                        ctypes.c_int64]
+  fallocate.restype = ctypes.c_int
+  return fallocate
+
+_FALLOCATE = _LoadFallocate()
+
+
 #
 # Helper functions.
 #
@@ -92,32 +199,267 @@ def _VerifySha256(file_obj, expected_hash, name, length=-1):
                         common.FormatSha256(expected_hash)))
 
 
-def _ReadExtents(file_obj, extents, block_size, max_length=-1):
+class _BackgroundVerifier(object):
+  """Verifies the SHA256 hash of a file on a background thread."""
+
+  def __init__(self, file_name, expected_hash, name, length):
+    """Starts verifying a file.
+
+    Args:
+      file_name: the name of the file to verify
+      expected_hash: the hash digest we expect to be getting
+      name: name string of this hash, for error reporting
+      length: precise length of data to verify
+    """
+    self.error = None
+    self._thread = threading.Thread(
+        target=self._Verify, args=(file_name, expected_hash, name, length))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _Verify(self, file_name, expected_hash, name, length):
+    try:
+      with open(file_name, 'rb') as file_obj:
+        _VerifySha256(file_obj, expected_hash, name, length=length)
+    except (IOError, OSError) as e:
+      self.error = PayloadError('failed to verify %s: %s' % (name, e))
+    except PayloadError as e:
+      self.error = e
+
+  def Check(self):
+    """Raises the verification error, if verification failed already."""
+    if self.error:
+      raise self.error
+
+  def Join(self):
+    """Waits for verification to finish."""
+    self._thread.join()
+
+  def Wait(self):
+    """Waits for verification to finish, raising its error if it failed."""
+    self.Join()
+    self.Check()
+
+
+def _FileDescriptor(file_obj):
+  """Returns the OS-level file descriptor of a file object, or None."""
+  try:
+    return file_obj.fileno()
+  except (AttributeError, IOError, ValueError):
+    return None
+
+
+def _BlockDeviceSize(file_name):
+  """Returns the size of a block device, or None if the file is not one."""
+  try:
+    if not stat.S_ISBLK(os.stat(file_name).st_mode):
+      return None
+  except OSError:
+    return None
+  with open(file_name, 'rb') as dev:
+    dev.seek(0, 2)
+    return dev.tell()
+
+
+def _ReadAt(file_obj, buf, offset):
+  """Reads data at a given offset of a file into a buffer.
+
+  Uses positional reads on the underlying file descriptor where available,
+  which keeps the file position untouched.
+
+  Args:
+    file_obj: file object
+    buf: a writable buffer (e.g. a memoryview slice) to fill
+    offset: the absolute offset in the file to read from
+
+  Returns:
+    The number of bytes read, which is less than the size of the buffer only
+    when hitting the end of the file.
+  """
+  view = memoryview(buf)
+  total_read = 0
+  fd = _FileDescriptor(file_obj) if hasattr(os, 'preadv') else None
+  if fd is None:
+    file_obj.seek(offset)
+  else:
+    # Make sure pending buffered writes are visible to us.
+    file_obj.flush()
+
+  while view:
+    if fd is None:
+      read_length = file_obj.readinto(view)
+    else:
+      read_length = os.preadv(fd, [view], offset + total_read)
+    if not read_length:
+      break
+    view = view[read_length:]
+    total_read += read_length
+
+  return total_read
+
+
+def _WriteAt(file_obj, data, offset):
+  """Writes data at a given offset of a file.
+
+  Uses positional writes on the underlying file descriptor where available,
+  which keeps the file position untouched.
+
+  Args:
+    file_obj: file object
+    data: data to write
+    offset: the absolute offset in the file to write at
+  """
+  fd = _FileDescriptor(file_obj) if hasattr(os, 'pwrite') else None
+  if fd is None:
+    file_obj.seek(offset)
+    file_obj.write(data)
+    return
+
+  # Make sure buffered writes do not land on top of ours later on.
+  file_obj.flush()
+  view = memoryview(data)
+  while view:
+    written = os.pwrite(fd, view, offset)
+    view = view[written:]
+    offset += written
+
+
+def _OpenToolFile(data=None):
+  """Creates an anonymous file to be passed to an external tool by name.
+
+  Where supported, this is a memfd(2) that the tool opens through /dev/fd, so
+  nothing touches the file system. Otherwise, it is a temporary file which is
+  deleted when closed. Either way, callers should run the tool with close_fds
+  set to False.
+
+  Args:
+    data: initial content of the file (optional)
+
+  Returns:
+    A tuple of the file object, open for reading and writing, and the file
+    name to pass to the tool.
+  """
+  if hasattr(os, 'memfd_create'):
+    fd = os.memfd_create('update_payload')
+    os.set_inheritable(fd, True)
+    tool_file = os.fdopen(fd, 'w+b')
+    tool_file_name = '/dev/fd/%d' % fd
+  else:
+    tool_file = tempfile.NamedTemporaryFile()
+    tool_file_name = tool_file.name
+  if data:
+    tool_file.write(data)
+    tool_file.flush()
+  return tool_file, tool_file_name
+
+
+def _WriteZeros(file_obj, offset, length):
+  """Writes zeros to a range of a file, reusing a single zero buffer.
+
+  Args:
+    file_obj: file object
+    offset: the absolute offset in the file to start writing at
+    length: the number of zero bytes to write
+  """
+  zeros = memoryview(_ZERO_BUFFER)
+  while length:
+    write_length = min(length, len(zeros))
+    _WriteAt(file_obj, zeros[:write_length], offset)
+    offset += write_length
+    length -= write_length
+
+
+def _PunchHole(fd, offset, length):
+  """Turns a range of a regular file into a hole, reading back as zeros.
+
+  The file is extended if the range goes past its end.
+
+  Args:
+    fd: the file descriptor
+    offset: the absolute offset of the range
+    length: the length of the range
+
+  Returns:
+    True if successful, False if hole punching is not supported.
+  """
+  if _FALLOCATE is None:
+    return False
+  file_size = os.fstat(fd).st_size
+  if offset < file_size:
+    punch_length = min(length, file_size - offset)
+    if _FALLOCATE(fd, _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE, offset,
+                  punch_length):
+      return False
+  if offset + length > file_size:
+    os.ftruncate(fd, offset + length)
+  return True
+
+
+def _BlockDeviceZeroOut(fd, offset, length, discard):
+  """Zeroes or discards a range of a block device.
+
+  Args:
+    fd: the file descriptor
+    offset: the absolute offset of the range
+    length: the length of the range
+    discard: whether to discard the range rather than zero it
+
+  Returns:
+    True if successful, False if the device does not support it.
+  """
+  if fcntl is None:
+    return False
+  try:
+    fcntl.ioctl(fd, _BLKDISCARD if discard else _BLKZEROOUT,
+                struct.pack('QQ', offset, length))
+  except (IOError, OSError):
+    return False
+  return True
+
+
+def _ReadExtents(file_obj, extents, block_size, max_length=-1, buf=None):
   """Reads data from file as defined by extent sequence.
 
-  This tries to be efficient by not copying data as it is read in chunks.
+  Each extent is read straight into its place in a single buffer, so no
+  intermediate copies are made.
 
   Args:
     file_obj: file object
     extents: sequence of block extents (offset and length)
     block_size: size of each block
     max_length: maximum length to read (optional)
+    buf: a bytearray to read into, used if large enough (optional)
 
   Returns:
-    A character array containing the concatenated read data.
+    A memoryview of the concatenated read data.
+
+  Raises:
+    PayloadError if the file ends before all data was read.
   """
-  data = array.array('B')
   if max_length < 0:
     max_length = sys.maxsize
+  read_ranges = []
+  data_length = 0
   for ex in extents:
-    if max_length == 0:
+    if data_length == max_length:
       break
-    read_length = min(max_length, ex.num_blocks * block_size)
+    read_length = min(max_length - data_length, ex.num_blocks * block_size)
+    read_ranges.append((ex.start_block * block_size, read_length))
+    data_length += read_length
 
-    file_obj.seek(ex.start_block * block_size)
-    data.fromfile(file_obj, read_length)
+  if buf is None or len(buf) < data_length:
+    buf = bytearray(data_length)
+  data = memoryview(buf)[:data_length]
 
-    max_length -= read_length
+  data_offset = 0
+  for file_offset, read_length in read_ranges:
+    actual_length = _ReadAt(
+        file_obj, data[data_offset:data_offset + read_length], file_offset)
+    if actual_length != read_length:
+      raise PayloadError(
+          'reading from file (%s) too short (%d instead of %d bytes)' %
+          (getattr(file_obj, 'name', None), actual_length, read_length))
+    data_offset += read_length
 
   return data
 
@@ -137,14 +479,15 @@ def _WriteExtents(file_obj, data, extents, block_size, base_name):
   Raises:
     PayloadError when things don't add up.
   """
+  data = memoryview(data)
   data_offset = 0
   data_length = len(data)
   for ex, ex_name in common.ExtentIter(extents, base_name):
     if not data_length:
       raise PayloadError('%s: more write extents than data' % ex_name)
     write_length = min(data_length, ex.num_blocks * block_size)
-    file_obj.seek(ex.start_block * block_size)
-    file_obj.write(data[data_offset:(data_offset + write_length)])
+    _WriteAt(file_obj, data[data_offset:(data_offset + write_length)],
+             ex.start_block * block_size)
 
     data_offset += write_length
     data_length -= write_length
@@ -153,6 +496,48 @@ def _WriteExtents(file_obj, data, extents, block_size, base_name):
     raise PayloadError('%s: more data than write extents' % base_name)
 
 
+def _ExtentPairIter(src_extents, dst_extents, block_size, base_name):
+  """Maps a sequence of src extents onto a sequence of dst extents.
+
+  Args:
+    src_extents: sequence of block extents to read from
+    dst_extents: sequence of block extents to write to
+    block_size: size of each block
+    base_name: name string of the dst extent sequence for error reporting
+
+  Yields:
+    (src_offset, dst_offset, length) tuples of byte ranges, such that copying
+    each src range to its dst range moves the data from the src extents to
+    the dst extents.
+
+  Raises:
+    PayloadError if src and dst extents differ in total length.
+  """
+  dst_iter = common.ExtentIter(dst_extents, base_name)
+  dst_offset = dst_left = 0
+  for src_ex in src_extents:
+    src_offset = src_ex.start_block * block_size
+    src_left = src_ex.num_blocks * block_size
+    while src_left:
+      if not dst_left:
+        dst_ex, _ = next(dst_iter, (None, None))
+        if dst_ex is None:
+          raise PayloadError('%s: more data than write extents' % base_name)
+        dst_offset = dst_ex.start_block * block_size
+        dst_left = dst_ex.num_blocks * block_size
+      length = min(src_left, dst_left)
+      yield src_offset, dst_offset, length
+      src_offset += length
+      src_left -= length
+      dst_offset += length
+      dst_left -= length
+
+  dst_ex, dst_ex_name = next(dst_iter, (None, None))
+  if dst_left or dst_ex is not None:
+    raise PayloadError('%s: more write extents than data' %
+                       (dst_ex_name or base_name))
+
+
 def _ExtentsToBspatchArg(extents, block_size, base_name, data_length=-1):
   """Translates an extent sequence into a bspatch-compatible string argument.
 
@@ -196,6 +581,363 @@ def _ExtentsToBspatchArg(extents, block_size, base_name, data_length=-1):
   return arg, pad_off, pad_len
 
 
+def _IsWrittenInOrder(operations, block_size, part_size):
+  """Returns whether operations write a whole partition front to back.
+
+  This holds when the operations replace or zero data, and their dst extents
+  follow each other without gaps or overlaps, from the first block up to the
+  end of the partition.
+
+  Args:
+    operations: the sequence of operations
+    block_size: the size of each block
+    part_size: the partition size
+  """
+  next_block = 0
+  for op in operations:
+    if op.type not in (common.OpType.REPLACE, common.OpType.REPLACE_BZ,
+                       common.OpType.REPLACE_XZ, common.OpType.ZERO):
+      return False
+    for ex in op.dst_extents:
+      if ex.start_block != next_block:
+        return False
+      next_block += ex.num_blocks
+  return next_block * block_size >= part_size
+
+
+def _DstOverlapDependencies(operations):
+  """Finds the earlier operations each operation's dst extents overlap with.
+
+  This is an interval sweep over all dst extents, so that it only costs as
+  much as sorting the extents when there is no overlap at all, which is the
+  common case for full payloads.
+
+  Args:
+    operations: the sequence of operations
+
+  Returns:
+    A list containing, for every operation, the set of indices of preceding
+    operations that write to at least one of the same blocks.
+  """
+  intervals = sorted((ex.start_block, ex.start_block + ex.num_blocks, idx)
+                     for idx, op in enumerate(operations)
+                     for ex in op.dst_extents)
+  deps = [set() for _ in operations]
+  active = []
+  for start, end, idx in intervals:
+    while active and active[0][0] <= start:
+      heapq.heappop(active)
+    for _, other_idx in active:
+      if other_idx != idx:
+        deps[max(idx, other_idx)].add(min(idx, other_idx))
+    heapq.heappush(active, (end, idx))
+  return deps
+
+
+def _DecompressBlob(op_type, data):
+  """Decompresses the data blob of a REPLACE{,_BZ,_XZ} operation.
+
+  This runs in pool worker processes, so errors are returned rather than
+  raised for the parent to report them against the right operation.
+
+  Args:
+    op_type: the operation type
+    data: the raw data blob
+
+  Returns:
+    A pair consisting of the decompressed data and an error string (None if
+    decompression succeeded).
+  """
+  try:
+    if op_type == common.OpType.REPLACE_BZ:
+      data = bz2.decompress(data)
+    elif op_type == common.OpType.REPLACE_XZ:
+      # pylint: disable=no-member
+      data = lzma.decompress(data)
+  except Exception as e:  # pylint: disable=broad-except
+    return None, str(e)
+  return data, None
+
+
+def _DecompressChunks(decompressor_cls, data, chunk_size, op_name):
+  """Incrementally decompresses data, yielding it in bounded chunks.
+
+  Like bz2.decompress and lzma.decompress, this decompresses concatenated
+  compressed streams, e.g. as written by pbzip2, one after the other.
+
+  Args:
+    decompressor_cls: bz2.BZ2Decompressor or lzma.LZMADecompressor
+    data: the compressed data
+    chunk_size: the maximum size of each decompressed chunk, also used as the
+                size of the compressed chunks fed to the decompressor
+    op_name: name string for error reporting
+
+  Yields:
+    Consecutive chunks of decompressed data.
+
+  Raises:
+    PayloadError if the compressed data is invalid or truncated.
+  """
+  def _Decompress(decompressor, in_chunk, *args):
+    try:
+      return decompressor.decompress(in_chunk, *args)
+    except Exception as e:  # pylint: disable=broad-except
+      raise PayloadError('%s: failed to decompress data: %s' % (op_name, e))
+
+  decompressor = decompressor_cls()
+  if not hasattr(decompressor, 'needs_input'):
+    # Older decompressors cannot bound their output, so just do it at once.
+    while data:
+      yield _Decompress(decompressor, data)
+      if not decompressor.eof:
+        raise PayloadError('%s: compressed data ended prematurely' % op_name)
+      data = decompressor.unused_data
+      decompressor = decompressor_cls()
+    return
+
+  data = memoryview(data)
+  data_pos = 0
+  while True:
+    if decompressor.eof:
+      # Any data fed past the end of the stream starts the next one.
+      data_pos -= len(decompressor.unused_data)
+      if data_pos >= len(data):
+        break
+      decompressor = decompressor_cls()
+    if decompressor.needs_input:
+      if data_pos >= len(data):
+        raise PayloadError('%s: compressed data ended prematurely' % op_name)
+      in_chunk = data[data_pos:data_pos + chunk_size]
+      data_pos += len(in_chunk)
+    else:
+      in_chunk = b''
+    out_chunk = _Decompress(decompressor, in_chunk, chunk_size)
+    if out_chunk:
+      yield out_chunk
+
+
+def _ApplyPartitionInProcess(args):
+  """Applies a single partition update from within a worker process.
+
+  Worker processes do not share the parent's payload file object, so the
+  payload is reopened by name and reinitialized before applying.
+
+  Args:
+    args: a tuple consisting of the payload class, the payload file name, the
+          payload file offset, whether to map the payload file into memory, a
+          dictionary of PayloadApplier arguments, and the partition name, dest
+          and source partition file names
+
+  Returns:
+    The applier's counters.
+
+  Raises:
+    PayloadError if anything goes wrong with the update.
+  """
+  (payload_cls, payload_file_name, payload_file_offset, use_mmap,
+   applier_args, part_name, new_part_file_name, old_part_file_name) = args
+  with open(payload_file_name, 'rb') as payload_file:
+    with payload_cls(payload_file, payload_file_offset=payload_file_offset,
+                     use_mmap=use_mmap) as payload:
+      payload.Init()
+      helper = PayloadApplier(payload, **applier_args)
+      helper.ApplyPartition(part_name, new_part_file_name, old_part_file_name)
+      return helper.stats
+
+
+class _WriteHasher(object):
+  """Hashes partition data as it is written, front to back.
+
+  Only the leading bytes up to the partition size are hashed, so padding
+  written past the end of the partition is ignored.
+  """
+
+  def __init__(self, length):
+    """Initialize the hasher.
+
+    Args:
+      length: the number of bytes to hash
+    """
+    self.length = length
+    self._hasher = hashlib.sha256()
+    self._remaining = length
+
+  def Update(self, data):
+    """Hashes the next data written."""
+    data = memoryview(data)[:self._remaining]
+    self._hasher.update(data)
+    self._remaining -= len(data)
+
+  def UpdateZeros(self, length):
+    """Hashes the next zeros written."""
+    zeros = memoryview(_ZERO_BUFFER)
+    while length and self._remaining:
+      update_length = min(length, len(zeros))
+      self.Update(zeros[:update_length])
+      length -= update_length
+
+  def Digest(self):
+    """Returns the hash digest, or None if not all data was hashed."""
+    return None if self._remaining else self._hasher.digest()
+
+
+#
+# Checkpointing.
+#
+class _Journal(object):
+  """A checkpoint journal of payload application progress.
+
+  The journal is a JSON file recording, for each partition, the file it is
+  being written to and the index of the first operation not known to have
+  been applied yet. It is tied to a payload by the hash of its metadata, and
+  replaced atomically whenever it is updated.
+  """
+
+  def __init__(self, file_name, metadata_hash, resume):
+    """Initialize the journal.
+
+    Args:
+      file_name: the journal file name
+      metadata_hash: the SHA256 hash of the payload metadata
+      resume: whether to pick up the progress recorded in an existing journal
+
+    Raises:
+      PayloadError if the existing journal is invalid or for another payload.
+    """
+    self.file_name = file_name
+    self.metadata_hash = common.FormatSha256(metadata_hash)
+    self.partitions = {}
+    self._lock = threading.Lock()
+    if not (resume and os.path.exists(file_name)):
+      return
+
+    try:
+      with open(file_name) as journal_file:
+        content = json.load(journal_file)
+      version = content['version']
+      metadata_hash = content['metadata_sha256']
+      partitions = content['partitions']
+    except (IOError, ValueError, KeyError, TypeError) as e:
+      raise PayloadError('invalid journal (%s): %s' % (file_name, e))
+    if version != _JOURNAL_VERSION:
+      raise PayloadError('unsupported journal version (%r)' % version)
+    if metadata_hash != self.metadata_hash:
+      raise PayloadError('journal (%s) is for another payload' % file_name)
+    self.partitions = partitions
+
+  def NextOperation(self, part_name, new_part_file_name, num_ops):
+    """Returns the index of the first operation of a partition to apply.
+
+    Args:
+      part_name: the name of the partition
+      new_part_file_name: file name the partition is written to
+      num_ops: the number of operations of the partition
+
+    Raises:
+      PayloadError if the recorded progress does not match the partition.
+    """
+    with self._lock:
+      entry = self.partitions.get(part_name)
+    if not entry:
+      return 0
+    if entry.get('file_name') != os.path.abspath(new_part_file_name):
+      raise PayloadError('%s: journal recorded progress writing to another '
+                         'file (%s)' % (part_name, entry.get('file_name')))
+    next_op = entry.get('next_operation')
+    if not isinstance(next_op, int) or not 0 <= next_op <= num_ops:
+      raise PayloadError('%s: invalid next operation in journal (%r)' %
+                         (part_name, next_op))
+    if next_op and not os.path.exists(new_part_file_name):
+      raise PayloadError('%s: cannot resume, file is missing (%s)' %
+                         (part_name, new_part_file_name))
+    return next_op
+
+  def Record(self, part_name, new_part_file_name, next_op):
+    """Records the progress of a partition, replacing the journal file.
+
+    Args:
+      part_name: the name of the partition
+      new_part_file_name: file name the partition is written to
+      next_op: the index of the first operation not applied yet
+    """
+    with self._lock:
+      self.partitions[part_name] = {
+          'file_name': os.path.abspath(new_part_file_name),
+          'next_operation': next_op,
+      }
+      content = {
+          'version': _JOURNAL_VERSION,
+          'metadata_sha256': self.metadata_hash,
+          'partitions': self.partitions,
+      }
+      tmp_file_name = self.file_name + '.tmp'
+      with open(tmp_file_name, 'w') as tmp_file:
+        json.dump(content, tmp_file, indent=2, sort_keys=True)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+      os.rename(tmp_file_name, self.file_name)
+
+
+class _PartitionProgress(object):
+  """Tracks the operations applied to a partition and checkpoints them.
+
+  Operations may complete out of order; only the longest prefix of applied
+  operations is recorded. The partition file is synced to disk before the
+  journal is updated, so the journal never gets ahead of the data.
+  """
+
+  def __init__(self, journal, part_name, new_part_file_name, new_part_file,
+               block_size, next_op):
+    """Initialize the progress tracker.
+
+    Args:
+      journal: the _Journal to record progress to
+      part_name: the name of the partition
+      new_part_file_name: file name the partition is written to
+      new_part_file: the new partition file object
+      block_size: the payload block size
+      next_op: the index of the first operation to apply
+    """
+    self.journal = journal
+    self.part_name = part_name
+    self.new_part_file_name = new_part_file_name
+    self.new_part_file = new_part_file
+    self.block_size = block_size
+    self.next_op = next_op
+    self._recorded_op = next_op
+    self._applied = set()
+    self._pending_ops = 0
+    self._pending_bytes = 0
+
+  def OperationApplied(self, idx, op):
+    """Notes that an operation was applied, checkpointing as needed.
+
+    Args:
+      idx: the index of the operation
+      op: the operation object
+    """
+    self._applied.add(idx)
+    while self.next_op in self._applied:
+      self._applied.remove(self.next_op)
+      self.next_op += 1
+    self._pending_ops += 1
+    self._pending_bytes += sum(ex.num_blocks for ex in op.dst_extents
+                               ) * self.block_size
+    if (self._pending_ops >= _JOURNAL_FLUSH_OPS or
+        self._pending_bytes >= _JOURNAL_FLUSH_BYTES):
+      self.Checkpoint()
+
+  def Checkpoint(self):
+    """Records the operations applied so far, if there are new ones."""
+    self._pending_ops = self._pending_bytes = 0
+    if self.next_op == self._recorded_op:
+      return
+    self.new_part_file.flush()
+    os.fsync(self.new_part_file.fileno())
+    self.journal.Record(self.part_name, self.new_part_file_name, self.next_op)
+    self._recorded_op = self.next_op
+
+
 #
 # Payload application.
 #
@@ -207,7 +949,12 @@ class PayloadApplier(object):
   """
 
   def __init__(self, payload, bsdiff_in_place=True, bspatch_path=None,
-               puffpatch_path=None, truncate_to_expected_size=True):
+               puffpatch_path=None, truncate_to_expected_size=True,
+               part_workers=1, part_worker_type=_WORKER_THREAD,
+               decompress_workers=0, decompress_buffer_size=0,
+               use_copy_file_range=True, patch_backend=_PATCH_BACKEND_AUTO,
+               journal_file_name=None, resume=False,
+               source_verification=_SOURCE_VERIFY_BEFORE):
     """Initialize the applier.
 
     Args:
@@ -218,8 +965,43 @@ class PayloadApplier(object):
       truncate_to_expected_size: whether to truncate the resulting partitions
                                  to their expected sizes, as specified in the
                                  payload (optional)
+      part_workers: number of partitions to apply concurrently (optional)
+      part_worker_type: whether partitions are applied by a pool of 'thread'
+                        or 'process' workers (optional)
+      decompress_workers: number of worker processes decompressing the data
+                          of full partition updates in parallel; zero or one
+                          decompresses inline, as do partition worker
+                          processes, which cannot have children (optional)
+      decompress_buffer_size: maximum size of data chunks decompressed at
+                              once when decompressing inline (optional)
+      use_copy_file_range: whether to let the kernel copy SOURCE_COPY data
+                           with copy_file_range(2), where supported
+                           (optional)
+      patch_backend: whether bsdiff patches are applied in-process
+                     ('python'), by bspatch ('external'), or in-process
+                     unless the patch needs a missing decompressor ('auto')
+                     (optional)
+      journal_file_name: file to checkpoint progress to, allowing an
+                         interrupted application to be resumed (optional)
+      resume: whether to skip the operations recorded as applied in the
+              journal, rather than starting over (optional)
+      source_verification: whether source partitions are hashed in full
+                           'before' applying, in full 'concurrent'ly with
+                           applying, rolling back the destination on a
+                           mismatch, or only as far as used by
+                           'operations' with a source hash (optional)
     """
     assert payload.is_init, 'uninitialized update payload'
+    if part_worker_type not in WORKER_TYPES:
+      raise PayloadError('invalid partition worker type (%r)' %
+                         part_worker_type)
+    if patch_backend not in PATCH_BACKENDS:
+      raise PayloadError('invalid patch backend (%r)' % patch_backend)
+    if source_verification not in SOURCE_VERIFICATION_MODES:
+      raise PayloadError('invalid source verification mode (%r)' %
+                         source_verification)
+    if resume and not journal_file_name:
+      raise PayloadError('resuming requires a journal')
     self.payload = payload
     self.block_size = payload.manifest.block_size
     self.minor_version = payload.manifest.minor_version
@@ -227,89 +1009,300 @@ class PayloadApplier(object):
     self.bspatch_path = bspatch_path or 'bspatch'
     self.puffpatch_path = puffpatch_path or 'puffin'
     self.truncate_to_expected_size = truncate_to_expected_size
+    self.part_workers = max(part_workers, 1)
+    self.part_worker_type = part_worker_type
+    self.decompress_workers = decompress_workers
+    self.decompress_buffer_size = (decompress_buffer_size or
+                                   _DEFAULT_DECOMPRESS_BUFFER_SIZE)
+    self.use_copy_file_range = (use_copy_file_range and
+                                hasattr(os, 'copy_file_range'))
+    self.patch_backend = patch_backend
+    self.source_verification = source_verification
+    self.journal = (_Journal(journal_file_name,
+                             payload.manifest_hasher.digest(), resume)
+                    if journal_file_name else None)
+    self.stats = collections.defaultdict(int)
+    self._can_discard_block_devices = True
+    self._can_zero_out_block_devices = True
+    self._can_punch_holes = True
+    self._stats_lock = threading.Lock()
+    self._thread_state = threading.local()
+
+  def _AddStat(self, name, value):
+    """Adds a value to one of the applier's counters."""
+    with self._stats_lock:
+      self.stats[name] += value
+
+  def _IoBuffer(self, length):
+    """Returns the calling thread's reusable buffer for extent reads.
+
+    Args:
+      length: the minimum size of the buffer
+
+    Returns:
+      A bytearray of at least the requested size.
+    """
+    buf = getattr(self._thread_state, 'io_buffer', None)
+    if buf is None or len(buf) < length:
+      buf = self._thread_state.io_buffer = bytearray(length)
+    return buf
 
-  def _ApplyReplaceOperation(self, op, op_name, out_data, part_file, part_size):
+  def _ApplyReplaceOperation(self, op, op_name, out_data, part_file, part_size,
+                             hasher=None):
     """Applies a REPLACE{,_BZ,_XZ} operation.
 
+    Compressed data is decompressed incrementally and written out chunk by
+    chunk, so memory usage does not grow with the size of the operation,
+    unless the decompressed data is cached, in which case it is taken from
+    or added to the blob cache whole.
+
     Args:
       op: the operation object
       op_name: name string for error reporting
       out_data: the data to be written
       part_file: the partition file object
       part_size: the size of the partition
+      hasher: a _WriteHasher to pass the written data through (optional)
 
     Raises:
       PayloadError if something goes wrong.
     """
-    block_size = self.block_size
-    data_length = len(out_data)
-
+    # Take the decompressed data from the blob cache, or add it there.
+    blob_hash = self._DecompressedCacheKey(op, out_data)
+    if blob_hash:
+      blob_cache = self.payload.blob_cache
+      decompressed = blob_cache.GetDecompressed(blob_hash)
+      if decompressed is None:
+        decompressed, err = _DecompressBlob(op.type, out_data)
+        if err is not None:
+          raise PayloadError('%s: failed to decompress data: %s' %
+                             (op_name, err))
+        blob_cache.PutDecompressed(blob_hash, decompressed)
+      out_chunks = (decompressed,)
     # Decompress data if needed.
-    if op.type == common.OpType.REPLACE_BZ:
-      out_data = bz2.decompress(out_data)
-      data_length = len(out_data)
+    elif op.type == common.OpType.REPLACE_BZ:
+      out_chunks = _DecompressChunks(bz2.BZ2Decompressor, out_data,
+                                     self.decompress_buffer_size, op_name)
     elif op.type == common.OpType.REPLACE_XZ:
       # pylint: disable=no-member
-      out_data = lzma.decompress(out_data)
-      data_length = len(out_data)
+      out_chunks = _DecompressChunks(lzma.LZMADecompressor, out_data,
+                                     self.decompress_buffer_size, op_name)
+    else:
+      out_chunks = (out_data,)
 
-    # Write data to blocks specified in dst extents.
-    data_start = 0
-    for ex, ex_name in common.ExtentIter(op.dst_extents,
-                                         '%s.dst_extents' % op_name):
-      start_block = ex.start_block
-      num_blocks = ex.num_blocks
-      count = num_blocks * block_size
+    self._WriteReplaceData(op, op_name, out_chunks, part_file, part_size,
+                           hasher=hasher)
+
+  def _DecompressedCacheKey(self, op, data):
+    """Returns the key of the decompressed data of an operation in the cache.
+
+    Args:
+      op: the operation object
+      data: the operation's data blob
+
+    Returns:
+      The hash of the compressed data blob, or None if the operation has no
+      compressed data or decompressed data is not cached.
+    """
+    blob_cache = self.payload.blob_cache
+    if (blob_cache and blob_cache.cache_decompressed and
+        op.type in (common.OpType.REPLACE_BZ, common.OpType.REPLACE_XZ)):
+      # The hash in the manifest is not verified unless checking the payload
+      # while applying it, so it cannot be trusted as a key.
+      return hashlib.sha256(data).digest()
+    return None
+
+  def _WriteReplaceData(self, op, op_name, out_chunks, part_file, part_size,
+                        hasher=None):
+    """Writes the (decompressed) data of a REPLACE{,_BZ,_XZ} operation.
+
+    Args:
+      op: the operation object
+      op_name: name string for error reporting
+      out_chunks: iterable of consecutive chunks of the data to be written
+      part_file: the partition file object
+      part_size: the size of the partition
+      hasher: a _WriteHasher to pass the written data through, assuming the
+              data is written in partition order (optional)
 
-      data_end = data_start + count
+    Raises:
+      PayloadError if something goes wrong.
+    """
+    block_size = self.block_size
 
+    # Collect the byte ranges of the dst extents.
+    dst_ranges = []
+    for ex, ex_name in common.ExtentIter(op.dst_extents,
+                                         '%s.dst_extents' % op_name):
       # Make sure we're not running past partition boundary.
-      if (start_block + num_blocks) * block_size > part_size:
+      if (ex.start_block + ex.num_blocks) * block_size > part_size:
         raise PayloadError(
             '%s: extent (%s) exceeds partition size (%d)' %
             (ex_name, common.FormatExtent(ex, block_size),
              part_size))
+      dst_ranges.append((ex_name, ex.start_block * block_size,
+                         ex.num_blocks * block_size))
+    dst_length = sum(length for _, _, length in dst_ranges)
 
-      # Make sure that we have enough data to write.
-      if data_end >= data_length + block_size:
-        raise PayloadError(
-            '%s: more dst blocks than data (even with padding)')
+    # Write data to blocks specified in dst extents.
+    range_idx = range_pos = 0
+    data_length = 0
+    for chunk in out_chunks:
+      chunk = memoryview(chunk)
+      data_length += len(chunk)
+      while chunk and range_idx < len(dst_ranges):
+        _, range_start, range_length = dst_ranges[range_idx]
+        write_length = min(len(chunk), range_length - range_pos)
+        _WriteAt(part_file, chunk[:write_length], range_start + range_pos)
+        if hasher:
+          hasher.Update(chunk[:write_length])
+        chunk = chunk[write_length:]
+        range_pos += write_length
+        if range_pos == range_length:
+          range_idx += 1
+          range_pos = 0
 
-      # Pad with zeros if necessary.
-      if data_end > data_length:
-        padding = data_end - data_length
-        out_data += b'\0' * padding
+    # Make sure we wrote all data.
+    if dst_length < data_length:
+      raise PayloadError('%s: wrote fewer bytes (%d) than expected (%d)' %
+                         (op_name, dst_length, data_length))
+
+    # Make sure that we have enough data to write.
+    if dst_length >= data_length + block_size:
+      data_end = 0
+      for ex_name, _, range_length in dst_ranges:
+        data_end += range_length
+        if data_end >= data_length + block_size:
+          raise PayloadError(
+              '%s: more dst blocks than data (even with padding)' % ex_name)
 
-      self.payload.payload_file.seek(start_block * block_size)
-      part_file.seek(start_block * block_size)
-      part_file.write(out_data[data_start:data_end])
+    # Pad the last block with zeros if necessary.
+    if range_pos:
+      _, range_start, range_length = dst_ranges[range_idx]
+      _WriteAt(part_file, b'\0' * (range_length - range_pos),
+               range_start + range_pos)
+      if hasher:
+        hasher.UpdateZeros(range_length - range_pos)
 
-      data_start += count
+  def _ZeroOutInKernel(self, part_file, offset, length, discard):
+    """Lets the kernel zero or discard a range of a partition file.
 
-    # Make sure we wrote all data.
-    if data_start < data_length:
-      raise PayloadError('%s: wrote fewer bytes (%d) than expected (%d)' %
-                         (op_name, data_start, data_length))
+    Block devices are zeroed or discarded with ioctls, zeroing ranges that
+    fail to be discarded, and regular files get a hole punched, which also
+    keeps them sparse. Once a method turns out not to be supported, it is
+    not tried again.
 
-  def _ApplyZeroOperation(self, op, op_name, part_file):
-    """Applies a ZERO operation.
+    Args:
+      part_file: the partition file object
+      offset: the absolute offset of the range
+      length: the length of the range
+      discard: whether the range may be discarded rather than zeroed
+
+    Returns:
+      True if successful, False if the range needs zeroing some other way.
+    """
+    fd = _FileDescriptor(part_file)
+    if fd is None:
+      return False
+
+    # Make sure buffered writes do not land on top of the zeroed range later.
+    part_file.flush()
+    mode = os.fstat(fd).st_mode
+    if stat.S_ISBLK(mode):
+      if discard and self._can_discard_block_devices:
+        if _BlockDeviceZeroOut(fd, offset, length, True):
+          return True
+        self._can_discard_block_devices = False
+      if self._can_zero_out_block_devices:
+        if _BlockDeviceZeroOut(fd, offset, length, False):
+          return True
+        self._can_zero_out_block_devices = False
+    elif stat.S_ISREG(mode) and self._can_punch_holes:
+      if _PunchHole(fd, offset, length):
+        return True
+      self._can_punch_holes = False
+    return False
+
+  def _ApplyZeroOperation(self, op, op_name, part_file, hasher=None):
+    """Applies a ZERO or DISCARD operation.
 
     Args:
       op: the operation object
       op_name: name string for error reporting
       part_file: the partition file object
+      hasher: a _WriteHasher to pass the zeros through, assuming they are
+              written in partition order (optional)
 
     Raises:
       PayloadError if something goes wrong.
     """
     block_size = self.block_size
     base_name = '%s.dst_extents' % op_name
+    discard = op.type == common.OpType.DISCARD
 
-    # Iterate over the extents and write zero.
+    # Iterate over the extents and zero them.
     # pylint: disable=unused-variable
     for ex, ex_name in common.ExtentIter(op.dst_extents, base_name):
-      part_file.seek(ex.start_block * block_size)
-      part_file.write(b'\0' * (ex.num_blocks * block_size))
+      offset = ex.start_block * block_size
+      length = ex.num_blocks * block_size
+      if self._ZeroOutInKernel(part_file, offset, length, discard):
+        self._AddStat(STAT_ZERO_KERNEL_BYTES, length)
+      else:
+        _WriteZeros(part_file, offset, length)
+        self._AddStat(STAT_ZERO_WRITTEN_BYTES, length)
+      if hasher:
+        hasher.UpdateZeros(length)
+
+  def _CopyExtentsInKernel(self, op, op_name, old_part_file, new_part_file):
+    """Copies the data of a SOURCE_COPY operation using copy_file_range(2).
+
+    The data never enters userspace, and filesystems that support it may even
+    share the underlying blocks (reflink). Once the kernel or filesystem
+    turns out not to support it, it is not tried again.
+
+    Args:
+      op: the operation object
+      op_name: name string for error reporting
+      old_part_file: the old partition file object
+      new_part_file: the new partition file object
+
+    Returns:
+      True if the data was copied, False if it needs copying some other way.
+
+    Raises:
+      PayloadError if something goes wrong.
+    """
+    if not self.use_copy_file_range:
+      return False
+    old_fd = _FileDescriptor(old_part_file)
+    new_fd = _FileDescriptor(new_part_file)
+    if old_fd is None or new_fd is None:
+      return False
+
+    # Make sure buffered writes do not land on top of the copied data later.
+    new_part_file.flush()
+    try:
+      for src_offset, dst_offset, length in _ExtentPairIter(
+          op.src_extents, op.dst_extents, self.block_size,
+          '%s.dst_extents' % op_name):
+        while length:
+          # pylint: disable=no-member
+          copied = os.copy_file_range(old_fd, new_fd, length, src_offset,
+                                      dst_offset)
+          if not copied:
+            raise PayloadError(
+                '%s: source partition (%s) ends before offset %d' %
+                (op_name, old_part_file.name, src_offset))
+          src_offset += copied
+          dst_offset += copied
+          length -= copied
+    except OSError as e:
+      if e.errno not in _COPY_FILE_RANGE_UNSUPPORTED_ERRNOS:
+        raise
+      self.use_copy_file_range = False
+      return False
+
+    return True
 
   def _ApplySourceCopyOperation(self, op, op_name, old_part_file,
                                 new_part_file):
@@ -330,13 +1323,21 @@ class PayloadApplier(object):
           (op_name, op.type))
 
     block_size = self.block_size
+    in_length = self._BytesInExtents(op.src_extents,
+                                     '%s.src_extents' % op_name)
+
+    if self._CopyExtentsInKernel(op, op_name, old_part_file, new_part_file):
+      self._AddStat(STAT_SOURCE_COPY_KERNEL_BYTES, in_length)
+      return
 
     # Gather input raw data from src extents.
-    in_data = _ReadExtents(old_part_file, op.src_extents, block_size)
+    in_data = _ReadExtents(old_part_file, op.src_extents, block_size,
+                           buf=self._IoBuffer(in_length))
 
     # Dump extracted data to dst extents.
     _WriteExtents(new_part_file, in_data, op.dst_extents, block_size,
                   '%s.dst_extents' % op_name)
+    self._AddStat(STAT_SOURCE_COPY_USERSPACE_BYTES, in_length)
 
   def _BytesInExtents(self, extents, base_name):
     """Counts the length of extents in bytes.
@@ -355,6 +1356,80 @@ class PayloadApplier(object):
       length += ex.num_blocks * self.block_size
     return length
 
+  def _VerifySourceOperation(self, op, op_name, old_part_file):
+    """Verifies the source data of an operation against its source hash.
+
+    Args:
+      op: the operation object
+      op_name: name string for error reporting
+      old_part_file: the source partition file object
+
+    Raises:
+      PayloadError if the source data is not as expected.
+    """
+    length = sum(ex.num_blocks for ex in op.src_extents) * self.block_size
+    data = _ReadExtents(old_part_file, op.src_extents, self.block_size,
+                        buf=self._IoBuffer(length))
+    actual_hash = hashlib.sha256(data).digest()
+    if actual_hash != op.src_sha256_hash:
+      raise PayloadError('%s: source hash (%s) not as expected (%s)' %
+                         (op_name, common.FormatSha256(actual_hash),
+                          common.FormatSha256(op.src_sha256_hash)))
+
+  def _PatchInProcess(self, op, patch_data):
+    """Returns whether a diff operation is to be applied in-process.
+
+    Args:
+      op: the operation object
+      patch_data: the binary patch content
+    """
+    if op.type not in (common.OpType.SOURCE_BSDIFF,
+                       common.OpType.BROTLI_BSDIFF):
+      return False
+    if self.patch_backend == _PATCH_BACKEND_AUTO:
+      return bspatch.CanPatch(patch_data)
+    return self.patch_backend == _PATCH_BACKEND_PYTHON
+
+  def _ApplyBsdiffInProcess(self, op, op_name, patch_data, old_part_file,
+                            new_part_file):
+    """Applies a SOURCE_BSDIFF or BROTLI_BSDIFF operation in-process.
+
+    Args:
+      op: the operation object
+      op_name: name string for error reporting
+      patch_data: the binary patch content
+      old_part_file: the source partition file object
+      new_part_file: the target partition file object
+
+    Raises:
+      PayloadError if something goes wrong.
+    """
+    block_size = self.block_size
+    in_length = (op.src_length if op.src_length else
+                 self._BytesInExtents(op.src_extents,
+                                      '%s.src_extents' % op_name))
+    in_data = _ReadExtents(old_part_file, op.src_extents, block_size,
+                           max_length=in_length,
+                           buf=self._IoBuffer(in_length))
+    try:
+      out_data = bspatch.Patch(in_data, patch_data)
+    except PayloadError as e:
+      raise PayloadError('%s: %s' % (op_name, e))
+
+    out_length = (op.dst_length if op.dst_length else
+                  self._BytesInExtents(op.dst_extents,
+                                       '%s.dst_extents' % op_name))
+    if len(out_data) != out_length:
+      raise PayloadError(
+          '%s: actual patched data length (%d) not as expected (%d)' %
+          (op_name, len(out_data), out_length))
+
+    # Write output back to partition, with padding.
+    out_data.extend(b'\0' * (-out_length % block_size))
+    _WriteExtents(new_part_file, out_data, op.dst_extents, block_size,
+                  '%s.dst_extents' % op_name)
+    self._AddStat(STAT_PATCH_IN_PROCESS_OPS, 1)
+
   def _ApplyDiffOperation(self, op, op_name, patch_data, old_part_file,
                           new_part_file):
     """Applies a SOURCE_BSDIFF, BROTLI_BSDIFF or PUFFDIFF operation.
@@ -374,12 +1449,18 @@ class PayloadApplier(object):
           '%s: no source partition file provided for operation type (%d)' %
           (op_name, op.type))
 
+    if self._PatchInProcess(op, patch_data):
+      self._ApplyBsdiffInProcess(op, op_name, patch_data, old_part_file,
+                                 new_part_file)
+      return
+
     block_size = self.block_size
 
-    # Dump patch data to file.
-    with tempfile.NamedTemporaryFile(delete=False) as patch_file:
-      patch_file_name = patch_file.name
-      patch_file.write(patch_data)
+    # Hand the patch data to the tool in an anonymous file. The tools take a
+    # single patch per run, so there is no way around running them per
+    # operation.
+    patch_file, patch_file_name = _OpenToolFile(patch_data)
+    self._AddStat(STAT_PATCH_TOOL_RUNS, 1)
 
     if (hasattr(new_part_file, 'fileno') and
         ((not old_part_file) or hasattr(old_part_file, 'fileno'))):
@@ -429,25 +1510,23 @@ class PayloadApplier(object):
         new_part_file.seek(pad_off)
         new_part_file.write(b'\0' * pad_len)
     else:
-      # Gather input raw data and write to a temp file.
+      # Gather input raw data and hand it to the tool in an anonymous file.
       input_part_file = old_part_file if old_part_file else new_part_file
+      in_length = (op.src_length if op.src_length else
+                   self._BytesInExtents(op.src_extents, "%s.src_extents"))
       in_data = _ReadExtents(input_part_file, op.src_extents, block_size,
-                             max_length=op.src_length if op.src_length else
-                             self._BytesInExtents(op.src_extents,
-                                                  "%s.src_extents"))
-      with tempfile.NamedTemporaryFile(delete=False) as in_file:
-        in_file_name = in_file.name
-        in_file.write(in_data)
+                             max_length=in_length,
+                             buf=self._IoBuffer(in_length))
+      in_file, in_file_name = _OpenToolFile(in_data)
 
-      # Allocate temporary output file.
-      with tempfile.NamedTemporaryFile(delete=False) as out_file:
-        out_file_name = out_file.name
+      # Allocate anonymous output file.
+      out_file, out_file_name = _OpenToolFile()
 
       if op.type in (common.OpType.SOURCE_BSDIFF, common.OpType.BROTLI_BSDIFF):
         # Invoke bspatch.
         bspatch_cmd = [self.bspatch_path, in_file_name, out_file_name,
                        patch_file_name]
-        subprocess.check_call(bspatch_cmd)
+        subprocess.check_call(bspatch_cmd, close_fds=False)
       elif op.type == common.OpType.PUFFDIFF:
         # Invoke puffpatch.
         puffpatch_cmd = [self.puffpatch_path,
@@ -455,34 +1534,143 @@ class PayloadApplier(object):
                          "--src_file=%s" % in_file_name,
                          "--dst_file=%s" % out_file_name,
                          "--patch_file=%s" % patch_file_name]
-        subprocess.check_call(puffpatch_cmd)
+        subprocess.check_call(puffpatch_cmd, close_fds=False)
       else:
         raise PayloadError("Unknown operation %s" % op.type)
 
       # Read output.
-      with open(out_file_name, 'rb') as out_file:
-        out_data = out_file.read()
-        if len(out_data) != op.dst_length:
-          raise PayloadError(
-              '%s: actual patched data length (%d) not as expected (%d)' %
-              (op_name, len(out_data), op.dst_length))
+      out_len = os.fstat(out_file.fileno()).st_size
+      if out_len != op.dst_length:
+        raise PayloadError(
+            '%s: actual patched data length (%d) not as expected (%d)' %
+            (op_name, out_len, op.dst_length))
+
+      # Read into a buffer already padded to a block boundary.
+      out_data = bytearray(-(-out_len // block_size) * block_size)
+      _ReadAt(out_file, memoryview(out_data)[:out_len], 0)
 
       # Write output back to partition, with padding.
-      unaligned_out_len = len(out_data) % block_size
-      if unaligned_out_len:
-        out_data += b'\0' * (block_size - unaligned_out_len)
       _WriteExtents(new_part_file, out_data, op.dst_extents, block_size,
                     '%s.dst_extents' % op_name)
 
-      # Delete input/output files.
-      os.remove(in_file_name)
-      os.remove(out_file_name)
+      # Release input/output files.
+      in_file.close()
+      out_file.close()
 
-    # Delete patch file.
-    os.remove(patch_file_name)
+    # Release patch file.
+    patch_file.close()
+
+  def _ApplyReplaceOperationsConcurrently(self, operations, base_name,
+                                         new_part_file, part_size,
+                                         start_op=0, progress=None):
+    """Applies REPLACE*, ZERO and DISCARD operations, decompressing in parallel.
+
+    Data blobs are read in order and decompressed on a pool of worker
+    processes. Results are written as soon as they are available, except that
+    an operation is held back until every preceding operation writing to any
+    of the same blocks has been written. The number of operations in flight
+    is bounded to keep memory usage in check.
+
+    Args:
+      operations: the sequence of operations
+      base_name: the name of the operation sequence
+      new_part_file: the new partition file object, open for reading/writing
+      part_size: the partition size
+      start_op: the index of the first operation to apply (optional)
+      progress: a _PartitionProgress to report applied operations to
+                (optional)
+
+    Raises:
+      PayloadError if anything goes wrong while processing the payload.
+    """
+    ops = list(common.OperationIter(operations, base_name))
+    deps = _DstOverlapDependencies(operations)
+    max_in_flight = self.decompress_workers * 4
+    completed = queue.Queue()
+    written = set(range(start_op))
+    held_back = {}
+    # The cache keys of decompressed data to add to the blob cache.
+    blob_hashes = {}
+
+    def _Write(idx, out_data):
+      op, op_name = ops[idx]
+      if op.type in (common.OpType.ZERO, common.OpType.DISCARD):
+        self._ApplyZeroOperation(op, op_name, new_part_file)
+      else:
+        self._WriteReplaceData(op, op_name, (out_data,), new_part_file,
+                               part_size)
+      written.add(idx)
+      if progress:
+        progress.OperationApplied(idx, op)
+
+    def _WriteNextCompleted():
+      idx, (out_data, err) = completed.get()
+      if err is not None:
+        raise PayloadError('%s: failed to decompress data: %s' %
+                           (ops[idx][1], err))
+      if idx in blob_hashes:
+        self.payload.blob_cache.PutDecompressed(blob_hashes.pop(idx),
+                                                out_data)
+      held_back[idx] = out_data
+      # Write whatever has no pending dependency left, which may in turn
+      # release operations that were held back.
+      released = True
+      while released:
+        released = False
+        for ready_idx in sorted(held_back):
+          if deps[ready_idx] <= written:
+            _Write(ready_idx, held_back.pop(ready_idx))
+            released = True
+
+    worker_pool = multiprocessing.Pool(processes=self.decompress_workers)
+    try:
+      for idx, (op, _) in enumerate(ops[start_op:], start_op):
+        if op.type in (common.OpType.ZERO, common.OpType.DISCARD):
+          completed.put((idx, (None, None)))
+        else:
+          data = self.payload.ReadDataBlob(op.data_offset, op.data_length)
+          blob_hash = self._DecompressedCacheKey(op, data)
+          out_data = (blob_hash and
+                      self.payload.blob_cache.GetDecompressed(blob_hash))
+          if out_data is not None:
+            completed.put((idx, (out_data, None)))
+          else:
+            if blob_hash:
+              blob_hashes[idx] = blob_hash
+            # Failing to run the task at all, e.g. for a worker dying, must
+            # not leave the operation pending forever.
+            worker_pool.apply_async(
+                _DecompressBlob, (op.type, bytes(data)),
+                callback=lambda result, idx=idx: completed.put((idx, result)),
+                error_callback=lambda e, idx=idx: completed.put(
+                    (idx, (None, repr(e)))))
+
+        while idx + 1 - len(written) >= max_in_flight:
+          _WriteNextCompleted()
+
+      while len(written) < len(ops):
+        _WriteNextCompleted()
+    finally:
+      worker_pool.terminate()
+      worker_pool.join()
+
+  def _CanDecompressConcurrently(self, operations, old_part_file):
+    """Returns whether a partition's data can be decompressed in parallel.
+
+    Args:
+      operations: the sequence of operations
+      old_part_file: the old partition file object, if any
+    """
+    return (self.decompress_workers > 1 and not old_part_file and
+            all(op.type in (common.OpType.REPLACE, common.OpType.REPLACE_BZ,
+                            common.OpType.REPLACE_XZ, common.OpType.ZERO,
+                            common.OpType.DISCARD)
+                for op in operations))
 
   def _ApplyOperations(self, operations, base_name, old_part_file,
-                       new_part_file, part_size):
+                       new_part_file, part_size, start_op=0, progress=None,
+                       hasher=None, source_verifier=None,
+                       verify_source_ops=False):
     """Applies a sequence of update operations to a partition.
 
     Args:
@@ -491,19 +1679,48 @@ class PayloadApplier(object):
       old_part_file: the old partition file object, open for reading/writing
       new_part_file: the new partition file object, open for reading/writing
       part_size: the partition size
+      start_op: the index of the first operation to apply (optional)
+      progress: a _PartitionProgress to report applied operations to
+                (optional)
+      hasher: a _WriteHasher to pass the written data through, for
+              operations writing the partition in order (optional; not
+              supported with concurrent decompression)
+      source_verifier: a _BackgroundVerifier of the source partition, to
+                       stop applying as soon as it fails (optional)
+      verify_source_ops: whether to verify the source data of each
+                         operation against its source hash (optional)
 
     Raises:
       PayloadError if anything goes wrong while processing the payload.
     """
-    for op, op_name in common.OperationIter(operations, base_name):
+    if self._CanDecompressConcurrently(operations, old_part_file):
+      assert not hasher, 'cannot hash data decompressed concurrently'
+      self._ApplyReplaceOperationsConcurrently(operations, base_name,
+                                               new_part_file, part_size,
+                                               start_op=start_op,
+                                               progress=progress)
+      return
+
+    for idx, (op, op_name) in enumerate(
+        common.OperationIter(operations, base_name)):
+      # Skip operations applied before resuming.
+      if idx < start_op:
+        continue
+
+      if source_verifier:
+        source_verifier.Check()
+      if verify_source_ops and op.src_extents:
+        self._VerifySourceOperation(op, op_name, old_part_file)
+
       # Read data blob.
       data = self.payload.ReadDataBlob(op.data_offset, op.data_length)
 
       if op.type in (common.OpType.REPLACE, common.OpType.REPLACE_BZ,
                      common.OpType.REPLACE_XZ):
-        self._ApplyReplaceOperation(op, op_name, data, new_part_file, part_size)
-      elif op.type == common.OpType.ZERO:
-        self._ApplyZeroOperation(op, op_name, new_part_file)
+        self._ApplyReplaceOperation(op, op_name, data, new_part_file, part_size,
+                                    hasher=hasher)
+      elif op.type in (common.OpType.ZERO, common.OpType.DISCARD):
+        self._ApplyZeroOperation(op, op_name, new_part_file, hasher=hasher)
       elif op.type == common.OpType.SOURCE_COPY:
         self._ApplySourceCopyOperation(op, op_name, old_part_file,
                                        new_part_file)
@@ -515,6 +1732,21 @@ class PayloadApplier(object):
         raise PayloadError('%s: unknown operation type (%d)' %
                            (op_name, op.type))
 
+      if progress:
+        progress.OperationApplied(idx, op)
+
+  def _RollBackPartition(self, part_name, new_part_file_name):
+    """Discards what was applied to a partition.
+
+    Args:
+      part_name: the name of the partition
+      new_part_file_name: file name partition data was written to
+    """
+    if os.path.isfile(new_part_file_name):
+      open(new_part_file_name, 'w').close()
+    if self.journal:
+      self.journal.Record(part_name, new_part_file_name, 0)
+
   def _ApplyToPartition(self, operations, part_name, base_name,
                         new_part_file_name, new_part_info,
                         old_part_file_name=None, old_part_info=None):
@@ -524,7 +1756,10 @@ class PayloadApplier(object):
       operations: the sequence of update operations to apply
       part_name: the name of the partition, for error reporting
       base_name: the name of the operation sequence
-      new_part_file_name: file name to write partition data to
+      new_part_file_name: file name to write partition data to, which may be
+        a block device large enough to hold the partition, e.g. the target
+        slot of an A/B update; block devices are written in place and not
+        truncated
       new_part_info: size and expected hash of dest partition
       old_part_file_name: file name of source partition (optional)
       old_part_info: size and expected hash of source partition (optional)
@@ -532,41 +1767,221 @@ class PayloadApplier(object):
     Raises:
       PayloadError if anything goes wrong with the update.
     """
+    # Check that a block device fits the partition before writing anything.
+    block_device_size = _BlockDeviceSize(new_part_file_name)
+    if (block_device_size is not None and
+        block_device_size < new_part_info.size):
+      raise PayloadError(
+          '%s: block device %s too small (%d bytes) for new partition '
+          '(%d bytes)' % (part_name, new_part_file_name, block_device_size,
+                          new_part_info.size))
+
+    start_op = 0
+    if self.journal:
+      start_op = self.journal.NextOperation(part_name, new_part_file_name,
+                                            len(operations))
+
     # Do we have a source partition?
+    source_verifier = None
+    verify_source_ops = False
     if old_part_file_name:
-      # Verify the source partition.
-      with open(old_part_file_name, 'rb') as old_part_file:
-        _VerifySha256(old_part_file, old_part_info.hash,
-                      'old ' + part_name, length=old_part_info.size)
+      # Verify the source partition, or arrange for it to be verified.
+      source_verification = self.source_verification
+      if (source_verification == _SOURCE_VERIFY_OPERATIONS and
+          not all(op.HasField('src_sha256_hash')
+                  for op in operations if op.src_extents)):
+        source_verification = _SOURCE_VERIFY_BEFORE
+      if source_verification == _SOURCE_VERIFY_BEFORE:
+        with open(old_part_file_name, 'rb') as old_part_file:
+          _VerifySha256(old_part_file, old_part_info.hash,
+                        'old ' + part_name, length=old_part_info.size)
+      elif source_verification == _SOURCE_VERIFY_CONCURRENT:
+        source_verifier = _BackgroundVerifier(
+            old_part_file_name, old_part_info.hash, 'old ' + part_name,
+            old_part_info.size)
+      else:
+        verify_source_ops = True
+      new_part_file_mode = 'r+b'
+      if not start_op and block_device_size is None:
+        open(new_part_file_name, 'w').close()
+
+    elif start_op or block_device_size is not None:
+      # Keep what was written before resuming, or the block device as is.
       new_part_file_mode = 'r+b'
-      open(new_part_file_name, 'w').close()
 
     else:
       # We need to create/truncate the dst partition file.
       new_part_file_mode = 'w+b'
 
     # Apply operations.
-    with open(new_part_file_name, new_part_file_mode) as new_part_file:
-      old_part_file = (open(old_part_file_name, 'r+b')
-                       if old_part_file_name else None)
-      try:
-        self._ApplyOperations(operations, base_name, old_part_file,
-                              new_part_file, new_part_info.size)
-      finally:
-        if old_part_file:
-          old_part_file.close()
-
-      # Truncate the result, if so instructed.
-      if self.truncate_to_expected_size:
-        new_part_file.seek(0, 2)
-        if new_part_file.tell() > new_part_info.size:
-          new_part_file.seek(new_part_info.size)
-          new_part_file.truncate()
+    try:
+      with open(new_part_file_name, new_part_file_mode) as new_part_file:
+        old_part_file = (open(old_part_file_name, 'r+b')
+                         if old_part_file_name else None)
+        progress = (_PartitionProgress(self.journal, part_name,
+                                       new_part_file_name, new_part_file,
+                                       self.block_size, start_op)
+                    if self.journal else None)
+        # Hash the data as it is written if it is written front to back,
+        # saving a pass over the whole partition afterwards.
+        hasher = None
+        if (not start_op and
+            not self._CanDecompressConcurrently(operations, old_part_file) and
+            _IsWrittenInOrder(operations, self.block_size,
+                              new_part_info.size)):
+          hasher = _WriteHasher(new_part_info.size)
+        applied = False
+        try:
+          self._ApplyOperations(operations, base_name, old_part_file,
+                                new_part_file, new_part_info.size,
+                                start_op=start_op, progress=progress,
+                                hasher=hasher,
+                                source_verifier=source_verifier,
+                                verify_source_ops=verify_source_ops)
+          applied = True
+        finally:
+          if old_part_file:
+            old_part_file.close()
+          # Record whatever got applied, even if applying failed midway,
+          # unless the failure is down to a bad source partition, which
+          # makes what was applied garbage.
+          if not applied and source_verifier:
+            source_verifier.Join()
+          if progress and not (source_verifier and source_verifier.error):
+            progress.Checkpoint()
+
+        # Truncate the result, if so instructed, or make sure it reached the
+        # block device before it is verified.
+        if block_device_size is not None:
+          new_part_file.flush()
+          os.fsync(new_part_file.fileno())
+        elif self.truncate_to_expected_size:
+          new_part_file.seek(0, 2)
+          if new_part_file.tell() > new_part_info.size:
+            new_part_file.seek(new_part_info.size)
+            new_part_file.truncate()
+
+      if source_verifier:
+        source_verifier.Wait()
+    except Exception:  # pylint: disable=broad-except
+      # Whatever was applied from a bad source partition is garbage, so roll
+      # it back rather than leave it to be mistaken for progress. Errors
+      # applying it, e.g. of an external patch tool, are down to the bad
+      # source too.
+      if source_verifier:
+        source_verifier.Join()
+        if source_verifier.error:
+          self._RollBackPartition(part_name, new_part_file_name)
+          raise source_verifier.error
+      raise
 
     # Verify the resulting partition.
-    with open(new_part_file_name, 'rb') as new_part_file:
-      _VerifySha256(new_part_file, new_part_info.hash,
-                    'new ' + part_name, length=new_part_info.size)
+    new_part_hash = hasher and hasher.Digest()
+    if new_part_hash is not None:
+      if new_part_hash != new_part_info.hash:
+        raise PayloadError(
+            'new %s hash (%s) not as expected (%s)' %
+            (part_name, common.FormatSha256(new_part_hash),
+             common.FormatSha256(new_part_info.hash)))
+      self._AddStat(STAT_VERIFIED_WHILE_WRITING_BYTES, new_part_info.size)
+    else:
+      with open(new_part_file_name, 'rb') as new_part_file:
+        _VerifySha256(new_part_file, new_part_info.hash,
+                      'new ' + part_name, length=new_part_info.size)
+      self._AddStat(STAT_VERIFIED_BY_READING_BYTES, new_part_info.size)
+
+  def ApplyPartition(self, part_name, new_part_file_name,
+                     old_part_file_name=None):
+    """Applies the update operations of a single partition.
+
+    Args:
+      part_name: the name of the partition, as found in the manifest
+      new_part_file_name: file name to write partition data to
+      old_part_file_name: file name of source partition (optional)
+
+    Raises:
+      PayloadError if the partition is unknown or the update failed.
+    """
+    part = next((p for p in self.payload.manifest.partitions
+                 if p.partition_name == part_name), None)
+    if part is None:
+      raise PayloadError('unknown partition (%s)' % part_name)
+
+    self._ApplyToPartition(
+        part.operations, part_name, '%s_install_operations' % part_name,
+        new_part_file_name, part.new_partition_info, old_part_file_name,
+        part.old_partition_info)
+
+  def _ApplyPartitionsConcurrently(self, part_names, new_parts, old_parts):
+    """Applies a number of partitions using a pool of workers.
+
+    Partitions are independent of each other, so they are all dispatched at
+    once; errors are collected for every partition before reporting.
+
+    Args:
+      part_names: the names of the partitions to apply
+      new_parts: map of partition name to dest partition file
+      old_parts: map of partition name to source partition file
+
+    Raises:
+      PayloadError listing every partition that failed to apply.
+    """
+    num_workers = min(self.part_workers, len(part_names))
+    if self.part_worker_type == _WORKER_PROCESS:
+      payload_file_name = getattr(self.payload.payload_file, 'name', None)
+      if not (isinstance(payload_file_name, str) and
+              os.path.isfile(payload_file_name)):
+        raise PayloadError('applying partitions in worker processes requires '
+                           'a payload backed by a named file')
+      if self.journal:
+        raise PayloadError('journaling is not supported with partition '
+                           'worker processes')
+      applier_args = {
+          'bsdiff_in_place': self.bsdiff_in_place,
+          'bspatch_path': self.bspatch_path,
+          'puffpatch_path': self.puffpatch_path,
+          'truncate_to_expected_size': self.truncate_to_expected_size,
+          'decompress_buffer_size': self.decompress_buffer_size,
+          'use_copy_file_range': self.use_copy_file_range,
+          'patch_backend': self.patch_backend,
+          'source_verification': self.source_verification,
+      }
+      # Worker processes reopen the payload without its blob cache, whose
+      # index is not shared between processes.
+      worker_pool = multiprocessing.Pool(processes=num_workers)
+      work_func = _ApplyPartitionInProcess
+      work_args = [
+          ((type(self.payload), payload_file_name,
+            self.payload.payload_file_offset,
+            getattr(self.payload, 'use_mmap', False), applier_args, name,
+            new_parts[name], old_parts.get(name, None)),)
+          for name in part_names]
+    else:
+      worker_pool = multiprocessing_pool.ThreadPool(processes=num_workers)
+      work_func = self.ApplyPartition
+      work_args = [(name, new_parts[name], old_parts.get(name, None))
+                   for name in part_names]
+
+    errors = []
+    try:
+      results = [(name, worker_pool.apply_async(work_func, args))
+                 for name, args in zip(part_names, work_args)]
+      for name, result in results:
+        try:
+          worker_stats = result.get()
+        except Exception as e:  # pylint: disable=broad-except
+          errors.append('%s: %s' % (name, e))
+          continue
+        # Counters of worker processes need merging into ours.
+        for stat_name, value in (worker_stats or {}).items():
+          self._AddStat(stat_name, value)
+    finally:
+      worker_pool.close()
+      worker_pool.join()
+
+    if errors:
+      raise PayloadError('failed to apply %d partition(s): %s' %
+                         (len(errors), '; '.join(errors)))
 
   def Run(self, new_parts, old_parts=None):
     """Applier entry point, invoking all update operations.
@@ -575,6 +1990,10 @@ class PayloadApplier(object):
       new_parts: map of partition name to dest partition file
       old_parts: map of partition name to source partition file (optional)
 
+    Returns:
+      A dictionary of counters collected while applying, e.g. the number of
+      SOURCE_COPY bytes copied by the kernel vs in userspace.
+
     Raises:
       PayloadError if payload application failed.
     """
@@ -614,8 +2033,15 @@ class PayloadApplier(object):
     else:
       raise PayloadError('not all src partitions provided')
 
+    if self.part_workers > 1 and len(install_operations) > 1:
+      self._ApplyPartitionsConcurrently(
+          [name for name, _ in install_operations], new_parts, old_parts)
+      return dict(self.stats)
+
     for name, operations in install_operations:
       # Apply update to partition.
       self._ApplyToPartition(
           operations, name, '%s_install_operations' % name, new_parts[name],
           new_part_info[name], old_parts.get(name, None), old_part_info[name])
+
+    return dict(self.stats)
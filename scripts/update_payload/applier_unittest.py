@@ -0,0 +1,1048 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Unit testing applier.py."""
+
+# Disable check for function names to avoid errors based on old code
+# pylint: disable-msg=invalid-name
+
+from __future__ import absolute_import
+
+import bz2
+import errno
+import hashlib
+import io
+import json
+import lzma
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import mock  # pylint: disable=import-error
+from six.moves.urllib import request as urllib_request
+
+from update_payload import applier
+from update_payload import blob_cache as blob_cache_lib
+from update_payload import common
+from update_payload import payload as payload_lib
+from update_payload import test_utils
+from update_payload import update_metadata_pb2
+from update_payload.error import PayloadError
+from update_payload.payload import Payload
+from update_payload.payload import StreamingPayload
+
+
+_BLOCK_SIZE = 4096
+
+# A stand-in for bspatch, applying patches between byte extents in-process.
+_FAKE_BSPATCH = """
+import sys
+sys.path.insert(0, %r)
+from update_payload import bspatch
+
+def _Extents(arg):
+  return [[int(num) for num in ex.split(':')] for ex in arg.split(',')]
+
+old_file_name, new_file_name, patch_file_name, in_arg, out_arg = sys.argv[1:]
+with open(old_file_name, 'rb') as old_file:
+  old_data = b''
+  for offset, length in _Extents(in_arg):
+    old_file.seek(offset)
+    old_data += old_file.read(length)
+with open(patch_file_name, 'rb') as patch_file:
+  new_data = bspatch.Patch(old_data, patch_file.read())
+with open(new_file_name, 'r+b') as new_file:
+  for offset, length in _Extents(out_arg):
+    new_file.seek(offset)
+    new_file.write(new_data[:length])
+    new_data = new_data[length:]
+"""
+
+
+def _PartData(seed, num_blocks):
+  """Returns deterministic, block-aligned partition content."""
+  pattern = hashlib.sha256(seed.encode('utf-8')).digest()
+  return (pattern * (num_blocks * _BLOCK_SIZE // len(pattern) + 1))[
+      :num_blocks * _BLOCK_SIZE]
+
+
+class PayloadApplierTest(unittest.TestCase):
+  """Tests the PayloadApplier class."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    # Kernel gets a plain REPLACE, root a REPLACE_BZ followed by a ZERO.
+    self.new_data = {
+        'kernel': _PartData('kernel', 4),
+        'root': _PartData('root', 6) + b'\0' * (2 * _BLOCK_SIZE),
+    }
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _WritePayload(self, corrupt_parts=(), extra_root_ops=()):
+    """Writes a full payload for self.new_data and returns its file name.
+
+    Args:
+      corrupt_parts: names of partitions whose expected hash is bogus
+      extra_root_ops: (type, dst_extents, data_blob) tuples of operations to
+                      append to the root partition
+    """
+    payload_gen = test_utils.EnhancedPayloadGenerator()
+    payload_gen.SetBlockSize(_BLOCK_SIZE)
+    payload_gen.SetMinorVersion(0)
+    for name, data in sorted(self.new_data.items()):
+      part_hash = hashlib.sha256(data).digest()
+      if name in corrupt_parts:
+        part_hash = hashlib.sha256(part_hash).digest()
+      payload_gen.SetPartInfo(name, True, len(data), part_hash)
+
+    kernel_data = self.new_data['kernel']
+    payload_gen.AddOperationWithData(
+        'kernel', common.OpType.REPLACE, dst_extents=[(0, 4)],
+        data_blob=kernel_data)
+    payload_gen.AddOperationWithData(
+        'root', common.OpType.REPLACE_BZ, dst_extents=[(0, 6)],
+        data_blob=bz2.compress(self.new_data['root'][:6 * _BLOCK_SIZE]))
+    payload_gen.AddOperationWithData(
+        'root', common.OpType.ZERO, dst_extents=[(6, 2)])
+    for op_type, dst_extents, data_blob in extra_root_ops:
+      payload_gen.AddOperationWithData(
+          'root', op_type, dst_extents=dst_extents, data_blob=data_blob)
+
+    payload_file_name = os.path.join(self.test_dir, 'payload.bin')
+    with open(payload_file_name, 'wb') as payload_file:
+      payload_gen.WriteToFileWithData(payload_file)
+    return payload_file_name
+
+  def _WriteDeltaPayload(self, bsdiff=False, src_hashes=True):
+    """Writes a delta payload for self.new_data.
+
+    Args:
+      bsdiff: whether the last root operation is a SOURCE_BSDIFF rather than
+              a REPLACE
+      src_hashes: whether operations carry the hash of their source data
+
+    Returns:
+      A pair consisting of the payload file name and the map of source
+      partition file names.
+    """
+    old_data = {
+        'kernel': _PartData('old kernel', 4),
+        'root': _PartData('old root', 8),
+    }
+    self.new_data['kernel'] = (old_data['kernel'][2 * _BLOCK_SIZE:] +
+                               old_data['kernel'][:2 * _BLOCK_SIZE])
+    self.new_data['root'] = (old_data['root'][4 * _BLOCK_SIZE:] +
+                             self.new_data['root'][4 * _BLOCK_SIZE:])
+
+    payload_gen = test_utils.EnhancedPayloadGenerator()
+    payload_gen.SetBlockSize(_BLOCK_SIZE)
+    payload_gen.SetMinorVersion(2)
+    old_parts = {}
+    for name in sorted(self.new_data):
+      payload_gen.SetPartInfo(name, False, len(old_data[name]),
+                              hashlib.sha256(old_data[name]).digest())
+      payload_gen.SetPartInfo(name, True, len(self.new_data[name]),
+                              hashlib.sha256(self.new_data[name]).digest())
+      old_parts[name] = os.path.join(self.test_dir, name + '.old.img')
+      with open(old_parts[name], 'wb') as old_part_file:
+        old_part_file.write(old_data[name])
+
+    def _SrcHash(name, src_extents):
+      if not src_hashes:
+        return None
+      return hashlib.sha256(b''.join(
+          old_data[name][start * _BLOCK_SIZE:(start + num) * _BLOCK_SIZE]
+          for start, num in src_extents)).digest()
+
+    payload_gen.AddOperationWithData(
+        'kernel', common.OpType.SOURCE_COPY, src_extents=[(2, 2), (0, 2)],
+        dst_extents=[(0, 4)],
+        src_sha256_hash=_SrcHash('kernel', [(2, 2), (0, 2)]))
+    payload_gen.AddOperationWithData(
+        'root', common.OpType.SOURCE_COPY, src_extents=[(4, 4)],
+        dst_extents=[(0, 3), (3, 1)],
+        src_sha256_hash=_SrcHash('root', [(4, 4)]))
+    if bsdiff:
+      # The end of the last block is left for padding.
+      dst_length = 4 * _BLOCK_SIZE - 100
+      payload_gen.AddOperationWithData(
+          'root', common.OpType.SOURCE_BSDIFF, src_extents=[(1, 1), (0, 3)],
+          src_length=4 * _BLOCK_SIZE - 10, dst_extents=[(4, 2), (6, 2)],
+          dst_length=dst_length,
+          data_blob=test_utils.MakeBsdiffPatch(
+              old_data['root'][_BLOCK_SIZE:2 * _BLOCK_SIZE] +
+              old_data['root'][:3 * _BLOCK_SIZE - 10],
+              self.new_data['root'][4 * _BLOCK_SIZE:][:dst_length],
+              compressors=(1, 1, 1)),
+          src_sha256_hash=_SrcHash('root', [(1, 1), (0, 3)]))
+    else:
+      payload_gen.AddOperationWithData(
+          'root', common.OpType.REPLACE, dst_extents=[(4, 4)],
+          data_blob=self.new_data['root'][4 * _BLOCK_SIZE:])
+
+    payload_file_name = os.path.join(self.test_dir, 'delta.bin')
+    with open(payload_file_name, 'wb') as payload_file:
+      payload_gen.WriteToFileWithData(payload_file)
+    return payload_file_name, old_parts
+
+  def _Apply(self, payload_file_name, old_parts=None, payload_file_offset=0,
+             use_mmap=False, blob_cache=None, **applier_dargs):
+    """Applies a payload, returning the map of dest partition file names."""
+    new_parts = dict((name, os.path.join(self.test_dir, name + '.img'))
+                     for name in self.new_data)
+    with open(payload_file_name, 'rb') as payload_file:
+      payload = Payload(payload_file, payload_file_offset=payload_file_offset,
+                        use_mmap=use_mmap, blob_cache=blob_cache)
+      payload.Init()
+      self.stats = applier.PayloadApplier(payload, **applier_dargs).Run(
+          new_parts, old_parts=old_parts)
+    return new_parts
+
+  def _AssertApplied(self, new_parts):
+    for name, file_name in new_parts.items():
+      with open(file_name, 'rb') as part_file:
+        self.assertEqual(self.new_data[name], part_file.read())
+
+  def testRun(self):
+    """Tests serially applying a full payload."""
+    self._AssertApplied(self._Apply(self._WritePayload()))
+
+  def testRunVerifyWhileWriting(self):
+    """Tests hashing partitions written front to back while applying."""
+    self._AssertApplied(self._Apply(self._WritePayload()))
+    self.assertEqual(12 * _BLOCK_SIZE,
+                     self.stats[applier.STAT_VERIFIED_WHILE_WRITING_BYTES])
+    self.assertNotIn(applier.STAT_VERIFIED_BY_READING_BYTES, self.stats)
+
+    with self.assertRaises(PayloadError) as cm:
+      self._Apply(self._WritePayload(corrupt_parts=('root',)))
+    self.assertIn('new root hash', str(cm.exception))
+
+    # Rewriting a block makes the root partition be verified afterwards.
+    extra_root_ops = [(common.OpType.REPLACE, [(0, 1)],
+                       self.new_data['root'][:_BLOCK_SIZE])]
+    self._AssertApplied(self._Apply(
+        self._WritePayload(extra_root_ops=extra_root_ops)))
+    self.assertEqual(4 * _BLOCK_SIZE,
+                     self.stats[applier.STAT_VERIFIED_WHILE_WRITING_BYTES])
+    self.assertEqual(8 * _BLOCK_SIZE,
+                     self.stats[applier.STAT_VERIFIED_BY_READING_BYTES])
+
+  def _WriteSignedPayload(self):
+    """Writes a signed full payload for self.new_data.
+
+    Returns:
+      A pair consisting of the payload file name and the offset of the data
+      section.
+    """
+    payload_gen = test_utils.EnhancedPayloadGenerator()
+    payload_gen.SetBlockSize(_BLOCK_SIZE)
+    payload_gen.SetMinorVersion(0)
+    for name, data in sorted(self.new_data.items()):
+      payload_gen.SetPartInfo(name, True, len(data),
+                              hashlib.sha256(data).digest())
+      payload_gen.AddOperationWithData(
+          name, common.OpType.REPLACE_BZ,
+          dst_extents=[(0, len(data) // _BLOCK_SIZE)],
+          data_blob=bz2.compress(data))
+
+    payload_file_name = os.path.join(self.test_dir, 'signed.bin')
+    with open(payload_file_name, 'wb') as payload_file:
+      payload_gen.WriteToFileWithData(
+          payload_file, privkey_file_name=test_utils._PRIVKEY_FILE_NAME)
+    with open(payload_file_name, 'rb') as payload_file:
+      payload = Payload(payload_file)
+      payload.Init()
+      return payload_file_name, payload.data_offset
+
+  def _VerifyAndApply(self, payload_file_name, **dargs):
+    """Checks and applies a payload in a single pass."""
+    new_parts = dict((name, os.path.join(self.test_dir, name + '.img'))
+                     for name in self.new_data)
+    with open(payload_file_name, 'rb') as payload_file:
+      payload = Payload(payload_file)
+      payload.Init()
+      self.stats = payload.VerifyAndApply(
+          new_parts, pubkey_file_name=test_utils._PUBKEY_FILE_NAME,
+          assert_type='full', **dargs)
+    return new_parts
+
+  def testVerifyAndApply(self):
+    """Tests verifying data blobs and the signature while applying."""
+    payload_file_name, data_offset = self._WriteSignedPayload()
+    self._AssertApplied(self._VerifyAndApply(payload_file_name))
+    with open(payload_file_name, 'rb') as payload_file:
+      payload = Payload(payload_file)
+      payload.Init()
+      sigs_offset = payload.manifest.signatures_offset
+    self.assertEqual(
+        sigs_offset,
+        self.stats[payload_lib.STAT_SIG_HASHED_WHILE_APPLYING_BYTES])
+    self.assertEqual(
+        0, self.stats[payload_lib.STAT_SIG_HASHED_BY_READING_BYTES])
+
+    # A corrupt blob fails before it gets applied.
+    with open(payload_file_name, 'r+b') as payload_file:
+      payload_file.seek(data_offset + sigs_offset - 1)
+      payload_file.write(b'\xff')
+    with self.assertRaises(PayloadError) as cm:
+      self._VerifyAndApply(payload_file_name)
+    self.assertIn('data_sha256_hash', str(cm.exception))
+    self.assertIn('root_install_operations[1]', str(cm.exception))
+
+  def testVerifyAndApplyErrors(self):
+    """Tests that applying partitions concurrently is rejected."""
+    payload_file_name, _ = self._WriteSignedPayload()
+    self.assertRaises(PayloadError, self._VerifyAndApply, payload_file_name,
+                      part_workers=2)
+
+  def testVerifyAndApplyStreaming(self):
+    """Tests applying a payload while downloading it."""
+    payload_file_name, _ = self._WriteSignedPayload()
+    with open(payload_file_name, 'rb') as payload_file:
+      payload_data = payload_file.read()
+    new_parts = dict((name, os.path.join(self.test_dir, name + '.img'))
+                     for name in self.new_data)
+
+    server = test_utils.PayloadHttpServer(payload_data)
+    try:
+      response = urllib_request.urlopen(server.url)
+      try:
+        payload = StreamingPayload(response)
+        payload.Init()
+        self.stats = payload.VerifyAndApply(
+            new_parts, pubkey_file_name=test_utils._PUBKEY_FILE_NAME,
+            assert_type='full',
+            payload_size=int(response.headers['Content-Length']))
+      finally:
+        response.close()
+    finally:
+      server.Stop()
+
+    self._AssertApplied(new_parts)
+    self.assertEqual(
+        0, self.stats[payload_lib.STAT_SIG_HASHED_BY_READING_BYTES])
+
+  def testVerifyAndApplyStreamingErrors(self):
+    """Tests that payload streams are only read forward."""
+    payload_file_name, _ = self._WriteSignedPayload()
+    with open(payload_file_name, 'rb') as payload_file:
+      payload_data = payload_file.read()
+    new_parts = dict((name, os.path.join(self.test_dir, name + '.img'))
+                     for name in self.new_data)
+
+    def _InitPayload():
+      payload = StreamingPayload(io.BytesIO(payload_data))
+      payload.Init()
+      return payload
+
+    payload = _InitPayload()
+    with self.assertRaises(PayloadError) as cm:
+      payload.VerifyAndApply(new_parts,
+                             pubkey_file_name=test_utils._PUBKEY_FILE_NAME)
+    self.assertIn('size must be given', str(cm.exception))
+
+    self.assertRaises(PayloadError, _InitPayload().Apply, new_parts,
+                      part_workers=2)
+
+    payload = _InitPayload()
+    kernel_op, root_op = [part.operations[0]
+                          for part in payload.manifest.partitions]
+    payload.ReadDataBlob(root_op.data_offset, root_op.data_length)
+    with self.assertRaises(PayloadError) as cm:
+      payload.ReadDataBlob(kernel_op.data_offset, kernel_op.data_length)
+    self.assertIn('already streamed past', str(cm.exception))
+
+    # Data is cut short.
+    payload = StreamingPayload(io.BytesIO(payload_data[:-1]))
+    payload.Init()
+    self.assertRaises(PayloadError, payload.VerifyAndApply, new_parts,
+                      pubkey_file_name=test_utils._PUBKEY_FILE_NAME,
+                      payload_size=len(payload_data))
+
+  def testDataVerifierOutOfOrder(self):
+    """Tests hashing the payload when blobs are read out of order."""
+    payload_file_name, _ = self._WriteSignedPayload()
+    with open(payload_file_name, 'rb') as payload_file:
+      payload = Payload(payload_file)
+      payload.Init()
+      kernel_op, root_op = [part.operations[0]
+                            for part in payload.manifest.partitions]
+      verifier = payload_lib._DataVerifier(payload)
+      payload._data_verifier = verifier
+      payload.ReadDataBlob(root_op.data_offset, root_op.data_length)
+      payload.ReadDataBlob(kernel_op.data_offset, kernel_op.data_length)
+
+      payload_hasher = payload.manifest_hasher.copy()
+      payload_hasher.update(payload.ReadDataBlob(
+          0, payload.manifest.signatures_offset))
+      self.assertEqual(payload_hasher.digest(), verifier.Digest())
+      self.assertEqual(
+          {payload_lib.STAT_SIG_HASHED_WHILE_APPLYING_BYTES:
+               root_op.data_length,
+           payload_lib.STAT_SIG_HASHED_BY_READING_BYTES:
+               kernel_op.data_length},
+          verifier.stats)
+
+  def testIsWrittenInOrder(self):
+    """Tests detecting operations writing a partition front to back."""
+    def _Ops(*op_extents):
+      return [update_metadata_pb2.InstallOperation(
+          type=common.OpType.REPLACE,
+          dst_extents=[update_metadata_pb2.Extent(
+              start_block=start, num_blocks=num) for start, num in extents])
+              for extents in op_extents]
+
+    self.assertTrue(applier._IsWrittenInOrder(
+        _Ops([(0, 2), (2, 1)], [(3, 1)]), _BLOCK_SIZE, 4 * _BLOCK_SIZE))
+    self.assertTrue(applier._IsWrittenInOrder(
+        _Ops([(0, 4)]), _BLOCK_SIZE, 4 * _BLOCK_SIZE - 1))
+    self.assertFalse(applier._IsWrittenInOrder(
+        _Ops([(0, 3)]), _BLOCK_SIZE, 4 * _BLOCK_SIZE))
+    self.assertFalse(applier._IsWrittenInOrder(
+        _Ops([(0, 2)], [(3, 1)]), _BLOCK_SIZE, 4 * _BLOCK_SIZE))
+    self.assertFalse(applier._IsWrittenInOrder(
+        _Ops([(2, 2)], [(0, 2)]), _BLOCK_SIZE, 4 * _BLOCK_SIZE))
+    ops = _Ops([(0, 4)])
+    ops[0].type = common.OpType.SOURCE_COPY
+    self.assertFalse(applier._IsWrittenInOrder(ops, _BLOCK_SIZE,
+                                               4 * _BLOCK_SIZE))
+
+  def testRunMmap(self):
+    """Tests applying a payload mapped into memory, at an offset."""
+    payload_file_name = self._WritePayload()
+    with open(payload_file_name, 'rb') as payload_file:
+      payload_data = payload_file.read()
+    embedded_file_name = os.path.join(self.test_dir, 'embedded.bin')
+    with open(embedded_file_name, 'wb') as embedded_file:
+      embedded_file.write(b'zip' * 1000 + payload_data)
+
+    for applier_dargs in ({}, {'decompress_workers': 2},
+                          {'part_workers': 2, 'part_worker_type': 'process'}):
+      self._AssertApplied(self._Apply(embedded_file_name,
+                                      payload_file_offset=3000,
+                                      use_mmap=True, **applier_dargs))
+
+    with open(embedded_file_name, 'rb') as embedded_file:
+      payload = Payload(embedded_file, payload_file_offset=3000,
+                        use_mmap=True)
+      payload.Init()
+      blob = payload.ReadDataBlob(0, 3)
+      self.assertIsInstance(blob, memoryview)
+      self.assertEqual(payload_data[payload.data_offset:][:3], blob)
+      self.assertRaises(PayloadError, payload.ReadDataBlob,
+                        len(payload_data) - payload.data_offset - 2, 3)
+
+    # Closing the payload unmaps the file; data is read from it from then on.
+    with open(embedded_file_name, 'rb') as embedded_file:
+      with Payload(embedded_file, payload_file_offset=3000,
+                   use_mmap=True) as payload:
+        payload.Init()
+        payload_mmap = payload._mmap
+        self.assertIsInstance(payload.ReadDataBlob(0, 3), memoryview)
+      self.assertTrue(payload_mmap.closed)
+      self.assertEqual(payload_data[payload.data_offset:][:3],
+                       payload.ReadDataBlob(0, 3))
+      self.assertIsInstance(payload.ReadDataBlob(0, 3), bytes)
+
+    # Files that cannot be mapped are read from instead.
+    payload = Payload(io.BytesIO(payload_data), use_mmap=True)
+    payload.Init()
+    self.assertEqual(payload_data[payload.data_offset:][:3],
+                     payload.ReadDataBlob(0, 3))
+    self.assertIsInstance(payload.ReadDataBlob(0, 3), bytes)
+
+  def testRunConcurrentThreads(self):
+    """Tests applying partitions on a pool of threads."""
+    self._AssertApplied(self._Apply(self._WritePayload(), part_workers=2))
+
+  def testRunConcurrentProcesses(self):
+    """Tests applying partitions on a pool of processes."""
+    self._AssertApplied(self._Apply(self._WritePayload(), part_workers=2,
+                                    part_worker_type='process'))
+
+  def testRunConcurrentAggregatesErrors(self):
+    """Tests that a failure is reported for every failing partition."""
+    payload_file_name = self._WritePayload(corrupt_parts=('kernel', 'root'))
+    for worker_type in applier.WORKER_TYPES:
+      with self.assertRaises(PayloadError) as cm:
+        self._Apply(payload_file_name, part_workers=2,
+                    part_worker_type=worker_type)
+      self.assertIn('2 partition(s)', str(cm.exception))
+      self.assertIn('new kernel hash', str(cm.exception))
+      self.assertIn('new root hash', str(cm.exception))
+
+  def testRunConcurrentDecompression(self):
+    """Tests decompressing full update data on a pool of processes."""
+    self._AssertApplied(self._Apply(self._WritePayload(),
+                                    decompress_workers=2))
+
+  def testRunConcurrentDecompressionOverlap(self):
+    """Tests that overlapping writes are applied in operation order."""
+    block = _PartData('overlap', 1)
+    root_data = self.new_data['root']
+    self.new_data['root'] = (root_data[:2 * _BLOCK_SIZE] + block * 2 +
+                             root_data[4 * _BLOCK_SIZE:])
+    extra_root_ops = [
+        (common.OpType.REPLACE_BZ, [(2, 2)], bz2.compress(block * 2)),
+        (common.OpType.REPLACE, [(3, 1)], block),
+    ]
+    self._AssertApplied(self._Apply(
+        self._WritePayload(extra_root_ops=extra_root_ops),
+        decompress_workers=2))
+
+  def testRunConcurrentDecompressionError(self):
+    """Tests that decompression errors name the failing operation."""
+    extra_root_ops = [(common.OpType.REPLACE_BZ, [(0, 1)], b'not bzip2')]
+    with self.assertRaises(PayloadError) as cm:
+      self._Apply(self._WritePayload(extra_root_ops=extra_root_ops),
+                  decompress_workers=2)
+    self.assertIn('root_install_operations[3](REPLACE_BZ)', str(cm.exception))
+
+  def testRunConcurrentDecompressionTaskError(self):
+    """Tests that tasks failing outside of decompression are reported."""
+    # Lambdas cannot be pickled to be sent to the worker processes.
+    with mock.patch.object(applier, '_DecompressBlob', lambda *args: None):
+      with self.assertRaises(PayloadError) as cm:
+        self._Apply(self._WritePayload(), decompress_workers=2)
+    self.assertIn('failed to decompress data', str(cm.exception))
+
+  def testRunStreamingDecompression(self):
+    """Tests decompressing in small chunks, padding the last block."""
+    partial_block = _PartData('partial', 2)[:int(1.5 * _BLOCK_SIZE)]
+    root_data = self.new_data['root']
+    self.new_data['root'] = (partial_block + b'\0' * (_BLOCK_SIZE // 2) +
+                             root_data[2 * _BLOCK_SIZE:])
+    extra_root_ops = [
+        (common.OpType.REPLACE_XZ, [(0, 1), (1, 1)],
+         lzma.compress(partial_block)),
+    ]
+    self._AssertApplied(self._Apply(
+        self._WritePayload(extra_root_ops=extra_root_ops),
+        decompress_buffer_size=100))
+
+  def testRunConcatenatedStreams(self):
+    """Tests decompressing concatenated streams, as written by pbzip2."""
+    blocks = [_PartData('stream %d' % idx, 1) for idx in range(2)]
+    root_data = self.new_data['root']
+    self.new_data['root'] = b''.join(blocks) + root_data[2 * _BLOCK_SIZE:]
+    for compress, op_type in ((bz2.compress, common.OpType.REPLACE_BZ),
+                              (lzma.compress, common.OpType.REPLACE_XZ)):
+      extra_root_ops = [
+          (op_type, [(0, 2)], b''.join(compress(block) for block in blocks)),
+      ]
+      payload_file_name = self._WritePayload(extra_root_ops=extra_root_ops)
+      for decompress_buffer_size in (100, 1024 * 1024):
+        self._AssertApplied(self._Apply(
+            payload_file_name, decompress_buffer_size=decompress_buffer_size))
+
+    # Trailing data that is not another stream is an error.
+    extra_root_ops = [
+        (common.OpType.REPLACE_BZ, [(0, 2)],
+         bz2.compress(b''.join(blocks)) + b'garbage'),
+    ]
+    with self.assertRaises(PayloadError) as cm:
+      self._Apply(self._WritePayload(extra_root_ops=extra_root_ops))
+    self.assertIn('root_install_operations[3](REPLACE_BZ): failed to '
+                  'decompress data', str(cm.exception))
+
+  def testRunStreamingDecompressionErrors(self):
+    """Tests errors caught while writing streamed data."""
+    block = _PartData('block', 1)
+    for extra_root_op, expected_error in (
+        ((common.OpType.REPLACE_BZ, [(0, 1)], bz2.compress(block)[:-10]),
+         'compressed data ended prematurely'),
+        ((common.OpType.REPLACE_BZ, [(0, 1)], bz2.compress(block * 2)),
+         'wrote fewer bytes'),
+        ((common.OpType.REPLACE_XZ, [(0, 1), (1, 1)], lzma.compress(block)),
+         'dst_extents[2]: more dst blocks than data')):
+      with self.assertRaises(PayloadError) as cm:
+        self._Apply(self._WritePayload(extra_root_ops=[extra_root_op]),
+                    decompress_buffer_size=100)
+      self.assertIn(expected_error, str(cm.exception))
+
+  def testRunBlobCache(self):
+    """Tests taking data blobs and decompressed data from a blob cache."""
+    payload_file_name = self._WritePayload()
+    blob_size = os.path.getsize(payload_file_name)
+    with open(payload_file_name, 'rb') as payload_file:
+      payload = Payload(payload_file)
+      payload.Init()
+      blob_size -= payload.data_offset
+    for decompress_workers in (0, 2):
+      cache = blob_cache_lib.BlobCache(
+          os.path.join(self.test_dir, 'cache%d' % decompress_workers),
+          cache_decompressed=True, populate=True)
+      self._AssertApplied(self._Apply(payload_file_name, blob_cache=cache,
+                                      decompress_workers=decompress_workers))
+      self.assertNotIn(blob_cache_lib.STAT_HIT_BYTES, cache.stats)
+      self._AssertApplied(self._Apply(payload_file_name, blob_cache=cache,
+                                      decompress_workers=decompress_workers))
+      self.assertEqual(blob_size, cache.stats[blob_cache_lib.STAT_HIT_BYTES])
+      self.assertEqual(6 * _BLOCK_SIZE,
+                       cache.stats[blob_cache_lib.STAT_DECOMPRESSED_HIT_BYTES])
+
+  def testRunDelta(self):
+    """Tests applying a delta payload."""
+    payload_file_name, old_parts = self._WriteDeltaPayload()
+    self._AssertApplied(self._Apply(payload_file_name, old_parts=old_parts))
+
+  @unittest.skipUnless(hasattr(os, 'copy_file_range'),
+                       'copy_file_range not available')
+  def testRunDeltaCopyFileRange(self):
+    """Tests that SOURCE_COPY data is copied by the kernel."""
+    payload_file_name, old_parts = self._WriteDeltaPayload()
+    self._AssertApplied(self._Apply(payload_file_name, old_parts=old_parts))
+    self.assertEqual(8 * _BLOCK_SIZE,
+                     self.stats[applier.STAT_SOURCE_COPY_KERNEL_BYTES])
+    self.assertNotIn(applier.STAT_SOURCE_COPY_USERSPACE_BYTES, self.stats)
+
+  def testRunDeltaCopyFileRangeFallback(self):
+    """Tests copying SOURCE_COPY data in userspace if the kernel can't."""
+    payload_file_name, old_parts = self._WriteDeltaPayload()
+    self._AssertApplied(self._Apply(payload_file_name, old_parts=old_parts,
+                                    use_copy_file_range=False))
+    self.assertEqual(8 * _BLOCK_SIZE,
+                     self.stats[applier.STAT_SOURCE_COPY_USERSPACE_BYTES])
+
+    unsupported = OSError(errno.EXDEV, 'cross-device copy')
+    with mock.patch.object(os, 'copy_file_range', create=True,
+                           side_effect=unsupported) as copy_file_range:
+      self._AssertApplied(self._Apply(payload_file_name, old_parts=old_parts))
+    # Not retried once found to be unsupported.
+    self.assertEqual(1, copy_file_range.call_count)
+    self.assertEqual(8 * _BLOCK_SIZE,
+                     self.stats[applier.STAT_SOURCE_COPY_USERSPACE_BYTES])
+    self.assertNotIn(applier.STAT_SOURCE_COPY_KERNEL_BYTES, self.stats)
+
+  def _CorruptBlock(self, file_name, block):
+    """Flips the first byte of a block of a file."""
+    with open(file_name, 'r+b') as part_file:
+      part_file.seek(block * _BLOCK_SIZE)
+      data = bytearray(part_file.read(1))
+      part_file.seek(block * _BLOCK_SIZE)
+      part_file.write(bytes(bytearray([data[0] ^ 0xff])))
+
+  def testRunSourceVerification(self):
+    """Tests the ways of verifying source partitions."""
+    payload_file_name, old_parts = self._WriteDeltaPayload()
+    for source_verification in applier.SOURCE_VERIFICATION_MODES:
+      self._AssertApplied(self._Apply(
+          payload_file_name, old_parts=old_parts,
+          source_verification=source_verification))
+    self.assertRaises(PayloadError, self._Apply, payload_file_name,
+                      old_parts=old_parts, source_verification='never')
+
+    # Blocks not used by any operation only matter when verifying in full.
+    self._CorruptBlock(old_parts['root'], 0)
+    self._AssertApplied(self._Apply(payload_file_name, old_parts=old_parts,
+                                    source_verification='operations'))
+    for source_verification in ('before', 'concurrent'):
+      with self.assertRaises(PayloadError) as cm:
+        self._Apply(payload_file_name, old_parts=old_parts,
+                    source_verification=source_verification)
+      self.assertIn('old root hash', str(cm.exception))
+
+    self._CorruptBlock(old_parts['root'], 5)
+    with self.assertRaises(PayloadError) as cm:
+      self._Apply(payload_file_name, old_parts=old_parts,
+                  source_verification='operations')
+    self.assertIn('root_install_operations[1](SOURCE_COPY): source hash',
+                  str(cm.exception))
+
+  def testRunSourceVerificationFallback(self):
+    """Tests verifying in full when operations lack source hashes."""
+    payload_file_name, old_parts = self._WriteDeltaPayload(src_hashes=False)
+    self._CorruptBlock(old_parts['root'], 0)
+    with self.assertRaises(PayloadError) as cm:
+      self._Apply(payload_file_name, old_parts=old_parts,
+                  source_verification='operations')
+    self.assertIn('old root hash', str(cm.exception))
+
+  def testRunSourceVerificationRollBack(self):
+    """Tests rolling back what was applied from a bad source partition."""
+    payload_file_name, old_parts = self._WriteDeltaPayload()
+    journal_file_name = os.path.join(self.test_dir, 'journal')
+    self._CorruptBlock(old_parts['root'], 0)
+    with self.assertRaises(PayloadError):
+      self._Apply(payload_file_name, old_parts=old_parts,
+                  source_verification='concurrent',
+                  journal_file_name=journal_file_name)
+    self.assertEqual(0, os.path.getsize(os.path.join(self.test_dir,
+                                                     'root.img')))
+    with open(journal_file_name) as journal_file:
+      journal = json.load(journal_file)
+    self.assertEqual(0, journal['partitions']['root']['next_operation'])
+
+  def testRunSourceVerificationRollBackPending(self):
+    """Tests rolling back when applying fails before verification ends."""
+    payload_file_name, old_parts = self._WriteDeltaPayload()
+    journal_file_name = os.path.join(self.test_dir, 'journal')
+    self._CorruptBlock(old_parts['root'], 0)
+    verify = applier._BackgroundVerifier._Verify
+
+    def _SlowVerify(*args):
+      time.sleep(0.2)
+      verify(*args)
+
+    # A tool failing on the bad source data fails with an error of its own.
+    tool_error = subprocess.CalledProcessError(1, 'bspatch')
+    with mock.patch.object(applier, '_JOURNAL_FLUSH_OPS', 1), \
+         mock.patch.object(applier._BackgroundVerifier, '_Verify',
+                           autospec=True, side_effect=_SlowVerify), \
+         mock.patch.object(applier.PayloadApplier, '_ApplyReplaceOperation',
+                           side_effect=tool_error):
+      with self.assertRaises(PayloadError) as cm:
+        self._Apply(payload_file_name, old_parts=old_parts,
+                    source_verification='concurrent',
+                    journal_file_name=journal_file_name)
+    self.assertIn('old root hash', str(cm.exception))
+    self.assertEqual(0, os.path.getsize(os.path.join(self.test_dir,
+                                                     'root.img')))
+    with open(journal_file_name) as journal_file:
+      journal = json.load(journal_file)
+    self.assertEqual(0, journal['partitions']['root']['next_operation'])
+
+    # Failures with a good source are reported as such, keeping progress;
+    # corrupting the block again restores it.
+    self._CorruptBlock(old_parts['root'], 0)
+    with mock.patch.object(applier, '_JOURNAL_FLUSH_OPS', 1), \
+         mock.patch.object(applier.PayloadApplier, '_ApplyReplaceOperation',
+                           side_effect=tool_error):
+      self.assertRaises(subprocess.CalledProcessError, self._Apply,
+                        payload_file_name, old_parts=old_parts,
+                        source_verification='concurrent',
+                        journal_file_name=journal_file_name)
+    with open(journal_file_name) as journal_file:
+      journal = json.load(journal_file)
+    self.assertEqual(1, journal['partitions']['root']['next_operation'])
+
+  def testRunDeltaBsdiffInProcess(self):
+    """Tests applying bsdiff patches in-process."""
+    payload_file_name, old_parts = self._WriteDeltaPayload(bsdiff=True)
+    for patch_backend in ('auto', 'python'):
+      self._AssertApplied(self._Apply(payload_file_name, old_parts=old_parts,
+                                      patch_backend=patch_backend))
+      self.assertEqual(1, self.stats[applier.STAT_PATCH_IN_PROCESS_OPS])
+      self.assertNotIn(applier.STAT_PATCH_TOOL_RUNS, self.stats)
+
+  def testRunDeltaBsdiffExternal(self):
+    """Tests applying bsdiff patches with an external tool."""
+    payload_file_name, old_parts = self._WriteDeltaPayload(bsdiff=True)
+    bspatch_path = os.path.join(self.test_dir, 'bspatch')
+    with open(bspatch_path, 'w') as bspatch_file:
+      bspatch_file.write('#!%s\n' % sys.executable)
+      bspatch_file.write(_FAKE_BSPATCH % os.path.dirname(
+          os.path.dirname(os.path.abspath(applier.__file__))))
+    os.chmod(bspatch_path, 0o755)
+
+    self._AssertApplied(self._Apply(payload_file_name, old_parts=old_parts,
+                                    patch_backend='external',
+                                    bspatch_path=bspatch_path))
+    self.assertEqual(1, self.stats[applier.STAT_PATCH_TOOL_RUNS])
+    self.assertNotIn(applier.STAT_PATCH_IN_PROCESS_OPS, self.stats)
+
+    # Patches the in-process backend cannot handle go to the tool as well.
+    with mock.patch.object(applier.bspatch, 'CanPatch', return_value=False):
+      self._AssertApplied(self._Apply(payload_file_name, old_parts=old_parts,
+                                      bspatch_path=bspatch_path))
+    self.assertEqual(1, self.stats[applier.STAT_PATCH_TOOL_RUNS])
+
+  def testOpenToolFile(self):
+    """Tests the anonymous files passed to external tools."""
+    tool_file, tool_file_name = applier._OpenToolFile(b'patch data')
+    with tool_file:
+      with open(tool_file_name, 'rb') as reopened_file:
+        self.assertEqual(b'patch data', reopened_file.read())
+      if hasattr(os, 'memfd_create'):
+        self.assertEqual('/dev/fd/%d' % tool_file.fileno(), tool_file_name)
+
+  def _AssertResumed(self, payload_file_name, interrupted_method,
+                     skipped_method, old_parts=None, **applier_dargs):
+    """Interrupts applying a payload, then resumes it.
+
+    Args:
+      payload_file_name: the payload file name
+      interrupted_method: the name of the applier method failing the second
+                          root operation
+      skipped_method: the name of the applier method applying the first root
+                      operation, which must not be called again on resume
+      old_parts: map of source partition file names (optional)
+      applier_dargs: additional arguments to apply with on resume
+    """
+    journal_file_name = os.path.join(self.test_dir, 'journal')
+    with mock.patch.object(applier, '_JOURNAL_FLUSH_OPS', 1):
+      with mock.patch.object(applier.PayloadApplier, interrupted_method,
+                             side_effect=PayloadError('interrupted')):
+        with self.assertRaises(PayloadError):
+          self._Apply(payload_file_name, old_parts=old_parts,
+                      journal_file_name=journal_file_name)
+    with open(journal_file_name) as journal_file:
+      journal = json.load(journal_file)
+    self.assertEqual(1, journal['partitions']['root']['next_operation'])
+
+    method = getattr(applier.PayloadApplier, skipped_method)
+    with mock.patch.object(applier.PayloadApplier, skipped_method,
+                           autospec=True, side_effect=method) as spy:
+      new_parts = self._Apply(payload_file_name, old_parts=old_parts,
+                              journal_file_name=journal_file_name,
+                              resume=True, **applier_dargs)
+    self._AssertApplied(new_parts)
+    self.assertEqual([], [call[0][2] for call in spy.call_args_list
+                          if call[0][2].startswith('root_')])
+
+    # Progress is recorded up to the last operation.
+    with open(journal_file_name) as journal_file:
+      journal = json.load(journal_file)
+    self.assertEqual(
+        {'kernel': 1, 'root': 2},
+        dict((name, entry['next_operation'])
+             for name, entry in journal['partitions'].items()))
+
+  def testRunResume(self):
+    """Tests resuming an interrupted full payload application."""
+    payload_file_name = self._WritePayload()
+    self._AssertResumed(payload_file_name, '_ApplyZeroOperation',
+                        '_ApplyReplaceOperation')
+    self._AssertResumed(payload_file_name, '_ApplyZeroOperation',
+                        '_ApplyReplaceOperation', decompress_workers=2)
+
+  def testRunResumeDelta(self):
+    """Tests resuming an interrupted delta payload application."""
+    payload_file_name, old_parts = self._WriteDeltaPayload()
+    self._AssertResumed(payload_file_name, '_ApplyReplaceOperation',
+                        '_ApplySourceCopyOperation', old_parts=old_parts)
+
+  def testRunResumeErrors(self):
+    """Tests that journals not matching the application are rejected."""
+    payload_file_name = self._WritePayload()
+    journal_file_name = os.path.join(self.test_dir, 'journal')
+    with self.assertRaises(PayloadError):
+      self._Apply(payload_file_name, resume=True)
+
+    # Resuming without a journal starts over.
+    self._AssertApplied(self._Apply(payload_file_name,
+                                    journal_file_name=journal_file_name,
+                                    resume=True))
+    with open(journal_file_name) as journal_file:
+      journal = json.load(journal_file)
+
+    bad_journals = [
+        'not json',
+        dict(journal, version=0),
+        dict(journal, metadata_sha256='bogus'),
+        dict(journal, partitions={'root': {'file_name': '/bogus',
+                                           'next_operation': 1}}),
+        dict(journal, partitions={'root': dict(journal['partitions']['root'],
+                                               next_operation=3)}),
+    ]
+    for bad_journal in bad_journals:
+      with open(journal_file_name, 'w') as journal_file:
+        if isinstance(bad_journal, dict):
+          json.dump(bad_journal, journal_file)
+        else:
+          journal_file.write(bad_journal)
+      with self.assertRaises(PayloadError):
+        self._Apply(payload_file_name, journal_file_name=journal_file_name,
+                    resume=True)
+
+    # Not resuming ignores whatever is in the journal.
+    self._AssertApplied(self._Apply(payload_file_name,
+                                    journal_file_name=journal_file_name))
+
+  def testReadWriteExtents(self):
+    """Tests extent I/O on real files as well as in-memory ones."""
+    payload_gen = test_utils.PayloadGenerator()
+    payload_gen.AddOperation('root', common.OpType.SOURCE_COPY,
+                             src_extents=[(3, 1), (0, 2)],
+                             dst_extents=[(1, 2), (4, 1)])
+    payload_gen.AddOperation('root', common.OpType.SOURCE_COPY,
+                             src_extents=[(0, 1), (9, 1)])
+    op, past_eof_op = payload_gen.manifest.partitions[0].operations
+    src_data = _PartData('src', 4)
+    expected_data = (src_data[3 * _BLOCK_SIZE:] +
+                     src_data[:2 * _BLOCK_SIZE])
+
+    file_name = os.path.join(self.test_dir, 'extents.img')
+    with open(file_name, 'w+b') as real_file:
+      for part_file in (real_file, io.BytesIO()):
+        part_file.write(src_data)
+        buf = bytearray(4 * _BLOCK_SIZE)
+        data = applier._ReadExtents(part_file, op.src_extents, _BLOCK_SIZE,
+                                    buf=buf)
+        self.assertEqual(expected_data, data.tobytes())
+        # The data must have been read into the given buffer.
+        self.assertEqual(expected_data, bytes(buf[:len(data)]))
+        self.assertEqual(
+            expected_data[:_BLOCK_SIZE + 10],
+            applier._ReadExtents(part_file, op.src_extents, _BLOCK_SIZE,
+                                 max_length=_BLOCK_SIZE + 10).tobytes())
+
+        applier._WriteExtents(part_file, data, op.dst_extents, _BLOCK_SIZE,
+                              'dst_extents')
+        part_file.seek(0)
+        content = part_file.read()
+        self.assertEqual(expected_data[:2 * _BLOCK_SIZE],
+                         content[_BLOCK_SIZE:3 * _BLOCK_SIZE])
+        self.assertEqual(expected_data[2 * _BLOCK_SIZE:],
+                         content[4 * _BLOCK_SIZE:])
+
+        with self.assertRaises(PayloadError):
+          applier._ReadExtents(part_file, past_eof_op.src_extents,
+                               _BLOCK_SIZE)
+        with self.assertRaises(PayloadError):
+          applier._WriteExtents(part_file, data[:_BLOCK_SIZE],
+                                op.dst_extents, _BLOCK_SIZE, 'dst_extents')
+
+  def testRunZeroPunchesHoles(self):
+    """Tests that ZERO and DISCARD operations leave holes in the output."""
+    root_data = self.new_data['root']
+    self.new_data['root'] = root_data[:2 * _BLOCK_SIZE] + b'\0' * (
+        len(root_data) - 2 * _BLOCK_SIZE)
+    extra_root_ops = [
+        (common.OpType.ZERO, [(2, 2)], None),
+        (common.OpType.DISCARD, [(4, 2)], None),
+    ]
+    new_parts = self._Apply(self._WritePayload(extra_root_ops=extra_root_ops))
+    self._AssertApplied(new_parts)
+    self.assertEqual(6 * _BLOCK_SIZE,
+                     self.stats[applier.STAT_ZERO_KERNEL_BYTES])
+    # Only the first two blocks should be allocated, unless the filesystem
+    # does not support holes at all.
+    self.assertLessEqual(os.stat(new_parts['root']).st_blocks * 512,
+                         max(2 * _BLOCK_SIZE, len(self.new_data['root'])))
+
+  def testRunBlockDevice(self):
+    """Tests writing partitions in place onto block devices."""
+    new_parts = dict((name, os.path.join(self.test_dir, name + '.img'))
+                     for name in self.new_data)
+    tail = b'\xff' * (3 * _BLOCK_SIZE)
+
+    def _FillDevices(extra_size):
+      for name, file_name in new_parts.items():
+        with open(file_name, 'wb') as part_file:
+          part_file.write(b'\xff' * (len(self.new_data[name]) + extra_size))
+
+    def _BlockDeviceSize(file_name):
+      if file_name in new_parts.values():
+        return os.path.getsize(file_name)
+      return None
+
+    self.assertIsNone(applier._BlockDeviceSize(new_parts['root']))
+    self.assertIsNone(applier._BlockDeviceSize(self.test_dir + '/missing'))
+
+    # Block devices are not truncated to the partition size.
+    _FillDevices(len(tail))
+    with mock.patch.object(applier, '_BlockDeviceSize',
+                           side_effect=_BlockDeviceSize):
+      self._Apply(self._WritePayload())
+    for name, file_name in new_parts.items():
+      with open(file_name, 'rb') as part_file:
+        self.assertEqual(self.new_data[name] + tail, part_file.read())
+
+    # Nothing is written to block devices too small for the partition.
+    _FillDevices(-_BLOCK_SIZE)
+    with mock.patch.object(applier, '_BlockDeviceSize',
+                           side_effect=_BlockDeviceSize):
+      with self.assertRaises(PayloadError) as cm:
+        self._Apply(self._WritePayload())
+    self.assertIn('too small', str(cm.exception))
+    for name, file_name in new_parts.items():
+      with open(file_name, 'rb') as part_file:
+        self.assertEqual(b'\xff' * (len(self.new_data[name]) - _BLOCK_SIZE),
+                         part_file.read())
+
+  def testRunZeroFallback(self):
+    """Tests writing zeros when holes can't be punched."""
+    with mock.patch.object(applier, '_FALLOCATE', None):
+      self._AssertApplied(self._Apply(self._WritePayload()))
+    self.assertEqual(2 * _BLOCK_SIZE,
+                     self.stats[applier.STAT_ZERO_WRITTEN_BYTES])
+    self.assertNotIn(applier.STAT_ZERO_KERNEL_BYTES, self.stats)
+
+  def testRunZeroBlockDevice(self):
+    """Tests zeroing block device ranges that fail to be discarded."""
+    root_data = self.new_data['root']
+    self.new_data['root'] = root_data[:2 * _BLOCK_SIZE] + b'\0' * (
+        len(root_data) - 2 * _BLOCK_SIZE)
+    extra_root_ops = [
+        (common.OpType.DISCARD, [(2, 1), (3, 1)], None),
+        (common.OpType.ZERO, [(4, 2)], None),
+    ]
+
+    def _BlockDeviceZeroOut(fd, offset, length, discard):
+      if discard:
+        return False
+      os.pwrite(fd, b'\0' * length, offset)
+      return True
+
+    with mock.patch.object(applier, '_BlockDeviceSize', return_value=None), \
+         mock.patch.object(applier.stat, 'S_ISBLK', return_value=True), \
+         mock.patch.object(applier, '_BlockDeviceZeroOut',
+                           side_effect=_BlockDeviceZeroOut) as zero_out:
+      self._AssertApplied(self._Apply(
+          self._WritePayload(extra_root_ops=extra_root_ops)))
+    # Only discarding is given up on when it fails, and the range is zeroed.
+    calls = [(args[1], args[3]) for args, _ in zero_out.call_args_list]
+    self.assertEqual([(2 * _BLOCK_SIZE, True)],
+                     [call for call in calls if call[1]])
+    discard_idx = calls.index((2 * _BLOCK_SIZE, True))
+    self.assertEqual([(2 * _BLOCK_SIZE, False), (3 * _BLOCK_SIZE, False)],
+                     calls[discard_idx + 1:discard_idx + 3])
+    self.assertEqual(6 * _BLOCK_SIZE,
+                     self.stats[applier.STAT_ZERO_KERNEL_BYTES])
+
+  def testWriteZeros(self):
+    """Tests writing zeros in chunks of the shared zero buffer."""
+    part_file = io.BytesIO(b'\xff' * (2 * len(applier._ZERO_BUFFER) + 12))
+    applier._WriteZeros(part_file, 10, 2 * len(applier._ZERO_BUFFER) + 1)
+    content = part_file.getvalue()
+    self.assertEqual(b'\xff' * 10, content[:10])
+    self.assertEqual(b'\0' * (2 * len(applier._ZERO_BUFFER) + 1),
+                     content[10:11 + 2 * len(applier._ZERO_BUFFER)])
+    self.assertEqual(b'\xff', content[-1:])
+
+  def testDstOverlapDependencies(self):
+    """Tests finding operations writing to the same blocks."""
+    payload_gen = test_utils.PayloadGenerator()
+    for dst_extents in ([(0, 4)], [(4, 2), (8, 1)], [(3, 2)], [(6, 2)],
+                        [(7, 2)]):
+      payload_gen.AddOperation('root', common.OpType.REPLACE,
+                               dst_extents=dst_extents)
+    operations = payload_gen.manifest.partitions[0].operations
+    self.assertEqual([set(), set(), {0, 1}, set(), {1, 3}],
+                     applier._DstOverlapDependencies(operations))
+
+  def testInvalidPatchBackend(self):
+    """Tests that unknown patch backends are rejected."""
+    with self.assertRaises(PayloadError):
+      self._Apply(self._WritePayload(), patch_backend='fork')
+
+  def testInvalidWorkerType(self):
+    """Tests that an unknown partition worker type is rejected."""
+    with self.assertRaises(PayloadError):
+      self._Apply(self._WritePayload(), part_worker_type='fiber')
+
+
+if __name__ == '__main__':
+  unittest.main()
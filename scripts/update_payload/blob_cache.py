@@ -0,0 +1,318 @@
+#
+# Copyright (C) 2013 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Content-addressed cache of data blobs shared across update payloads.
+
+Consecutive builds often share identical data blobs, e.g. the REPLACE blobs of
+regions that did not change, which then have the same data_sha256_hash in
+both payloads. The cache keeps blobs in a directory, one file per blob named
+after its SHA-256 hash, so that applying or downloading the next payload
+takes them from the cache rather than fetching them again. Optionally, the
+decompressed data of REPLACE_BZ and REPLACE_XZ blobs is cached too, keyed by
+the hash of the compressed blob, which saves decompressing it again.
+
+Blobs are only added to the cache when it is set up to be populated, as
+most blobs of a payload are not shared with the next one, and caching all of
+them would evict those that are. The total size of the cache is bounded by
+evicting the least recently used entries, as recorded by the modification
+time of their files so that it carries over from one run to the next.
+Entries used since the cache was opened are never evicted to make room for
+new ones, so populating the cache while applying a payload does not evict
+the blobs the payload shares. Entries are checked against their hash
+whenever they are read, so a corrupt entry is dropped rather than used.
+
+  cache = BlobCache(cache_dir, populate=True)
+  payload = Payload(payload_file, blob_cache=cache)
+
+"""
+
+from __future__ import absolute_import
+
+import binascii
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+
+from update_payload.error import PayloadError
+
+
+#
+# Constants.
+#
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# Suffix of the entries holding decompressed data.
+_DECOMPRESSED_SUFFIX = '.out'
+
+# Size of the hash heading the entries holding decompressed data.
+_HASH_SIZE = hashlib.sha256().digest_size
+
+# Prefix of the temporary files entries are written to.
+_TMP_PREFIX = '.tmp'
+
+# Counters of the cache.
+STAT_HIT_BYTES = 'blob_cache_hit_bytes'
+STAT_STORED_BYTES = 'blob_cache_stored_bytes'
+STAT_EVICTED_BYTES = 'blob_cache_evicted_bytes'
+STAT_DECOMPRESSED_HIT_BYTES = 'blob_cache_decompressed_hit_bytes'
+
+
+def _EntryName(blob_hash):
+  """Returns the name of the cache entry of a blob."""
+  return binascii.hexlify(blob_hash).decode('ascii')
+
+
+class BlobCache(object):
+  """A size-bounded, content-addressed cache of data blobs on disk.
+
+  Blobs are stored in files named after the hex SHA-256 hash of their
+  content; decompressed data is stored in files named after the hash of the
+  compressed blob, prefixed with the hash of the decompressed data itself.
+  Entries are written to a temporary file first and renamed, so they are
+  never seen partially written, and several processes can share the cache
+  directory. Each process keeps its own index of the directory, read when
+  the cache is first used; entries removed by another process are treated
+  as missing.
+  """
+
+  def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE,
+               cache_decompressed=False, populate=False):
+    """Initialize the cache.
+
+    Args:
+      cache_dir: the cache directory, created if missing
+      max_size: the maximum total size of the cache entries, in bytes
+                (optional)
+      cache_decompressed: whether to cache the decompressed data of
+                          compressed blobs as well (optional)
+      populate: whether to add blobs to the cache, rather than only taking
+                them from it (optional)
+    """
+    self.cache_dir = cache_dir
+    self.max_size = max_size
+    self.cache_decompressed = cache_decompressed
+    self.populate = populate
+    self.stats = collections.defaultdict(int)
+    # Maps the name of each entry to its size, least recently used first.
+    self._entries = None
+    self._total_size = 0
+    # The entries used since the cache was opened, kept from eviction.
+    self._used = set()
+    self._used_size = 0
+    self._lock = threading.Lock()
+
+  def _LoadIndex(self):
+    """Lists the cache entries, unless already done."""
+    if self._entries is not None:
+      return
+    try:
+      if not os.path.isdir(self.cache_dir):
+        os.makedirs(self.cache_dir)
+      entries = []
+      for name in os.listdir(self.cache_dir):
+        if name.startswith(_TMP_PREFIX):
+          continue
+        stat = os.stat(os.path.join(self.cache_dir, name))
+        entries.append((stat.st_mtime, name, stat.st_size))
+    except OSError as e:
+      raise PayloadError('cannot read blob cache %s: %s' %
+                         (self.cache_dir, e))
+    self._entries = collections.OrderedDict(
+        (name, size) for _, name, size in sorted(entries))
+    self._total_size = sum(self._entries.values())
+
+  def _Path(self, name):
+    return os.path.join(self.cache_dir, name)
+
+  def _Drop(self, name):
+    """Removes an entry, which may already be gone."""
+    size = self._entries.pop(name, 0)
+    self._total_size -= size
+    if name in self._used:
+      self._used.remove(name)
+      self._used_size -= size
+    try:
+      os.remove(self._Path(name))
+    except OSError:
+      pass
+
+  def _Touch(self, name):
+    """Marks an entry as the most recently used one."""
+    self._entries[name] = self._entries.pop(name)
+    if name not in self._used:
+      self._used.add(name)
+      self._used_size += self._entries[name]
+    try:
+      os.utime(self._Path(name), None)
+    except OSError:
+      pass
+
+  def _Read(self, name):
+    """Returns the content of an entry, or None if missing."""
+    with self._lock:
+      self._LoadIndex()
+      if name not in self._entries:
+        return None
+      try:
+        with open(self._Path(name), 'rb') as entry_file:
+          data = entry_file.read()
+      except IOError:
+        self._Drop(name)
+        return None
+      self._Touch(name)
+      return data
+
+  def _Write(self, name, chunks):
+    """Adds an entry, evicting the least recently used ones to fit it.
+
+    Entries are not added if there is no room for them without evicting
+    entries in use, e.g. if larger than the whole cache.
+
+    Args:
+      name: the name of the entry
+      chunks: the chunks of data the entry consists of
+    """
+    size = sum(len(chunk) for chunk in chunks)
+    with self._lock:
+      self._LoadIndex()
+      if name in self._entries:
+        self._Touch(name)
+        return
+      excess = self._total_size + size - self.max_size
+      if excess > self._total_size - self._used_size:
+        return
+      evicted = []
+      for evicted_name, evicted_size in self._entries.items():
+        if excess <= 0:
+          break
+        if evicted_name not in self._used:
+          evicted.append(evicted_name)
+          excess -= evicted_size
+      for evicted_name in evicted:
+        self.stats[STAT_EVICTED_BYTES] += self._entries[evicted_name]
+        self._Drop(evicted_name)
+
+      # Failing to cache, e.g. for lack of space, is not worth failing for.
+      tmp_name = None
+      try:
+        fd, tmp_name = tempfile.mkstemp(prefix=_TMP_PREFIX,
+                                        dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as tmp_file:
+          for chunk in chunks:
+            tmp_file.write(chunk)
+        os.rename(tmp_name, self._Path(name))
+      except (IOError, OSError):
+        if tmp_name and os.path.exists(tmp_name):
+          os.remove(tmp_name)
+        return
+      self._entries[name] = size
+      self._total_size += size
+      self.stats[STAT_STORED_BYTES] += size
+
+  def Contains(self, blob_hash):
+    """Returns whether a blob is cached, marking it as in use.
+
+    Args:
+      blob_hash: the SHA-256 digest of the blob
+    """
+    name = _EntryName(blob_hash)
+    with self._lock:
+      self._LoadIndex()
+      if name not in self._entries:
+        return False
+      self._Touch(name)
+      return True
+
+  def Get(self, blob_hash):
+    """Returns a cached blob.
+
+    Args:
+      blob_hash: the SHA-256 digest of the blob
+
+    Returns:
+      The blob content, or None if it is not cached or the cache entry is
+      corrupt, in which case it is removed.
+    """
+    name = _EntryName(blob_hash)
+    data = self._Read(name)
+    if data is None:
+      return None
+    if hashlib.sha256(data).digest() != blob_hash:
+      with self._lock:
+        self._Drop(name)
+      return None
+    with self._lock:
+      self.stats[STAT_HIT_BYTES] += len(data)
+    return data
+
+  def Put(self, data):
+    """Adds a blob to the cache, if populated.
+
+    Args:
+      data: the blob content
+
+    Returns:
+      The SHA-256 digest of the blob, which it is cached by, or None if the
+      cache is not populated.
+    """
+    if not self.populate:
+      return None
+    blob_hash = hashlib.sha256(data).digest()
+    self._Write(_EntryName(blob_hash), (data,))
+    return blob_hash
+
+  def GetDecompressed(self, blob_hash):
+    """Returns the cached decompressed data of a compressed blob.
+
+    Args:
+      blob_hash: the SHA-256 digest of the compressed blob
+
+    Returns:
+      The decompressed data, or None if it is not cached (or decompressed
+      data is not cached at all) or the cache entry is corrupt.
+    """
+    if not self.cache_decompressed:
+      return None
+    name = _EntryName(blob_hash) + _DECOMPRESSED_SUFFIX
+    entry = self._Read(name)
+    if entry is None:
+      return None
+    data = memoryview(entry)[_HASH_SIZE:]
+    if hashlib.sha256(data).digest() != entry[:_HASH_SIZE]:
+      with self._lock:
+        self._Drop(name)
+      return None
+    with self._lock:
+      self.stats[STAT_DECOMPRESSED_HIT_BYTES] += len(data)
+    return data
+
+  def PutDecompressed(self, blob_hash, data):
+    """Adds the decompressed data of a compressed blob to the cache.
+
+    Nothing is cached unless the cache was set up to be populated and to
+    cache decompressed data.
+
+    Args:
+      blob_hash: the SHA-256 digest of the compressed blob, which must have
+                 been computed from the blob decompressed, not taken from
+                 the payload manifest
+      data: the decompressed data
+    """
+    if self.populate and self.cache_decompressed:
+      self._Write(_EntryName(blob_hash) + _DECOMPRESSED_SUFFIX,
+                  (hashlib.sha256(data).digest(), data))
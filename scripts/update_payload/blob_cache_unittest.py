@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Unit tests for blob_cache.py."""
+
+# Disable check for function names to avoid errors based on old code
+# pylint: disable-msg=invalid-name
+
+from __future__ import absolute_import
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock  # pylint: disable=import-error
+
+import update_payload
+from update_payload import blob_cache
+from update_payload import common
+from update_payload import test_utils
+
+
+class BlobCacheTest(unittest.TestCase):
+  """Tests the BlobCache class."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.cache_dir = os.path.join(self.test_dir, 'cache')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _EntryPath(self, data, suffix=''):
+    return os.path.join(self.cache_dir,
+                        hashlib.sha256(data).hexdigest() + suffix)
+
+  def testGetPut(self):
+    """Tests caching blobs by their hash."""
+    cache = blob_cache.BlobCache(self.cache_dir, populate=True)
+    blob_hash = hashlib.sha256(b'blob').digest()
+    self.assertIsNone(cache.Get(blob_hash))
+    self.assertFalse(cache.Contains(blob_hash))
+
+    self.assertEqual(blob_hash, cache.Put(b'blob'))
+    self.assertTrue(cache.Contains(blob_hash))
+    self.assertEqual(b'blob', cache.Get(blob_hash))
+    self.assertTrue(os.path.exists(self._EntryPath(b'blob')))
+
+    # The cache outlives the cache object.
+    cache = blob_cache.BlobCache(self.cache_dir)
+    self.assertEqual(b'blob', cache.Get(blob_hash))
+    self.assertEqual(4, cache.stats[blob_cache.STAT_HIT_BYTES])
+
+  def testPopulate(self):
+    """Tests that blobs are only added to a populated cache."""
+    cache = blob_cache.BlobCache(self.cache_dir)
+    self.assertIsNone(cache.Put(b'blob'))
+    self.assertFalse(os.path.exists(self._EntryPath(b'blob')))
+
+  def testEviction(self):
+    """Tests evicting the least recently used blobs not in use."""
+    cache = blob_cache.BlobCache(self.cache_dir, max_size=12, populate=True)
+    hashes = [cache.Put(data) for data in (b'aaaa', b'bbbb', b'cccc')]
+    # Entries are ordered by modification time when reopening the cache.
+    for age, data in enumerate((b'bbbb', b'aaaa', b'cccc')):
+      os.utime(self._EntryPath(data), (1000 + age, 1000 + age))
+
+    cache = blob_cache.BlobCache(self.cache_dir, max_size=12, populate=True)
+    self.assertTrue(cache.Contains(hashes[2]))
+    cache.Put(b'dddd')
+    self.assertFalse(cache.Contains(hashes[1]))
+    self.assertEqual(b'aaaa', cache.Get(hashes[0]))
+    # The newest entry goes first, as the older ones are in use.
+    cache.Put(b'eeee')
+    self.assertFalse(os.path.exists(self._EntryPath(b'dddd')))
+    self.assertEqual(b'cccc', cache.Get(hashes[2]))
+    self.assertEqual(8, cache.stats[blob_cache.STAT_EVICTED_BYTES])
+    self.assertEqual(3, len(os.listdir(self.cache_dir)))
+
+    # Blobs that only fit by evicting entries in use are not cached.
+    self.assertIsNone(cache.Get(cache.Put(b'x' * 5)))
+    self.assertIsNone(cache.Get(cache.Put(b'x' * 13)))
+    self.assertEqual(3, len(os.listdir(self.cache_dir)))
+
+  def testPayloadRead(self):
+    """Tests that reading a whole payload keeps the blobs it shares cached."""
+    blobs = [hashlib.sha256(b'%d' % idx).digest() * 4 for idx in range(8)]
+    cache = blob_cache.BlobCache(self.cache_dir, populate=True)
+    cache.Put(blobs[3])
+
+    payload_gen = test_utils.EnhancedPayloadGenerator()
+    payload_gen.SetBlockSize(len(blobs[0]))
+    for idx, blob in enumerate(blobs):
+      payload_gen.AddOperationWithData(
+          common.ROOTFS, common.OpType.REPLACE, dst_extents=[(idx, 1)],
+          data_blob=blob)
+    payload_file_name = os.path.join(self.test_dir, 'payload.bin')
+    with open(payload_file_name, 'wb') as payload_file:
+      payload_gen.WriteToFileWithData(payload_file)
+
+    max_size = 3 * len(blobs[0])
+    for populate in (False, True):
+      cache = blob_cache.BlobCache(self.cache_dir, max_size=max_size,
+                                   populate=populate)
+      with open(payload_file_name, 'rb') as payload_file:
+        payload = update_payload.Payload(payload_file, blob_cache=cache)
+        payload.Init()
+        for part in payload.manifest.partitions:
+          for op in part.operations:
+            payload.ReadDataBlob(op.data_offset, op.data_length)
+      self.assertEqual(len(blobs[3]), cache.stats[blob_cache.STAT_HIT_BYTES])
+      # The cache stays within its size, and keeps the blob in use.
+      self.assertTrue(os.path.exists(self._EntryPath(blobs[3])))
+      self.assertLessEqual(
+          sum(os.path.getsize(os.path.join(self.cache_dir, name))
+              for name in os.listdir(self.cache_dir)), max_size)
+    self.assertEqual(3, len(os.listdir(self.cache_dir)))
+
+  def testCorruptEntry(self):
+    """Tests that corrupt entries are dropped."""
+    cache = blob_cache.BlobCache(self.cache_dir, cache_decompressed=True,
+                                 populate=True)
+    blob_hash = cache.Put(b'blob')
+    cache.PutDecompressed(blob_hash, b'decompressed')
+    for file_name in (self._EntryPath(b'blob'),
+                      self._EntryPath(b'blob', suffix='.out')):
+      with open(file_name, 'r+b') as entry_file:
+        entry_file.seek(-1, 2)
+        entry_file.write(b'!')
+
+    self.assertIsNone(cache.Get(blob_hash))
+    self.assertIsNone(cache.GetDecompressed(blob_hash))
+    self.assertEqual([], os.listdir(self.cache_dir))
+
+  def testDecompressed(self):
+    """Tests caching decompressed data by the hash of the compressed blob."""
+    blob_hash = hashlib.sha256(b'compressed').digest()
+    for cache_decompressed, populate in ((False, True), (True, False)):
+      cache = blob_cache.BlobCache(self.cache_dir,
+                                   cache_decompressed=cache_decompressed,
+                                   populate=populate)
+      cache.PutDecompressed(blob_hash, b'decompressed')
+      self.assertIsNone(cache.GetDecompressed(blob_hash))
+
+    cache = blob_cache.BlobCache(self.cache_dir, cache_decompressed=True,
+                                 populate=True)
+    cache.PutDecompressed(blob_hash, b'decompressed')
+    self.assertEqual(b'decompressed', cache.GetDecompressed(blob_hash))
+    self.assertIsNone(cache.Get(blob_hash))
+    self.assertEqual(len(b'decompressed'),
+                     cache.stats[blob_cache.STAT_DECOMPRESSED_HIT_BYTES])
+
+  def testWriteFailure(self):
+    """Tests that failing to write to the cache is not an error."""
+    cache = blob_cache.BlobCache(self.cache_dir, populate=True)
+    with mock.patch.object(blob_cache.os, 'rename', side_effect=OSError):
+      blob_hash = cache.Put(b'blob')
+    self.assertIsNone(cache.Get(blob_hash))
+    self.assertEqual([], os.listdir(self.cache_dir))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,264 @@
+#
+# Copyright (C) 2013 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""In-process application of bsdiff patches.
+
+Handles both the original BSDIFF40 format, where every stream is bzip2
+compressed, and the BSDF2 format used by SOURCE_BSDIFF and BROTLI_BSDIFF
+operations, where each stream names its own compressor. Brotli streams
+require the optional brotli module.
+"""
+
+from __future__ import absolute_import
+
+import bz2
+import struct
+
+try:
+  import brotli  # pylint: disable=import-error
+except ImportError:
+  brotli = None
+
+from update_payload.error import PayloadError
+
+
+#
+# Constants.
+#
+_MAGIC_BSDIFF40 = b'BSDIFF40'
+_MAGIC_BSDF2 = b'BSDF2'
+_HEADER_SIZE = 32
+_CONTROL_ENTRY_SIZE = 24
+
+# Stream compressor types in BSDF2 headers.
+_COMPRESSOR_NONE = 0
+_COMPRESSOR_BZ2 = 1
+_COMPRESSOR_BROTLI = 2
+
+# Maximum number of bytes added together at once.
+_ADD_CHUNK_SIZE = 1024 * 1024
+_MASK_LOW = b'\x7f' * _ADD_CHUNK_SIZE
+_MASK_HIGH = b'\x80' * _ADD_CHUNK_SIZE
+
+
+#
+# Helper functions.
+#
+def _DecodeOffset(data, offset):
+  """Decodes a sign-magnitude 64-bit integer as used in bsdiff patches."""
+  value, = struct.unpack_from('<Q', data, offset)
+  if value & (1 << 63):
+    return -(value & ((1 << 63) - 1))
+  return value
+
+
+def _StreamCompressors(patch_data):
+  """Returns the compressor types of the control, diff and extra streams.
+
+  Args:
+    patch_data: the patch content
+
+  Returns:
+    A tuple of three compressor types.
+
+  Raises:
+    PayloadError if the patch format is not recognized.
+  """
+  magic = bytes(patch_data[:len(_MAGIC_BSDIFF40)])
+  if magic == _MAGIC_BSDIFF40:
+    return (_COMPRESSOR_BZ2,) * 3
+  if magic[:len(_MAGIC_BSDF2)] == _MAGIC_BSDF2:
+    return tuple(bytearray(magic[len(_MAGIC_BSDF2):]))
+  raise PayloadError('unrecognized bsdiff patch format')
+
+
+def _Decompress(compressor, data, stream_name):
+  """Decompresses one of the streams of a patch.
+
+  Args:
+    compressor: the compressor type of the stream
+    data: the compressed stream
+    stream_name: name of the stream for error reporting
+
+  Returns:
+    The decompressed stream.
+
+  Raises:
+    PayloadError if the stream cannot be decompressed.
+  """
+  if compressor == _COMPRESSOR_NONE:
+    return data
+  # bz2 reports corrupt data with IOError (OSError in Python 3), and truncated
+  # data with EOFError or ValueError depending on the Python version.
+  decompress_errors = (IOError, OSError, EOFError, ValueError)
+  try:
+    if compressor == _COMPRESSOR_BZ2:
+      return bz2.decompress(data)
+    if compressor == _COMPRESSOR_BROTLI and brotli:
+      decompress_errors += (brotli.error,)
+      return brotli.decompress(bytes(data))
+  except decompress_errors as e:
+    raise PayloadError('failed to decompress patch %s stream: %s' %
+                       (stream_name, e))
+  raise PayloadError('unsupported compressor (%d) for patch %s stream' %
+                     (compressor, stream_name))
+
+
+def _AddBytes(out, out_pos, old, old_pos, length):
+  """Adds bytes of old data onto output data, modulo 256.
+
+  The bytes are added a chunk at a time as large integers, masking out the
+  high bit of each byte so no carry crosses a byte boundary and adding it
+  back in with a XOR.
+
+  Args:
+    out: the output bytearray, holding the diff bytes
+    out_pos: the position in the output to start at
+    old: the old data
+    old_pos: the position in the old data to start at
+    length: the number of bytes to add
+  """
+  while length:
+    add_length = min(length, _ADD_CHUNK_SIZE)
+    out_end = out_pos + add_length
+    a = int.from_bytes(out[out_pos:out_end], 'little')
+    b = int.from_bytes(old[old_pos:old_pos + add_length], 'little')
+    mask_low = int.from_bytes(_MASK_LOW[:add_length], 'little')
+    mask_high = int.from_bytes(_MASK_HIGH[:add_length], 'little')
+    out[out_pos:out_end] = (((a & mask_low) + (b & mask_low)) ^
+                            ((a ^ b) & mask_high)).to_bytes(add_length,
+                                                            'little')
+    out_pos = out_end
+    old_pos += add_length
+    length -= add_length
+
+
+def _AddBytesCompat(out, out_pos, old, old_pos, length):
+  """Adds bytes of old data onto output data, for Pythons lacking from_bytes.
+
+  Args:
+    out: the output bytearray, holding the diff bytes
+    out_pos: the position in the output to start at
+    old: the old data
+    old_pos: the position in the old data to start at
+    length: the number of bytes to add
+  """
+  old = bytearray(old[old_pos:old_pos + length])
+  for i in range(length):
+    out[out_pos + i] = (out[out_pos + i] + old[i]) & 0xff
+
+if not hasattr(int, 'from_bytes'):
+  _AddBytes = _AddBytesCompat
+
+
+#
+# Patching.
+#
+def CanPatch(patch_data):
+  """Returns whether a patch can be applied in-process.
+
+  Args:
+    patch_data: the patch content
+
+  Returns:
+    False if the patch format is not recognized or it uses a compressor that
+    is not available, True otherwise.
+  """
+  try:
+    compressors = _StreamCompressors(patch_data)
+  except PayloadError:
+    return False
+  supported = (_COMPRESSOR_NONE, _COMPRESSOR_BZ2)
+  if brotli:
+    supported += (_COMPRESSOR_BROTLI,)
+  return all(compressor in supported for compressor in compressors)
+
+
+def Patch(old_data, patch_data):
+  """Applies a bsdiff patch to old data.
+
+  Args:
+    old_data: the data the patch was made against
+    patch_data: the patch content
+
+  Returns:
+    A bytearray with the new data.
+
+  Raises:
+    PayloadError if the patch is invalid or cannot be applied.
+  """
+  patch_data = memoryview(patch_data)
+  compressors = _StreamCompressors(patch_data)
+  if len(patch_data) < _HEADER_SIZE:
+    raise PayloadError('truncated patch header')
+  ctrl_length = _DecodeOffset(patch_data, 8)
+  diff_length = _DecodeOffset(patch_data, 16)
+  new_length = _DecodeOffset(patch_data, 24)
+  if (ctrl_length < 0 or diff_length < 0 or new_length < 0 or
+      _HEADER_SIZE + ctrl_length + diff_length > len(patch_data)):
+    raise PayloadError('corrupt patch header')
+
+  diff_start = _HEADER_SIZE + ctrl_length
+  extra_start = diff_start + diff_length
+  ctrl = _Decompress(compressors[0], patch_data[_HEADER_SIZE:diff_start],
+                     'control')
+  diff = memoryview(_Decompress(compressors[1],
+                                patch_data[diff_start:extra_start], 'diff'))
+  extra = memoryview(_Decompress(compressors[2], patch_data[extra_start:],
+                                 'extra'))
+  if len(ctrl) % _CONTROL_ENTRY_SIZE:
+    raise PayloadError('truncated patch control stream')
+
+  old_data = memoryview(old_data)
+  old_length = len(old_data)
+  new_data = bytearray(new_length)
+  new_pos = old_pos = diff_pos = extra_pos = 0
+  for ctrl_pos in range(0, len(ctrl), _CONTROL_ENTRY_SIZE):
+    if new_pos >= new_length:
+      break
+    add_length = _DecodeOffset(ctrl, ctrl_pos)
+    copy_length = _DecodeOffset(ctrl, ctrl_pos + 8)
+    seek_length = _DecodeOffset(ctrl, ctrl_pos + 16)
+    if (add_length < 0 or copy_length < 0 or
+        new_pos + add_length + copy_length > new_length or
+        diff_pos + add_length > len(diff) or
+        extra_pos + copy_length > len(extra)):
+      raise PayloadError('corrupt patch control entry (%d)' %
+                         (ctrl_pos // _CONTROL_ENTRY_SIZE))
+
+    # Add the old data to the diff bytes, where they overlap the old data.
+    new_data[new_pos:new_pos + add_length] = diff[diff_pos:
+                                                  diff_pos + add_length]
+    add_start = max(old_pos, 0)
+    add_end = min(old_pos + add_length, old_length)
+    if add_start < add_end:
+      _AddBytes(new_data, new_pos + add_start - old_pos, old_data, add_start,
+                add_end - add_start)
+    new_pos += add_length
+    old_pos += add_length
+    diff_pos += add_length
+
+    # Copy the extra bytes as is.
+    new_data[new_pos:new_pos + copy_length] = extra[extra_pos:
+                                                    extra_pos + copy_length]
+    new_pos += copy_length
+    extra_pos += copy_length
+    old_pos += seek_length
+
+  if new_pos != new_length:
+    raise PayloadError('patch produced fewer bytes (%d) than expected (%d)' %
+                       (new_pos, new_length))
+  return new_data
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Unit tests for bspatch.py."""
+
+# Disable check for function names to avoid errors based on old code
+# pylint: disable-msg=invalid-name
+
+from __future__ import absolute_import
+
+import os
+import struct
+import unittest
+
+import mock  # pylint: disable=import-error
+
+from update_payload import bspatch
+from update_payload import test_utils
+from update_payload.error import PayloadError
+
+
+class BspatchTest(unittest.TestCase):
+  """Tests the in-process bsdiff patch application."""
+
+  def testPatch(self):
+    """Tests patching with each supported patch format."""
+    old_data = b'hello world, this is old'
+    new_data = b'Hello world, this is new data'
+    for compressors in (None, (0, 0, 0), (1, 0, 1), (1, 1, 1)):
+      patch_data = test_utils.MakeBsdiffPatch(old_data, new_data,
+                                              compressors=compressors)
+      self.assertTrue(bspatch.CanPatch(patch_data))
+      self.assertEqual(bytearray(new_data),
+                       bspatch.Patch(old_data, patch_data))
+
+  def testPatchSeek(self):
+    """Tests control entries seeking around and past the old data."""
+    old_data = b'abcd'
+    patch_data = test_utils.EncodeBsdiffPatch(
+        [(3, 1, -5), (6, 0, 0)], b'\0\1\2' + b'\0\0\0\1\1\1', b'X', 10,
+        compressors=(0, 0, 0))
+    # The second entry starts two bytes before the old data, so only its last
+    # four bytes get added.
+    self.assertEqual(bytearray(b'aceX' + b'\0\0acde'),
+                     bspatch.Patch(old_data, patch_data))
+
+  def testAddBytes(self):
+    """Tests adding bytes across several chunks."""
+    old_data = os.urandom(100)
+    diff = os.urandom(100)
+    expected = bytearray((a + b) & 0xff for a, b in
+                         zip(bytearray(old_data), bytearray(diff)))
+    with mock.patch.object(bspatch, '_ADD_CHUNK_SIZE', 7):
+      out = bytearray(diff)
+      bspatch._AddBytes(out, 0, memoryview(old_data), 0, 100)
+      self.assertEqual(expected, out)
+    out = bytearray(diff)
+    bspatch._AddBytesCompat(out, 0, memoryview(old_data), 0, 100)
+    self.assertEqual(expected, out)
+
+  def testPatchErrors(self):
+    """Tests that invalid patches are rejected."""
+    old_data = b'old data'
+    patch_data = test_utils.MakeBsdiffPatch(old_data, b'new data',
+                                            compressors=(0, 0, 0))
+    bad_patches = [
+        b'BSDIFF41' + patch_data[8:],
+        patch_data[:20],
+        patch_data[:-1],
+        # Unknown and unavailable compressors.
+        b'BSDF2\0\0\7' + patch_data[8:],
+        # Control stream of a partial entry.
+        b'BSDF2\0\0\0' + struct.pack('<QQQ', 4, 0, 0) + b'\0' * 4,
+        # Entries adding or copying more than the new data.
+        test_utils.EncodeBsdiffPatch([(9, 0, 0)], b'\0' * 9, b'', 8,
+                                     compressors=(0, 0, 0)),
+        test_utils.EncodeBsdiffPatch([(0, 9, 0)], b'', b'\0' * 9, 8,
+                                     compressors=(0, 0, 0)),
+        # Entries adding more than the diff data.
+        test_utils.EncodeBsdiffPatch([(8, 0, 0)], b'\0' * 7, b'', 8,
+                                     compressors=(0, 0, 0)),
+        # Entries falling short of the new data.
+        test_utils.EncodeBsdiffPatch([(4, 0, 0)], b'\0' * 4, b'', 8,
+                                     compressors=(0, 0, 0)),
+        # Corrupt compressed stream.
+        b'BSDF2\1\0\0' + struct.pack('<QQQ', 10, 0, 8) + b'!' * 10,
+    ]
+    for bad_patch in bad_patches:
+      self.assertRaises(PayloadError, bspatch.Patch, old_data, bad_patch)
+    self.assertFalse(bspatch.CanPatch(bad_patches[0]))
+    self.assertFalse(bspatch.CanPatch(bad_patches[3]))
+
+  def testBrotli(self):
+    """Tests whether brotli streams are supported depending on the module."""
+    patch_data = test_utils.EncodeBsdiffPatch([], b'', b'', 0,
+                                              compressors=(0, 2, 0))
+    with mock.patch.object(bspatch, 'brotli', None):
+      self.assertFalse(bspatch.CanPatch(patch_data))
+      self.assertRaises(PayloadError, bspatch.Patch, b'', patch_data)
+    with mock.patch.object(bspatch, 'brotli') as brotli:
+      brotli.decompress.return_value = b''
+      self.assertTrue(bspatch.CanPatch(patch_data))
+      self.assertEqual(bytearray(), bspatch.Patch(b'', patch_data))
+      brotli.error = ValueError
+      brotli.decompress.side_effect = ValueError('corrupt')
+      self.assertRaises(PayloadError, bspatch.Patch, b'', patch_data)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -27,20 +27,21 @@ follows:
 from __future__ import absolute_import
 from __future__ import print_function
 
-import array
 import base64
 import collections
 import hashlib
-import itertools
+import json
 import os
-import subprocess
+import random
+from multiprocessing import pool as multiprocessing_pool
 
-from six.moves import range
+import six
 
 from update_payload import common
 from update_payload import error
 from update_payload import format_utils
 from update_payload import histogram
+from update_payload import pubkey
 from update_payload import update_metadata_pb2
 
 #
@@ -54,11 +55,41 @@ CHECKS_TO_DISABLE = (
     _CHECK_PAYLOAD_SIG,
 )
 
+# How thoroughly to check the payload: the metadata level checks the header,
+# manifest and operations without reading any data blobs, the sampled level
+# additionally verifies the hashes of a random subset of the blobs, and the
+# full level verifies all of them as well as the payload signatures.
+CHECK_LEVEL_METADATA = 'metadata'
+CHECK_LEVEL_SAMPLED = 'sampled'
+CHECK_LEVEL_FULL = 'full'
+CHECK_LEVELS = (
+    CHECK_LEVEL_METADATA,
+    CHECK_LEVEL_SAMPLED,
+    CHECK_LEVEL_FULL,
+)
+
+# Fraction of the data blobs verified at the sampled check level.
+DEFAULT_SAMPLE_FRACTION = 0.1
+
+# Report formats: aligned text, or one JSON object per line for each section.
+REPORT_FORMAT_TEXT = 'text'
+REPORT_FORMAT_JSON = 'json'
+REPORT_FORMATS = (
+    REPORT_FORMAT_TEXT,
+    REPORT_FORMAT_JSON,
+)
+
 _TYPE_FULL = 'full'
 _TYPE_DELTA = 'delta'
 
 _DEFAULT_BLOCK_SIZE = 4096
 
+# Number of blobs each hash worker may read and hash ahead of the checks.
+_HASH_AHEAD_PER_WORKER = 4
+
+# Maximum amount of payload data read at once when hashing it for signatures.
+_SIG_HASH_CHUNK_SIZE = 1024 * 1024
+
 _DEFAULT_PUBKEY_BASE_NAME = 'update-payload-key.pub.pem'
 _DEFAULT_PUBKEY_FILE_NAME = os.path.join(os.path.dirname(__file__),
                                          _DEFAULT_PUBKEY_BASE_NAME)
@@ -105,6 +136,76 @@ def _AddHumanReadableSize(size):
   return _AddFormat(format_utils.BytesToHumanReadable, size)
 
 
+#
+# Block usage counters.
+#
+
+class _BlockCounters(object):
+  """Counts the number of times each block of a partition is used.
+
+  Rather than incrementing a counter for every block of every extent, only
+  the blocks where extents start and end are recorded, and the counts are
+  derived by sweeping over those in order. The cost is thus proportional to
+  the number of extents rather than the size of the partition.
+  """
+
+  def __init__(self, num_blocks):
+    """Initializes the counters.
+
+    Args:
+      num_blocks: The number of blocks of the partition.
+    """
+    self.num_blocks = num_blocks
+    # Maps blocks to the change in count from the previous block.
+    self.deltas = collections.defaultdict(int)
+
+  def __len__(self):
+    return self.num_blocks
+
+  def AddExtent(self, start_block, num_blocks):
+    """Records one use of each block of an extent."""
+    self.deltas[start_block] += 1
+    self.deltas[start_block + num_blocks] -= 1
+
+  def CountRuns(self, num_blocks=None):
+    """Yields the counts of consecutive blocks, as run lengths.
+
+    Args:
+      num_blocks: The number of leading blocks to count (default: all).
+
+    Yields:
+      (count, length) pairs, for each run of consecutive blocks used the same
+      number of times, in block order.
+    """
+    if num_blocks is None or num_blocks > self.num_blocks:
+      num_blocks = self.num_blocks
+    count = pos = 0
+    for block in sorted(self.deltas):
+      if block >= num_blocks:
+        break
+      if block > pos:
+        yield count, block - pos
+        pos = block
+      count += self.deltas[block]
+    if num_blocks > pos:
+      yield count, num_blocks - pos
+
+  def GetCountDict(self, num_blocks=None):
+    """Returns the number of blocks used each number of times.
+
+    Args:
+      num_blocks: The number of leading blocks to count (default: all).
+
+    Returns:
+      A dictionary mapping usage counts to numbers of blocks, ordered by the
+      first block having each count.
+    """
+    count_dict = collections.OrderedDict()
+    for count, length in self.CountRuns(num_blocks):
+      count_dict[count] = count_dict.get(count, 0) + length
+    return count_dict
+
+
 #
 # Payload report generator.
 #
@@ -115,12 +216,18 @@ class _PayloadReport(object):
   A report is essentially a sequence of nodes, which represent data points. It
   is initialized to have a "global", untitled section. A node may be a
   sub-report itself.
+
+  A report may stream its sections to a file as they are completed, i.e. when
+  the next one is added or the report is finalized, rather than keeping them
+  all in memory until it is dumped.
   """
 
   # Report nodes: Field, sub-report, section.
   class Node(object):
     """A report node interface."""
 
+    __slots__ = ()
+
     @staticmethod
     def _Indent(indent, line):
       """Indents a line by a given indentation amount.
@@ -148,9 +255,15 @@ class _PayloadReport(object):
       """
       raise NotImplementedError
 
+    def GenerateJson(self):
+      """Returns a JSON serializable representation of a non-section node."""
+      raise NotImplementedError
+
   class FieldNode(Node):
     """A field report node, representing a (name, value) pair."""
 
+    __slots__ = ('name', 'value', 'linebreak', 'indent')
+
     def __init__(self, name, value, linebreak, indent):
       super(_PayloadReport.FieldNode, self).__init__()
       self.name = name
@@ -181,9 +294,22 @@ class _PayloadReport(object):
                       for line in report_output.split('\n')]
       return report_lines, curr_section
 
+    def GenerateJson(self):
+      """Returns the field as a name/value object."""
+      value = self.value
+      if isinstance(value, histogram.Histogram):
+        value = {'total': value.total,
+                 'counts': [[key, count] for key, count in value.data]}
+      elif not isinstance(value, (bool, float, six.integer_types,
+                                  six.string_types)):
+        value = str(value)
+      return {'name': self.name, 'value': value}
+
   class SubReportNode(Node):
     """A sub-report node, representing a nested report."""
 
+    __slots__ = ('title', 'report')
+
     def __init__(self, title, report):
       super(_PayloadReport.SubReportNode, self).__init__()
       self.title = title
@@ -196,9 +322,15 @@ class _PayloadReport(object):
                                                     sub_indent))
       return report_lines, curr_section
 
+    def GenerateJson(self):
+      """Returns the sub-report as a name/sections object."""
+      return {'name': self.title, 'report': list(self.report.GenerateJson())}
+
   class SectionNode(Node):
     """A section header node."""
 
+    __slots__ = ('title', 'max_field_name_len')
+
     def __init__(self, title=None):
       super(_PayloadReport.SectionNode, self).__init__()
       self.title = title
@@ -212,10 +344,22 @@ class _PayloadReport(object):
                                          '=== %s ===\n' % self.title))
       return report_lines, self
 
-  def __init__(self):
+  def __init__(self, stream_file=None, report_format=REPORT_FORMAT_TEXT):
+    """Initializes the report.
+
+    Args:
+      stream_file: File object to write each section to once it is complete
+        (optional).
+      report_format: One of REPORT_FORMATS, in which to write the report.
+    """
+    if report_format not in REPORT_FORMATS:
+      raise error.PayloadError('Invalid report format (%r).' % report_format)
     self.report = []
     self.last_section = self.global_section = self.SectionNode()
     self.is_finalized = False
+    self.stream_file = stream_file
+    self.report_format = report_format
+    self.is_written = False
 
   def GenerateLines(self, base_indent, sub_indent):
     """Generates the lines in the report, properly indented.
@@ -224,32 +368,68 @@ class _PayloadReport(object):
       base_indent: The indentation used for root-level report lines.
       sub_indent: The indentation offset used for sub-reports.
 
-    Returns:
-      A list of indented report lines.
+    Yields:
+      Indented report lines.
     """
-    report_lines = []
     curr_section = self.global_section
     for node in self.report:
       node_report_lines, curr_section = node.GenerateLines(
           base_indent, sub_indent, curr_section)
-      report_lines.extend(node_report_lines)
+      for line in node_report_lines:
+        yield line
 
-    return report_lines
+  def GenerateJson(self):
+    """Generates the sections of the report as JSON serializable objects.
+
+    Yields:
+      An object with the title and fields of each section; the global section
+      is untitled, and skipped if empty.
+    """
+    section = {'section': self.global_section.title, 'fields': []}
+    for node in self.report:
+      if isinstance(node, self.SectionNode):
+        if section['fields'] or section['section']:
+          yield section
+        section = {'section': node.title, 'fields': []}
+      else:
+        section['fields'].append(node.GenerateJson())
+    if section['fields'] or section['section']:
+      yield section
+
+  def _Write(self, out_file, base_indent=0, sub_indent=2):
+    """Writes the report nodes to a file and releases them.
+
+    Args:
+      out_file: File object to output the content to.
+      base_indent: Base indentation for report lines.
+      sub_indent: Added indentation for sub-reports.
+    """
+    if self.report_format == REPORT_FORMAT_JSON:
+      for section in self.GenerateJson():
+        out_file.write(json.dumps(section, sort_keys=True) + '\n')
+        self.is_written = True
+    else:
+      for line in self.GenerateLines(base_indent, sub_indent):
+        out_file.write(line)
+        self.is_written = True
+    self.report = []
 
   def Dump(self, out_file, base_indent=0, sub_indent=2):
     """Dumps the report to a file.
 
+    Sections already streamed are not dumped again.
+
     Args:
       out_file: File object to output the content to.
       base_indent: Base indentation for report lines.
       sub_indent: Added indentation for sub-reports.
     """
-    report_lines = self.GenerateLines(base_indent, sub_indent)
-    if report_lines and not self.is_finalized:
-      report_lines.append('(incomplete report)\n')
-
-    for line in report_lines:
-      out_file.write(line)
+    self._Write(out_file, base_indent, sub_indent)
+    if self.report_format == REPORT_FORMAT_JSON:
+      if self.is_written:
+        out_file.write(json.dumps({'complete': self.is_finalized}) + '\n')
+    elif self.is_written and not self.is_finalized:
+      out_file.write('(incomplete report)\n')
 
   def AddField(self, name, value, linebreak=False, indent=0):
     """Adds a field/value pair to the payload report.
@@ -273,14 +453,18 @@ class _PayloadReport(object):
     return sub_report.report
 
   def AddSection(self, title):
-    """Adds a new section title."""
+    """Adds a new section title, streaming the previous section if so set."""
     assert not self.is_finalized
+    if self.stream_file:
+      self._Write(self.stream_file)
     self.last_section = self.SectionNode(title)
     self.report.append(self.last_section)
 
   def Finalize(self):
     """Seals the report, marking it as complete."""
     self.is_finalized = True
+    if self.stream_file:
+      self._Write(self.stream_file)
 
 
 #
@@ -295,7 +479,10 @@ class PayloadChecker(object):
   """
 
   def __init__(self, payload, assert_type=None, block_size=0,
-               allow_unhashed=False, disabled_tests=()):
+               allow_unhashed=False, disabled_tests=(),
+               check_level=CHECK_LEVEL_FULL,
+               sample_fraction=DEFAULT_SAMPLE_FRACTION, sample_seed=None,
+               hash_workers=0):
     """Initialize the checker.
 
     Args:
@@ -304,6 +491,15 @@ class PayloadChecker(object):
       block_size: Expected filesystem / payload block size (optional).
       allow_unhashed: Allow operations with unhashed data blobs.
       disabled_tests: Sequence of tests to disable.
+      check_level: One of CHECK_LEVELS. Below the full level, the payload
+        signatures are not verified and the caller is responsible for doing
+        so if needed, e.g. using CheckPayloadSignatures().
+      sample_fraction: Fraction of the data blobs to verify at the sampled
+        check level.
+      sample_seed: Seed for picking the data blobs to verify at the sampled
+        check level (default: random).
+      hash_workers: Number of threads reading and hashing data blobs ahead of
+        the operation checks; blobs are hashed inline if less than two.
     """
     if not payload.is_init:
       raise ValueError('Uninitialized update payload.')
@@ -319,6 +515,15 @@ class PayloadChecker(object):
                                assert_type)
     self.payload_type = assert_type
     self.allow_unhashed = allow_unhashed
+    if check_level not in CHECK_LEVELS:
+      raise error.PayloadError('Invalid check_level value (%r).' % check_level)
+    if not 0 <= sample_fraction <= 1:
+      raise error.PayloadError('Invalid sample_fraction value (%r).' %
+                               sample_fraction)
+    self.check_level = check_level
+    self.sample_fraction = sample_fraction
+    self.sample_random = random.Random(sample_seed)
+    self.hash_workers = hash_workers
 
     # Disable specific tests.
     self.check_move_same_src_dst_block = (
@@ -334,6 +539,13 @@ class PayloadChecker(object):
     self.old_fs_sizes = collections.defaultdict(int)
     self.minor_version = None
     self.major_version = None
+    # Hash of the payload data read so far, and the amount of data hashed.
+    self.payload_hasher = None
+    self.payload_hashed_size = 0
+    # Number of data blobs whose hashes were verified.
+    self.num_blobs_verified = 0
+    # Public keys loaded so far, by file name.
+    self.pubkeys = {}
 
   @staticmethod
   def _CheckElem(msg, name, report, is_mandatory, is_submsg, convert=str,
@@ -477,32 +689,23 @@ class PayloadChecker(object):
       raise error.PayloadError('%r is not present in all values%s.' %
                                (name, ' in ' + obj_name if obj_name else ''))
 
-  @staticmethod
-  def _Run(cmd, send_data=None):
-    """Runs a subprocess, returns its output.
+  def _LoadPublicKey(self, pubkey_file_name):
+    """Returns a public key, loading it the first time it is used.
 
     Args:
-      cmd: Sequence of command-line argument for invoking the subprocess.
-      send_data: Data to feed to the process via its stdin.
+      pubkey_file_name: Public key used for verifying signatures.
 
-    Returns:
-      A tuple containing the stdout and stderr output of the process.
+    Raises:
+      error.PayloadError if the public key could not be loaded.
     """
-    run_process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
-                                   stdout=subprocess.PIPE)
-    try:
-      result = run_process.communicate(input=send_data)
-    finally:
-      exit_code = run_process.wait()
-
-    if exit_code:
-      raise RuntimeError('Subprocess %r failed with code %r.' %
-                         (cmd, exit_code))
-
-    return result
-
-  @staticmethod
-  def _CheckSha256Signature(sig_data, pubkey_file_name, actual_hash, sig_name):
+    key = self.pubkeys.get(pubkey_file_name)
+    if key is None:
+      key = pubkey.LoadPublicKey(pubkey_file_name)
+      self.pubkeys[pubkey_file_name] = key
+    return key
+
+  def _CheckSha256Signature(self, sig_data, pubkey_file_name, actual_hash,
+                            sig_name):
     """Verifies an actual hash against a signed one.
 
     Args:
@@ -518,9 +721,10 @@ class PayloadChecker(object):
       raise error.PayloadError(
           '%s: signature size (%d) not as expected (256).' %
           (sig_name, len(sig_data)))
-    signed_data, _ = PayloadChecker._Run(
-        ['openssl', 'rsautl', '-verify', '-pubin', '-inkey', pubkey_file_name],
-        send_data=sig_data)
+    try:
+      signed_data = self._LoadPublicKey(pubkey_file_name).Recover(sig_data)
+    except error.PayloadError as e:
+      raise error.PayloadError('%s: %s' % (sig_name, e))
 
     if len(signed_data) != len(common.SIG_ASN1_HEADER) + 32:
       raise error.PayloadError('%s: unexpected signed data length (%d).' %
@@ -714,7 +918,7 @@ class PayloadChecker(object):
     Args:
       extents: The sequence of extents to check.
       usable_size: The usable size of the partition to which the extents apply.
-      block_counters: Array of counters corresponding to the number of blocks.
+      block_counters: The _BlockCounters to record block usage in.
       name: The name of the extent block.
 
     Returns:
@@ -743,8 +947,7 @@ class PayloadChecker(object):
             (ex_name, common.FormatExtent(ex, self.block_size), usable_size))
 
       # Record block usage.
-      for i in range(start_block, end_block):
-        block_counters[i] += 1
+      block_counters.AddExtent(start_block, num_blocks)
 
       total_num_blocks += num_blocks
 
@@ -882,18 +1085,24 @@ class PayloadChecker(object):
 
   def _CheckOperation(self, op, op_name, old_block_counters, new_block_counters,
                       old_usable_size, new_usable_size, prev_data_offset,
-                      blob_hash_counts):
+                      blob_hash_counts, verify_blob=True,
+                      get_blob_hash=None):
     """Checks a single update operation.
 
     Args:
       op: The operation object.
       op_name: Operation name string for error reporting.
-      old_block_counters: Arrays of block read counters.
-      new_block_counters: Arrays of block write counters.
+      old_block_counters: Block read counters.
+      new_block_counters: Block write counters.
       old_usable_size: The overall usable size for src data in bytes.
       new_usable_size: The overall usable size for dst data in bytes.
       prev_data_offset: Offset of last used data bytes.
       blob_hash_counts: Counters for hashed/unhashed blobs.
+      verify_blob: Whether to read the data blob to verify its hash.
+      get_blob_hash: A function returning the data blob of the operation and
+        its hash digest, read ahead, or None to read the blob here. Errors
+        reading the blob are raised by the function, so they are reported
+        after the other checks of the operation as when reading it here.
 
     Returns:
       The amount of data blob associated with the operation.
@@ -935,13 +1144,19 @@ class PayloadChecker(object):
             op_name)
 
       # Check: Hash verifies correctly.
-      actual_hash = hashlib.sha256(self.payload.ReadDataBlob(data_offset,
-                                                             data_length))
-      if op.data_sha256_hash != actual_hash.digest():
-        raise error.PayloadError(
-            '%s: data_sha256_hash (%s) does not match actual hash (%s).' %
-            (op_name, common.FormatSha256(op.data_sha256_hash),
-             common.FormatSha256(actual_hash.digest())))
+      if verify_blob:
+        if get_blob_hash is None:
+          data, actual_hash = self._ReadAndHashBlob(data_offset, data_length)
+        else:
+          data, actual_hash = get_blob_hash()
+        if op.data_sha256_hash != actual_hash:
+          raise error.PayloadError(
+              '%s: data_sha256_hash (%s) does not match actual hash (%s).' %
+              (op_name, common.FormatSha256(op.data_sha256_hash),
+               common.FormatSha256(actual_hash)))
+        self.num_blobs_verified += 1
+        if self.check_level == CHECK_LEVEL_FULL:
+          self._HashPayloadData(data_offset, data)
     elif data_offset is not None:
       if self.allow_unhashed:
         blob_hash_counts['unhashed'] += 1
@@ -981,25 +1196,71 @@ class PayloadChecker(object):
           (op_name, op.type, self.minor_version))
     return data_length if data_length is not None else 0
 
+  def _SampleBlob(self):
+    """Returns whether to verify the data blob of the next operation.
+
+    This is called once per operation, in order, so that a seeded checker
+    picks the same blobs regardless of how they are hashed.
+    """
+    if self.check_level == CHECK_LEVEL_FULL:
+      return True
+    if self.check_level == CHECK_LEVEL_METADATA:
+      return False
+    return self.sample_random.random() < self.sample_fraction
+
+  def _ReadAndHashBlob(self, data_offset, data_length):
+    """Reads a data blob, returning it and its hash digest."""
+    data = self.payload.ReadDataBlob(data_offset, data_length)
+    return data, hashlib.sha256(data).digest()
+
+  def _HashBlobsAhead(self, operations, worker_pool):
+    """Reads and hashes the data blobs of operations on a pool of threads.
+
+    hashlib releases the GIL while hashing, so blobs get hashed in parallel.
+    The number of blobs read ahead is bounded to keep memory use in check.
+
+    Args:
+      operations: The sequence of operations.
+      worker_pool: The thread pool to read and hash blobs on.
+
+    Yields:
+      For each operation in order, a pair consisting of whether to verify its
+      data blob and, if so and it has a data hash, a function returning the
+      (data, digest) pair of the blob or raising the error reading it, None
+      otherwise.
+    """
+    pending = collections.deque()
+    max_pending = self.hash_workers * _HASH_AHEAD_PER_WORKER
+    for op in operations:
+      verify_blob = self._SampleBlob()
+      if (verify_blob and op.HasField('data_sha256_hash') and
+          op.HasField('data_offset') and op.HasField('data_length')):
+        pending.append((verify_blob, worker_pool.apply_async(
+            self._ReadAndHashBlob, (op.data_offset, op.data_length))))
+      else:
+        pending.append((verify_blob, None))
+      if len(pending) >= max_pending:
+        verify_blob, result = pending.popleft()
+        yield verify_blob, result and result.get
+    while pending:
+      verify_blob, result = pending.popleft()
+      yield verify_blob, result and result.get
+
   def _SizeToNumBlocks(self, size):
     """Returns the number of blocks needed to contain a given byte size."""
     return (size + self.block_size - 1) // self.block_size
 
   def _AllocBlockCounters(self, total_size):
-    """Returns a freshly initialized array of block counters.
-
-    Note that the generated array is not portable as is due to byte-ordering
-    issues, hence it should not be serialized.
+    """Returns freshly initialized block counters.
 
     Args:
       total_size: The total block size in bytes.
 
     Returns:
-      An array of unsigned short elements initialized to zero, one for each of
-      the blocks necessary for containing the partition.
+      A _BlockCounters object with all counts at zero, for each of the blocks
+      necessary for containing the partition.
     """
-    return array.array('H',
-                       itertools.repeat(0, self._SizeToNumBlocks(total_size)))
+    return _BlockCounters(self._SizeToNumBlocks(total_size))
 
   def _CheckOperations(self, operations, report, base_name, old_fs_size,
                        new_fs_size, old_usable_size, new_usable_size,
@@ -1056,23 +1317,41 @@ class PayloadChecker(object):
                           if old_fs_size else None)
     new_block_counters = self._AllocBlockCounters(new_usable_size)
 
+    # Hash data blobs ahead of the checks, if so configured.
+    worker_pool = blob_hashes = None
+    if self.check_level != CHECK_LEVEL_METADATA and self.hash_workers > 1:
+      worker_pool = multiprocessing_pool.ThreadPool(
+          processes=self.hash_workers)
+      blob_hashes = self._HashBlobsAhead(operations, worker_pool)
+
     # Process and verify each operation.
     op_num = 0
-    for op, op_name in common.OperationIter(operations, base_name):
-      op_num += 1
-
-      # Check: Type is valid.
-      if op.type not in op_counts:
-        raise error.PayloadError('%s: invalid type (%d).' % (op_name, op.type))
-      op_counts[op.type] += 1
-
-      curr_data_used = self._CheckOperation(
-          op, op_name, old_block_counters, new_block_counters,
-          old_usable_size, new_usable_size,
-          prev_data_offset + total_data_used, blob_hash_counts)
-      if curr_data_used:
-        op_blob_totals[op.type] += curr_data_used
-        total_data_used += curr_data_used
+    try:
+      for op, op_name in common.OperationIter(operations, base_name):
+        op_num += 1
+        if blob_hashes:
+          verify_blob, get_blob_hash = next(blob_hashes)
+        else:
+          verify_blob, get_blob_hash = self._SampleBlob(), None
+
+        # Check: Type is valid.
+        if op.type not in op_counts:
+          raise error.PayloadError('%s: invalid type (%d).' %
+                                   (op_name, op.type))
+        op_counts[op.type] += 1
+
+        curr_data_used = self._CheckOperation(
+            op, op_name, old_block_counters, new_block_counters,
+            old_usable_size, new_usable_size,
+            prev_data_offset + total_data_used, blob_hash_counts,
+            verify_blob=verify_blob, get_blob_hash=get_blob_hash)
+        if curr_data_used:
+          op_blob_totals[op.type] += curr_data_used
+          total_data_used += curr_data_used
+    finally:
+      if worker_pool:
+        worker_pool.terminate()
+        worker_pool.join()
 
     # Report totals and breakdown statistics.
     report.AddField('total operations', op_num)
@@ -1096,11 +1375,12 @@ class PayloadChecker(object):
     # Report read/write histograms.
     if old_block_counters:
       report.AddField('block read hist',
-                      histogram.Histogram.FromKeyList(old_block_counters),
+                      histogram.Histogram.FromCountDict(
+                          old_block_counters.GetCountDict()),
                       linebreak=True, indent=1)
 
-    new_write_hist = histogram.Histogram.FromKeyList(
-        new_block_counters[:self._SizeToNumBlocks(new_fs_size)])
+    new_write_hist = histogram.Histogram.FromCountDict(
+        new_block_counters.GetCountDict(self._SizeToNumBlocks(new_fs_size)))
     report.AddField('block write hist', new_write_hist, linebreak=True,
                     indent=1)
 
@@ -1112,11 +1392,57 @@ class PayloadChecker(object):
 
     return total_data_used
 
-  def _CheckSignatures(self, report, pubkey_file_name):
-    """Checks a payload's signature block."""
+  def _HashPayloadData(self, data_offset, data):
+    """Passes a data blob through the payload hash, if it is next in line.
+
+    Blobs are checked in the order they appear in the payload, so the hash of
+    the data preceding the signatures is mostly computed from them, sparing
+    the signature check from reading the data a second time.
+
+    Args:
+      data_offset: The offset of the blob in the data section.
+      data: The blob's content.
+    """
+    if self.payload_hasher is None:
+      self.payload_hasher = self.payload.manifest_hasher.copy()
+    if data_offset == self.payload_hashed_size:
+      self.payload_hasher.update(data)
+      self.payload_hashed_size += len(data)
+
+  def _PayloadHash(self):
+    """Returns the hash digest of the payload up to the signature blob.
+
+    Whatever data was not hashed while checking the operations is read and
+    hashed a chunk at a time, so that memory use does not grow with the
+    payload size.
+    """
+    if (self.payload_hasher is None or
+        self.payload_hashed_size > self.sigs_offset):
+      self.payload_hasher = self.payload.manifest_hasher.copy()
+      self.payload_hashed_size = 0
+    while self.payload_hashed_size < self.sigs_offset:
+      length = min(self.sigs_offset - self.payload_hashed_size,
+                   _SIG_HASH_CHUNK_SIZE)
+      self.payload_hasher.update(
+          self.payload.ReadDataBlob(self.payload_hashed_size, length))
+      self.payload_hashed_size += length
+    return self.payload_hasher.digest()
+
+  def _CheckSignatures(self, report, pubkey_file_name, payload_hash=None):
+    """Checks a payload's signature block.
+
+    Args:
+      report: The report object to add to.
+      pubkey_file_name: Public key used for signature verification.
+      payload_hash: The hash digest of the payload up to the signature blob,
+        if already computed (optional).
+
+    Raises:
+      error.PayloadError if the signatures could not be verified.
+    """
     sigs_raw = self.payload.ReadDataBlob(self.sigs_offset, self.sigs_size)
     sigs = update_metadata_pb2.Signatures()
-    sigs.ParseFromString(sigs_raw)
+    sigs.ParseFromString(bytes(sigs_raw))
     report.AddSection('signatures')
 
     # Check: At least one signature present.
@@ -1136,13 +1462,8 @@ class PayloadChecker(object):
                                  'signature blob. This is an invalid payload.')
 
     # Compute the checksum of all data up to signature blob.
-    # TODO(garnold) we're re-reading the whole data section into a string
-    # just to compute the checksum; instead, we could do it incrementally as
-    # we read the blobs one-by-one, under the assumption that we're reading
-    # them in order (which currently holds). This should be reconsidered.
-    payload_hasher = self.payload.manifest_hasher.copy()
-    common.Read(self.payload.payload_file, self.sigs_offset,
-                offset=self.payload.data_offset, hasher=payload_hasher)
+    if payload_hash is None:
+      payload_hash = self._PayloadHash()
 
     for sig, sig_name in common.SignatureIter(sigs.signatures, 'signatures'):
       sig_report = report.AddSubReport(sig_name)
@@ -1154,14 +1475,45 @@ class PayloadChecker(object):
 
       # Check: Signatures pertains to actual payload hash.
       if sig.version == 1:
-        self._CheckSha256Signature(sig.data, pubkey_file_name,
-                                   payload_hasher.digest(), sig_name)
+        self._CheckSha256Signature(sig.data, pubkey_file_name, payload_hash,
+                                   sig_name)
       else:
         raise error.PayloadError('Unknown signature version (%d).' %
                                  sig.version)
 
+  def CheckPayloadSignatures(self, payload_hash, pubkey_file_name=None,
+                             report_out_file=None,
+                             report_format=REPORT_FORMAT_TEXT):
+    """Checks the payload signatures against an already computed hash.
+
+    This completes a run below the full check level, once the caller is done
+    hashing the payload data.
+
+    Args:
+      payload_hash: The hash digest of the payload up to the signature blob.
+      pubkey_file_name: Public key used for signature verification.
+      report_out_file: File object to dump the report to.
+      report_format: One of REPORT_FORMATS.
+
+    Raises:
+      error.PayloadError if the signatures could not be verified.
+    """
+    if not pubkey_file_name:
+      pubkey_file_name = _DEFAULT_PUBKEY_FILE_NAME
+
+    report = _PayloadReport(stream_file=report_out_file,
+                            report_format=report_format)
+    try:
+      self._CheckSignatures(report, pubkey_file_name,
+                            payload_hash=payload_hash)
+      report.Finalize()
+    finally:
+      if report_out_file:
+        report.Dump(report_out_file)
+
   def Run(self, pubkey_file_name=None, metadata_sig_file=None, metadata_size=0,
-          part_sizes=None, report_out_file=None):
+          part_sizes=None, report_out_file=None, payload_size=None,
+          report_format=REPORT_FORMAT_TEXT):
     """Checker entry point, invoking all checks.
 
     Args:
@@ -1171,6 +1523,11 @@ class PayloadChecker(object):
       part_sizes: Mapping of partition label to size in bytes (default: infer
         based on payload type and version or filesystem).
       report_out_file: File object to dump the report to.
+      payload_size: Expected size of the payload in bytes (default: the size
+        of the payload file). This allows checking payloads of which only the
+        metadata has been fetched so far, at the metadata check level.
+      report_format: One of REPORT_FORMATS. Report sections are written to
+        report_out_file as soon as they are complete.
 
     Raises:
       error.PayloadError if payload verification failed.
@@ -1178,12 +1535,14 @@ class PayloadChecker(object):
     if not pubkey_file_name:
       pubkey_file_name = _DEFAULT_PUBKEY_FILE_NAME
 
-    report = _PayloadReport()
+    report = _PayloadReport(stream_file=report_out_file,
+                            report_format=report_format)
 
     # Get payload file size.
-    self.payload.payload_file.seek(0, 2)
-    payload_file_size = self.payload.payload_file.tell()
-    self.payload.ResetFile()
+    if payload_size is None:
+      self.payload.payload_file.seek(0, 2)
+      payload_size = self.payload.payload_file.tell()
+      self.payload.ResetFile()
 
     try:
       # Check metadata_size (if provided).
@@ -1246,18 +1605,22 @@ class PayloadChecker(object):
       if self.sigs_size:
         used_payload_size += self.sigs_size
 
-      if used_payload_size != payload_file_size:
+      if used_payload_size != payload_size:
         raise error.PayloadError(
             'Used payload size (%d) different from actual file size (%d).' %
-            (used_payload_size, payload_file_size))
+            (used_payload_size, payload_size))
 
       # Part 4: Handle payload signatures message.
-      if self.check_payload_sig and self.sigs_size:
+      if (self.check_payload_sig and self.sigs_size and
+          self.check_level == CHECK_LEVEL_FULL):
         self._CheckSignatures(report, pubkey_file_name)
 
       # Part 5: Summary.
       report.AddSection('summary')
       report.AddField('update type', self.payload_type)
+      if self.check_level != CHECK_LEVEL_FULL:
+        report.AddField('check level', self.check_level)
+        report.AddField('blobs verified', self.num_blobs_verified)
 
       report.Finalize()
     finally:
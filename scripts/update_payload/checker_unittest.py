@@ -22,20 +22,24 @@
 
 from __future__ import absolute_import
 
-import array
+import base64
 import collections
 import hashlib
 import io
 import itertools
+import json
 import os
+import random
 import unittest
 
+import six
 from six.moves import zip
 
 import mock  # pylint: disable=import-error
 
 from update_payload import checker
 from update_payload import common
+from update_payload import histogram
 from update_payload import test_utils
 from update_payload import update_metadata_pb2
 from update_payload.error import PayloadError
@@ -140,6 +144,7 @@ class PayloadCheckerTest(unittest.TestCase):
     payload.is_init = True
     payload.manifest = mock.create_autospec(
         update_metadata_pb2.DeltaArchiveManifest)
+    payload.manifest_hasher = hashlib.sha256()
     return payload
 
   @staticmethod
@@ -316,35 +321,62 @@ class PayloadCheckerTest(unittest.TestCase):
     self.assertRaises(PayloadError, checker.PayloadChecker._CheckPresentIff,
                       None, 'b', 'foo', 'bar', 'baz')
 
-  def DoCheckSha256SignatureTest(self, expect_pass, expect_subprocess_call,
+  def DoCheckSha256SignatureTest(self, expect_pass, expect_recover_call,
                                  sig_data, sig_asn1_header,
                                  returned_signed_hash, expected_signed_hash):
     """Parametric testing of _CheckSha256SignatureTest().
 
     Args:
       expect_pass: Whether or not it should pass.
-      expect_subprocess_call: Whether to expect the openssl call to happen.
+      expect_recover_call: Whether to expect the signed data to be recovered.
       sig_data: The signature raw data.
       sig_asn1_header: The ASN1 header.
-      returned_signed_hash: The signed hash data retuned by openssl.
+      returned_signed_hash: The signed hash data recovered from the signature.
       expected_signed_hash: The signed hash data to compare against.
     """
-    # Stub out the subprocess invocation.
-    with mock.patch.object(checker.PayloadChecker, '_Run') \
-         as mock_payload_checker:
-      if expect_subprocess_call:
-        mock_payload_checker([], send_data=sig_data)
-        mock_payload_checker.return_value = (
-            sig_asn1_header + returned_signed_hash, None)
+    payload_checker = checker.PayloadChecker(self.MockPayload())
+
+    # Stub out the public key.
+    with mock.patch.object(checker.pubkey, 'LoadPublicKey') \
+         as mock_load_public_key:
+      mock_key = mock_load_public_key.return_value
+      mock_key.Recover.return_value = sig_asn1_header + returned_signed_hash
 
       if expect_pass:
-        self.assertIsNone(checker.PayloadChecker._CheckSha256Signature(
+        self.assertIsNone(payload_checker._CheckSha256Signature(
             sig_data, 'foo', expected_signed_hash, 'bar'))
       else:
         self.assertRaises(PayloadError,
-                          checker.PayloadChecker._CheckSha256Signature,
+                          payload_checker._CheckSha256Signature,
                           sig_data, 'foo', expected_signed_hash, 'bar')
 
+      if expect_recover_call:
+        mock_load_public_key.assert_called_once_with('foo')
+        mock_key.Recover.assert_called_once_with(sig_data)
+      else:
+        self.assertFalse(mock_key.Recover.called)
+
+  def testCheckSha256Signature_Real(self):
+    """Tests _CheckSha256Signature() with actual signatures."""
+    payload_checker = checker.PayloadChecker(self.MockPayload())
+    signed_hash = hashlib.sha256(b'fake-data').digest()
+    sig_data = test_utils.SignSha256(b'fake-data',
+                                     test_utils._PRIVKEY_FILE_NAME)
+    with mock.patch.object(checker.pubkey, 'LoadPublicKey',
+                           wraps=checker.pubkey.LoadPublicKey) \
+         as mock_load_public_key:
+      for _ in range(2):
+        self.assertIsNone(payload_checker._CheckSha256Signature(
+            sig_data, test_utils._PUBKEY_FILE_NAME, signed_hash, 'bar'))
+      # The key is only loaded once.
+      mock_load_public_key.assert_called_once_with(
+          test_utils._PUBKEY_FILE_NAME)
+
+    # A signature made with another key.
+    self.assertRaises(PayloadError, payload_checker._CheckSha256Signature,
+                      sig_data, checker._DEFAULT_PUBKEY_FILE_NAME,
+                      signed_hash, 'bar')
+
   def testCheckSha256Signature_Pass(self):
     """Tests _CheckSha256Signature(); pass case."""
     sig_data = 'fake-signature'.ljust(256)
@@ -553,31 +585,31 @@ class PayloadCheckerTest(unittest.TestCase):
     self.assertEqual(
         23,
         payload_checker._CheckExtents(extents, (1024 + 16) * block_size,
-                                      collections.defaultdict(int), 'foo'))
+                                      checker._BlockCounters(1024 + 16), 'foo'))
 
     # Fails, extent missing a start block.
     extents = self.NewExtentList((-1, 4), (8, 3), (1024, 16))
     self.assertRaises(
         PayloadError, payload_checker._CheckExtents, extents,
-        (1024 + 16) * block_size, collections.defaultdict(int), 'foo')
+        (1024 + 16) * block_size, checker._BlockCounters(1024 + 16), 'foo')
 
     # Fails, extent missing block count.
     extents = self.NewExtentList((0, -1), (8, 3), (1024, 16))
     self.assertRaises(
         PayloadError, payload_checker._CheckExtents, extents,
-        (1024 + 16) * block_size, collections.defaultdict(int), 'foo')
+        (1024 + 16) * block_size, checker._BlockCounters(1024 + 16), 'foo')
 
     # Fails, extent has zero blocks.
     extents = self.NewExtentList((0, 4), (8, 3), (1024, 0))
     self.assertRaises(
         PayloadError, payload_checker._CheckExtents, extents,
-        (1024 + 16) * block_size, collections.defaultdict(int), 'foo')
+        (1024 + 16) * block_size, checker._BlockCounters(1024 + 16), 'foo')
 
     # Fails, extent exceeds partition boundaries.
     extents = self.NewExtentList((0, 4), (8, 3), (1024, 16))
     self.assertRaises(
         PayloadError, payload_checker._CheckExtents, extents,
-        (1024 + 15) * block_size, collections.defaultdict(int), 'foo')
+        (1024 + 15) * block_size, checker._BlockCounters(1024 + 16), 'foo')
 
   def testCheckReplaceOperation(self):
     """Tests _CheckReplaceOperation() where op.type == REPLACE."""
@@ -769,10 +801,8 @@ class PayloadCheckerTest(unittest.TestCase):
     # Create auxiliary arguments.
     old_part_size = test_utils.MiB(4)
     new_part_size = test_utils.MiB(8)
-    old_block_counters = array.array(
-        'B', [0] * ((old_part_size + block_size - 1) // block_size))
-    new_block_counters = array.array(
-        'B', [0] * ((new_part_size + block_size - 1) // block_size))
+    old_block_counters = payload_checker._AllocBlockCounters(old_part_size)
+    new_block_counters = payload_checker._AllocBlockCounters(new_part_size)
     prev_data_offset = 1876
     blob_hash_counts = collections.defaultdict(int)
 
@@ -866,14 +896,14 @@ class PayloadCheckerTest(unittest.TestCase):
                        payload_checker._CheckOperation(*args))
 
   def testAllocBlockCounters(self):
-    """Tests _CheckMoveOperation()."""
+    """Tests _AllocBlockCounters()."""
     payload_checker = checker.PayloadChecker(self.MockPayload())
     block_size = payload_checker.block_size
 
-    # Check allocation for block-aligned partition size, ensure it's integers.
+    # Check allocation for block-aligned partition size, all counts at zero.
     result = payload_checker._AllocBlockCounters(16 * block_size)
     self.assertEqual(16, len(result))
-    self.assertEqual(int, type(result[0]))
+    self.assertEqual({0: 16}, result.GetCountDict())
 
     # Check allocation of unaligned partition sizes.
     result = payload_checker._AllocBlockCounters(16 * block_size - 1)
@@ -881,6 +911,94 @@ class PayloadCheckerTest(unittest.TestCase):
     result = payload_checker._AllocBlockCounters(16 * block_size + 1)
     self.assertEqual(17, len(result))
 
+  @staticmethod
+  def _FillReport(report):
+    """Adds a few sections to a report."""
+    report.AddField('untitled', 1)
+    report.AddSection('first')
+    report.AddField('a', 'b')
+    report.AddField('longer name', 2)
+    sub_report = report.AddSubReport('sub')
+    sub_report.AddField('c', 3)
+    report.AddSection('second')
+    report.AddField(None, histogram.Histogram([('x', 1), ('y', 3)]))
+
+  def testPayloadReportStreaming(self):
+    """Tests streaming report sections as they are completed."""
+    report = checker._PayloadReport()
+    self._FillReport(report)
+    report.Finalize()
+    dump_file = six.StringIO()
+    report.Dump(dump_file)
+
+    # Only the last section is kept in memory.
+    stream_file = six.StringIO()
+    report = checker._PayloadReport(stream_file=stream_file)
+    self._FillReport(report)
+    self.assertEqual(
+        'untitled : 1\n'
+        '=== first ===\n'
+        'a           : b\n'
+        'longer name : 2\n'
+        'sub =>\n'
+        '  c : 3\n', stream_file.getvalue())
+    self.assertEqual(2, len(report.report))
+    report.Finalize()
+    report.Dump(stream_file)
+    self.assertEqual(dump_file.getvalue(), stream_file.getvalue())
+
+    # Incomplete reports are marked as such, even if partly streamed.
+    stream_file = six.StringIO()
+    report = checker._PayloadReport(stream_file=stream_file)
+    self._FillReport(report)
+    report.Dump(stream_file)
+    self.assertTrue(stream_file.getvalue().endswith(
+        '=== second ===\n'
+        'x |#####               | 1 (25%)\n'
+        'y |###############     | 3 (75%)\n'
+        '(incomplete report)\n'))
+
+  def testPayloadReportJson(self):
+    """Tests writing a report with a JSON object for each section."""
+    self.assertRaises(PayloadError, checker._PayloadReport,
+                      report_format='xml')
+    for stream in (False, True):
+      out_file = six.StringIO()
+      report = checker._PayloadReport(
+          stream_file=out_file if stream else None,
+          report_format=checker.REPORT_FORMAT_JSON)
+      self._FillReport(report)
+      report.Dump(out_file)
+      self.assertEqual([
+          {'section': None, 'fields': [{'name': 'untitled', 'value': 1}]},
+          {'section': 'first', 'fields': [
+              {'name': 'a', 'value': 'b'},
+              {'name': 'longer name', 'value': 2},
+              {'name': 'sub', 'report': [
+                  {'section': None,
+                   'fields': [{'name': 'c', 'value': 3}]}]}]},
+          {'section': 'second', 'fields': [
+              {'name': None,
+               'value': {'total': 4, 'counts': [['x', 1], ['y', 3]]}}]},
+          {'complete': False},
+      ], [json.loads(line) for line in out_file.getvalue().splitlines()])
+
+  def testBlockCounters(self):
+    """Tests counting block usage with _BlockCounters."""
+    block_counters = checker._BlockCounters(16)
+    for start_block, num_blocks in ((4, 4), (6, 4), (0, 2), (8, 2)):
+      block_counters.AddExtent(start_block, num_blocks)
+    self.assertEqual([(1, 2), (0, 2), (1, 2), (2, 2), (2, 2), (0, 6)],
+                     list(block_counters.CountRuns()))
+    self.assertEqual([(1, 2), (0, 2), (1, 2), (2, 1)],
+                     list(block_counters.CountRuns(7)))
+    self.assertEqual([(1, 4), (0, 8), (2, 4)],
+                     list(block_counters.GetCountDict().items()))
+    self.assertEqual({1: 2}, block_counters.GetCountDict(2))
+    self.assertEqual(16, len(block_counters))
+    self.assertEqual([(0, 16)],
+                     list(checker._BlockCounters(16).CountRuns(32)))
+
   def DoCheckOperationsTest(self, fail_nonexhaustive_full_update):
     """Tests _CheckOperations()."""
     # Generate a test payload. For this test, we only care about one
@@ -921,6 +1039,203 @@ class PayloadCheckerTest(unittest.TestCase):
       self.assertEqual(rootfs_data_length,
                        payload_checker._CheckOperations(*args))
 
+  def testCheckOperationsHashWorkers(self):
+    """Tests _CheckOperations() hashing blobs on worker threads."""
+    block_size = test_utils.KiB(4)
+    payload_gen = test_utils.EnhancedPayloadGenerator()
+    payload_gen.SetBlockSize(block_size)
+    num_ops = 20
+    rootfs_part_size = num_ops * block_size
+    payload_gen.SetPartInfo(common.ROOTFS, True, rootfs_part_size,
+                            hashlib.sha256(b'fake-new-rootfs-content').digest())
+    for i in range(num_ops):
+      payload_gen.AddOperationWithData(
+          common.ROOTFS, common.OpType.REPLACE, dst_extents=[(i, 1)],
+          data_blob=os.urandom(block_size), do_hash_data_blob=i % 3 != 0)
+    payload_file = io.BytesIO()
+    payload_gen.WriteToFileWithData(payload_file)
+
+    def _Check(payload_data, hash_workers, new_usable_size=rootfs_part_size):
+      payload = Payload(io.BytesIO(payload_data))
+      payload.Init()
+      payload_checker = checker.PayloadChecker(
+          payload, allow_unhashed=True, hash_workers=hash_workers)
+      payload_checker.payload_type = checker._TYPE_FULL
+      payload_checker.minor_version = 0
+      partition = payload.manifest.partitions[0]
+      return payload_checker._CheckOperations(
+          partition.operations, checker._PayloadReport(), 'foo', 0,
+          rootfs_part_size, rootfs_part_size, new_usable_size, 0)
+
+    payload_data = payload_file.getvalue()
+    for hash_workers in (0, 4):
+      self.assertEqual(rootfs_part_size, _Check(payload_data, hash_workers))
+
+    # Corrupt the blobs of two hashed operations; the first one is reported.
+    payload = Payload(io.BytesIO(payload_data))
+    payload.Init()
+    payload_data = bytearray(payload_data)
+    for i in (13, 7):
+      payload_data[payload.data_offset + i * block_size] ^= 1
+    for hash_workers in (0, 4):
+      with self.assertRaises(PayloadError) as cm:
+        _Check(bytes(payload_data), hash_workers)
+      self.assertIn('foo[8](REPLACE): data_sha256_hash', str(cm.exception))
+
+    # Errors reading blobs ahead are reported after the other errors of
+    # their operation, as when reading blobs in turn.
+    with mock.patch.object(Payload, 'ReadDataBlob',
+                           side_effect=PayloadError('read error')):
+      for hash_workers in (0, 4):
+        with self.assertRaises(PayloadError) as cm:
+          _Check(bytes(payload_data), hash_workers,
+                 new_usable_size=block_size)
+        self.assertIn('foo[2](REPLACE).dst_extents', str(cm.exception))
+
+  def testCheckOperationsCheckLevels(self):
+    """Tests _CheckOperations() verifying none, some or all of the blobs."""
+    block_size = test_utils.KiB(4)
+    payload_gen = test_utils.EnhancedPayloadGenerator()
+    payload_gen.SetBlockSize(block_size)
+    num_ops = 20
+    rootfs_part_size = num_ops * block_size
+    payload_gen.SetPartInfo(common.ROOTFS, True, rootfs_part_size,
+                            hashlib.sha256(b'fake-new-rootfs-content').digest())
+    for i in range(num_ops):
+      payload_gen.AddOperationWithData(
+          common.ROOTFS, common.OpType.REPLACE, dst_extents=[(i, 1)],
+          data_blob=os.urandom(block_size))
+    payload_file = io.BytesIO()
+    payload_gen.WriteToFileWithData(payload_file)
+    payload_data = bytearray(payload_file.getvalue())
+
+    # Corrupt the blob of the last operation.
+    payload = Payload(io.BytesIO(bytes(payload_data)))
+    payload.Init()
+    payload_data[payload.data_offset + (num_ops - 1) * block_size] ^= 1
+
+    def _Check(hash_workers=0, **checker_dargs):
+      payload = Payload(io.BytesIO(bytes(payload_data)))
+      payload.Init()
+      payload_checker = checker.PayloadChecker(
+          payload, hash_workers=hash_workers, **checker_dargs)
+      payload_checker.payload_type = checker._TYPE_FULL
+      payload_checker.minor_version = 0
+      partition = payload.manifest.partitions[0]
+      with mock.patch.object(payload, 'ReadDataBlob',
+                             wraps=payload.ReadDataBlob) as read_data_blob:
+        payload_checker._CheckOperations(
+            partition.operations, checker._PayloadReport(), 'foo', 0,
+            rootfs_part_size, rootfs_part_size, rootfs_part_size, 0)
+      self.assertEqual(read_data_blob.call_count,
+                       payload_checker.num_blobs_verified)
+      return payload_checker.num_blobs_verified
+
+    # No blob is read at the metadata level.
+    for hash_workers in (0, 4):
+      self.assertEqual(0, _Check(hash_workers=hash_workers,
+                                 check_level=checker.CHECK_LEVEL_METADATA))
+
+    # A seeded sample picks the same blobs, however they are hashed.
+    sample_rand = random.Random(3)
+    is_sampled = [sample_rand.random() < 0.5 for _ in range(num_ops)]
+    self.assertFalse(is_sampled[-1])
+    for hash_workers in (0, 4):
+      self.assertEqual(
+          sum(is_sampled),
+          _Check(hash_workers=hash_workers,
+                 check_level=checker.CHECK_LEVEL_SAMPLED,
+                 sample_fraction=0.5, sample_seed=3))
+
+    # Sampling every blob, or checking them all, finds the corrupt one.
+    for checker_dargs in ({'check_level': checker.CHECK_LEVEL_SAMPLED,
+                           'sample_fraction': 1},
+                          {'check_level': checker.CHECK_LEVEL_FULL}):
+      with self.assertRaises(PayloadError) as cm:
+        _Check(**checker_dargs)
+      self.assertIn('foo[20](REPLACE): data_sha256_hash', str(cm.exception))
+
+    self.assertRaises(PayloadError, _Check, check_level='bogus')
+    self.assertRaises(PayloadError, _Check,
+                      check_level=checker.CHECK_LEVEL_SAMPLED,
+                      sample_fraction=2)
+
+  @staticmethod
+  def _GetSignedPayloadData():
+    """Returns a small signed payload, and its metadata."""
+    payload_gen = test_utils.EnhancedPayloadGenerator()
+    block_size = test_utils.KiB(4)
+    payload_gen.SetBlockSize(block_size)
+    payload_gen.SetPartInfo(common.ROOTFS, True, block_size,
+                            hashlib.sha256(b'fake-new-rootfs-content').digest())
+    payload_gen.SetPartInfo(common.KERNEL, True, block_size,
+                            hashlib.sha256(b'fake-new-kernel-content').digest())
+    payload_gen.SetMinorVersion(0)
+    for part in (common.ROOTFS, common.KERNEL):
+      payload_gen.AddOperationWithData(
+          part, common.OpType.REPLACE, dst_extents=[(0, 1)],
+          data_blob=os.urandom(block_size))
+    payload_file = io.BytesIO()
+    payload_gen.WriteToFileWithData(
+        payload_file, privkey_file_name=test_utils._PRIVKEY_FILE_NAME)
+    payload_data = payload_file.getvalue()
+    payload = Payload(io.BytesIO(payload_data))
+    payload.Init()
+    return payload_data, payload_data[:payload.data_offset]
+
+  def testRunMetadataOnly(self):
+    """Tests Run() on a payload of which only the metadata is available."""
+    payload_data, metadata = self._GetSignedPayloadData()
+
+    def _Run(check_level, **run_dargs):
+      payload = Payload(io.BytesIO(metadata))
+      payload.Init()
+      report_file = six.StringIO()
+      checker.PayloadChecker(payload, check_level=check_level).Run(
+          pubkey_file_name=test_utils._PUBKEY_FILE_NAME,
+          report_out_file=report_file, **run_dargs)
+      return report_file.getvalue()
+
+    report = _Run(checker.CHECK_LEVEL_METADATA, payload_size=len(payload_data))
+    self.assertIn('blobs verified : 0\n', report)
+    self.assertRaises(PayloadError, _Run, checker.CHECK_LEVEL_METADATA)
+    self.assertRaises(PayloadError, _Run, checker.CHECK_LEVEL_METADATA,
+                      payload_size=len(payload_data) + 1)
+    self.assertRaises(PayloadError, _Run, checker.CHECK_LEVEL_FULL,
+                      payload_size=len(payload_data))
+
+  def testCheckMetadataOnlyPayload(self):
+    """Tests checking a payload object created from metadata only."""
+    payload_data, metadata = self._GetSignedPayloadData()
+    metadata_sig = base64.b64encode(
+        test_utils.SignSha256(metadata, test_utils._PRIVKEY_FILE_NAME))
+
+    def _Check(**check_dargs):
+      payload = Payload(io.BytesIO(metadata), metadata_only=True)
+      payload.Init()
+      payload.Check(pubkey_file_name=test_utils._PUBKEY_FILE_NAME,
+                    metadata_size=len(metadata), **check_dargs)
+
+    _Check(payload_size=len(payload_data),
+           metadata_sig_file=io.BytesIO(metadata_sig))
+    _Check(payload_size=len(payload_data),
+           check_level=checker.CHECK_LEVEL_METADATA)
+    self.assertRaises(PayloadError, _Check)
+    self.assertRaises(PayloadError, _Check, payload_size=len(payload_data) - 1)
+    self.assertRaises(PayloadError, _Check, payload_size=len(payload_data),
+                      check_level=checker.CHECK_LEVEL_SAMPLED)
+    self.assertRaises(PayloadError, _Check, payload_size=len(payload_data),
+                      metadata_sig_file=io.BytesIO(base64.b64encode(
+                          test_utils.SignSha256(
+                              metadata[:-1], test_utils._PRIVKEY_FILE_NAME))))
+
+    # The data section is not available.
+    payload = Payload(io.BytesIO(metadata), metadata_only=True)
+    payload.Init()
+    self.assertIsNone(payload.metadata_signature)
+    self.assertRaises(PayloadError, payload.ReadDataBlob, 0, 1)
+    self.assertRaises(PayloadError, payload.Apply, {})
+
   def DoCheckSignaturesTest(self, fail_empty_sigs_blob, fail_sig_missing_fields,
                             fail_unknown_sig_version, fail_incorrect_sig):
     """Tests _CheckSignatures()."""
@@ -982,6 +1297,43 @@ class PayloadCheckerTest(unittest.TestCase):
     else:
       self.assertIsNone(payload_checker._CheckSignatures(*args))
 
+  def testPayloadHash(self):
+    """Tests hashing the payload from checked blobs and in chunks."""
+    payload_gen = test_utils.EnhancedPayloadGenerator()
+    payload_gen.SetBlockSize(test_utils.KiB(4))
+    payload_gen.SetPartInfo(common.ROOTFS, True, test_utils.KiB(8),
+                            hashlib.sha256(b'fake-new-rootfs-content').digest())
+    blobs = [os.urandom(test_utils.KiB(4)) for _ in range(2)]
+    for i, blob in enumerate(blobs):
+      payload_gen.AddOperationWithData(common.ROOTFS, common.OpType.REPLACE,
+                                       dst_extents=[(i, 1)], data_blob=blob)
+    payload_gen.SetSignatures(payload_gen.curr_offset, 10)
+    payload_checker = _GetPayloadChecker(
+        payload_gen.WriteToFileWithData,
+        payload_gen_dargs={'sigs_data': b'\0' * 10})
+    payload_checker.sigs_offset = 2 * len(blobs[0])
+    payload = payload_checker.payload
+    expected_hash = payload.manifest_hasher.copy()
+    expected_hash.update(b''.join(blobs))
+
+    # The first blob was checked; the rest is read a chunk at a time.
+    payload_checker._HashPayloadData(0, blobs[0])
+    with mock.patch.object(checker, '_SIG_HASH_CHUNK_SIZE', 1000), \
+         mock.patch.object(payload, 'ReadDataBlob',
+                           wraps=payload.ReadDataBlob) as read_data_blob:
+      self.assertEqual(expected_hash.digest(), payload_checker._PayloadHash())
+    self.assertEqual(5, read_data_blob.call_count)
+    read_data_blob.assert_any_call(len(blobs[0]), 1000)
+    read_data_blob.assert_called_with(len(blobs[0]) + 4000, 96)
+
+    # Blobs out of order are not used.
+    payload_checker = _GetPayloadChecker(
+        payload_gen.WriteToFileWithData,
+        payload_gen_dargs={'sigs_data': b'\0' * 10})
+    payload_checker.sigs_offset = 2 * len(blobs[0])
+    payload_checker._HashPayloadData(len(blobs[0]), blobs[1])
+    self.assertEqual(expected_hash.digest(), payload_checker._PayloadHash())
+
   def DoCheckManifestMinorVersionTest(self, minor_version, payload_type):
     """Parametric testing for CheckManifestMinorVersion().
 
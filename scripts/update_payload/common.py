@@ -140,15 +140,16 @@ def Read(file_obj, length, offset=None, hasher=None):
     else:
       file_obj.seek(offset, 2)
 
+  file_name = getattr(file_obj, 'name', '<unnamed>')
   try:
     data = file_obj.read(length)
   except IOError as e:
-    raise PayloadError('error reading from file (%s): %s' % (file_obj.name, e))
+    raise PayloadError('error reading from file (%s): %s' % (file_name, e))
 
   if len(data) != length:
     raise PayloadError(
         'reading from file (%s) too short (%d instead of %d bytes)' %
-        (file_obj.name, len(data), length))
+        (file_name, len(data), length))
 
   if hasher:
     hasher.update(data)
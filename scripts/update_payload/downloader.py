@@ -0,0 +1,994 @@
+#
+# Copyright (C) 2013 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Downloading update payloads with parallel HTTP range requests.
+
+A single TCP stream is bounded by the round-trip time of the link, so the
+payload is split into chunks fetched by a number of workers, each reusing its
+own connection. The payload metadata is fetched and checked first, so that
+a bad payload is rejected before any of its data is downloaded. Data blobs
+lying wholly within a chunk are verified against their hash as the chunk
+arrives, and the chunk fetched again if one does not match; other data is
+only checked by length. Completed chunks are recorded in a bitmap next to
+the payload file, which allows resuming an interrupted download. Chunks made
+up of data blobs found in a blob cache are not downloaded at all.
+
+  downloader = PayloadDownloader(url, file_name)
+  downloader.Download(...)
+
+"""
+
+from __future__ import absolute_import
+
+import base64
+import bisect
+import hashlib
+import io
+import os
+import re
+import socket
+import struct
+import threading
+import time
+
+from six.moves import http_client
+from six.moves import queue
+from six.moves import range
+from six.moves.urllib import parse as urllib_parse
+from six.moves.urllib import request as urllib_request
+
+from update_payload import payload as payload_lib
+from update_payload.error import PayloadError
+
+
+#
+# Constants.
+#
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_NUM_WORKERS = 4
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+DEFAULT_TIMEOUT = 60
+DEFAULT_PREFETCH_WINDOW = 8 * 1024 * 1024
+
+# Adjacent data blobs are fetched together, up to this size.
+_MAX_COALESCED_SIZE = 1024 * 1024
+
+# Amount of data downloaded between checkpoints of the chunk bitmap.
+_CHECKPOINT_SIZE = 64 * 1024 * 1024
+
+# Redirects followed when fetching a range, as `curl -L' does.
+_MAX_REDIRECTS = 5
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+# Enough of the payload to hold the header of any payload version.
+_HEADER_FETCH_SIZE = 24
+
+# Header of the chunk bitmap file: magic, version, payload size, chunk size
+# and SHA256 hash of the payload metadata.
+_BITMAP_MAGIC = b'CrDL'
+_BITMAP_VERSION = 1
+_BITMAP_HEADER_FMT = '>4sIQQ32s'
+
+_CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)$')
+
+# Names of the counters kept while downloading.
+STAT_DOWNLOADED_BYTES = 'downloaded_bytes'
+STAT_RESUMED_BYTES = 'resumed_bytes'
+STAT_RETRIES = 'retries'
+STAT_ON_DEMAND_BYTES = 'on_demand_bytes'
+STAT_CACHED_BYTES = 'cached_bytes'
+
+
+#
+# Fetching ranges.
+#
+class _RetriableError(Exception):
+  """A failure to fetch a range that may go away when trying again."""
+
+
+class _RangeFetcher(object):
+  """Fetches byte ranges of a URL over a persistent HTTP connection.
+
+  Redirects are followed, and the URL redirected to is fetched from from
+  then on. The proxies given by the *_proxy environment variables are used
+  like curl does: http URLs are requested from the proxy, https ones are
+  tunnelled through it.
+  """
+
+  def __init__(self, url, timeout):
+    """Initializes the fetcher.
+
+    Args:
+      url: the http or https URL to fetch from
+      timeout: the timeout of connecting and reading, in seconds
+
+    Raises:
+      PayloadError if the URL is not supported.
+    """
+    self._timeout = timeout
+    self._conn = None
+    self._SetUrl(url)
+
+  def _SetUrl(self, url):
+    """Sets the URL to fetch from, and how to connect to fetch it.
+
+    Args:
+      url: the http or https URL to fetch from
+
+    Raises:
+      PayloadError if the URL is not supported.
+    """
+    parts = urllib_parse.urlsplit(url)
+    if parts.scheme == 'http':
+      self._conn_class = http_client.HTTPConnection
+    elif parts.scheme == 'https':
+      self._conn_class = http_client.HTTPSConnection
+    else:
+      raise PayloadError('unsupported payload URL (%s)' % url)
+    self.url = url
+    self._netloc = parts.netloc
+    self._path = parts.path or '/'
+    if parts.query:
+      self._path += '?' + parts.query
+    self._headers = {}
+    self._tunnel = None
+
+    proxy = urllib_request.getproxies().get(parts.scheme)
+    if not proxy or urllib_request.proxy_bypass(parts.netloc):
+      return
+    if '://' not in proxy:
+      proxy = 'http://' + proxy
+    proxy_parts = urllib_parse.urlsplit(proxy)
+    proxy_headers = {}
+    if proxy_parts.username:
+      credentials = '%s:%s' % (urllib_parse.unquote(proxy_parts.username),
+                               urllib_parse.unquote(proxy_parts.password or
+                                                    ''))
+      proxy_headers['Proxy-Authorization'] = 'Basic %s' % (
+          base64.b64encode(credentials.encode('utf-8')).decode('ascii'))
+    self._netloc = proxy_parts.netloc.rpartition('@')[2]
+    if parts.scheme == 'https':
+      self._tunnel = (parts.hostname, parts.port, proxy_headers)
+    else:
+      if proxy_parts.scheme == 'https':
+        self._conn_class = http_client.HTTPSConnection
+      self._path = urllib_parse.urlunsplit(parts[:4] + ('',))
+      self._headers = proxy_headers
+
+  def _Connect(self):
+    """Returns the connection, opening a new one if needed."""
+    if self._conn is None:
+      self._conn = self._conn_class(self._netloc, timeout=self._timeout)
+      if self._tunnel:
+        host, port, headers = self._tunnel
+        self._conn.set_tunnel(host, port, headers)
+    return self._conn
+
+  def Fetch(self, start, length):
+    """Fetches a byte range.
+
+    Args:
+      start: the offset of the range
+      length: the length of the range
+
+    Returns:
+      A pair consisting of the range content and the total size of the
+      resource, or None if the server did not tell.
+
+    Raises:
+      _RetriableError, or socket.error and http_client.HTTPException, if
+      fetching may succeed when trying again; PayloadError otherwise.
+    """
+    for _ in range(_MAX_REDIRECTS + 1):
+      headers = dict(self._headers)
+      headers['Range'] = 'bytes=%d-%d' % (start, start + length - 1)
+      conn = self._Connect()
+      conn.request('GET', self._path, headers=headers)
+      response = conn.getresponse()
+      if response.status not in _REDIRECT_STATUSES:
+        break
+      # The connection is dropped rather than reading the redirect body.
+      location = response.getheader('Location')
+      self.Close()
+      if not location:
+        raise PayloadError('HTTP status %d without a location fetching %s' %
+                           (response.status, self.url))
+      self._SetUrl(urllib_parse.urljoin(self.url, location))
+    else:
+      raise PayloadError('too many redirects fetching %s' % self.url)
+
+    # The response body is only read once known to be the range asked for,
+    # as it may otherwise be the whole payload; the connection is dropped
+    # instead.
+    match = _CONTENT_RANGE_RE.match(response.getheader('Content-Range', ''))
+    if response.status != 206:
+      self.Close()
+      if response.status >= 500 or response.status == 408:
+        raise _RetriableError('HTTP status %d' % response.status)
+      raise PayloadError('unexpected HTTP status %d fetching bytes %d-%d '
+                         '(range requests not supported?)' %
+                         (response.status, start, start + length - 1))
+    if (not match or int(match.group(1)) != start or
+        int(match.group(2)) != start + length - 1):
+      self.Close()
+      raise PayloadError('unexpected content range (%s) fetching bytes '
+                         '%d-%d' % (response.getheader('Content-Range'),
+                                    start, start + length - 1))
+    data = response.read()
+    if response.will_close:
+      self.Close()
+    if len(data) != length:
+      raise _RetriableError('got %d bytes instead of %d' % (len(data), length))
+    total_size = None if match.group(3) == '*' else int(match.group(3))
+    return data, total_size
+
+  def Close(self):
+    """Closes the connection, if any; the next fetch opens a new one."""
+    if self._conn is not None:
+      self._conn.close()
+      self._conn = None
+
+class _PayloadClient(object):
+  """Fetches ranges of a payload URL, retrying with exponential backoff."""
+
+  def __init__(self, url, max_retries=DEFAULT_MAX_RETRIES,
+               backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT):
+    """Initialize the client.
+
+    Args:
+      url: the payload URL
+      max_retries: the number of times fetching a range is retried before
+                   giving up (optional)
+      backoff: the delay before retrying, in seconds, doubled on every retry
+               of the same range (optional)
+      timeout: the timeout of connecting and reading, in seconds (optional)
+    """
+    self.url = url
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.timeout = timeout
+    self.stats = {STAT_DOWNLOADED_BYTES: 0, STAT_RETRIES: 0}
+    self._lock = threading.Lock()
+
+  def _AddStat(self, name, value):
+    """Adds to a counter."""
+    with self._lock:
+      self.stats[name] = self.stats.get(name, 0) + value
+
+  def _NewFetcher(self):
+    """Returns a _RangeFetcher with a connection of its own."""
+    return _RangeFetcher(self.url, self.timeout)
+
+  def _Fetch(self, fetcher, start, length, verify=None):
+    """Fetches a byte range, retrying with exponential backoff.
+
+    Args:
+      fetcher: the _RangeFetcher to use
+      start: the offset of the range
+      length: the length of the range
+      verify: a function called with the range content, raising
+              _RetriableError to fetch it again (optional)
+
+    Returns:
+      A pair consisting of the range content and the payload size, if known.
+
+    Raises:
+      PayloadError if the range could not be fetched.
+    """
+    attempt = 0
+    while True:
+      try:
+        result = fetcher.Fetch(start, length)
+        self._AddStat(STAT_DOWNLOADED_BYTES, length)
+        if verify:
+          verify(result[0])
+        return result
+      except (_RetriableError, socket.error, http_client.HTTPException) as e:
+        fetcher.Close()
+        if attempt >= self.max_retries:
+          raise PayloadError('failed to fetch bytes %d-%d of %s after %d '
+                             'attempt(s): %s' %
+                             (start, start + length - 1, self.url,
+                              attempt + 1, e))
+      time.sleep(self.backoff * 2 ** attempt)
+      attempt += 1
+      self._AddStat(STAT_RETRIES, 1)
+
+  def _FetchMetadata(self, fetcher, payload_size):
+    """Fetches the payload metadata.
+
+    Args:
+      fetcher: the _RangeFetcher to use
+      payload_size: the expected payload size, or None
+
+    Returns:
+      A pair consisting of the metadata, including the metadata signature,
+      and the payload size.
+
+    Raises:
+      PayloadError if the metadata could not be fetched or is invalid.
+    """
+    data, total_size = self._Fetch(fetcher, 0, _HEADER_FETCH_SIZE)
+    if payload_size is None:
+      payload_size = total_size
+    if payload_size is None:
+      raise PayloadError('server did not tell the payload size')
+    if total_size is not None and total_size != payload_size:
+      raise PayloadError('payload size (%d) different from expected (%d)' %
+                         (total_size, payload_size))
+
+    header = payload_lib.Payload._PayloadHeader()
+    header.ReadFromPayload(io.BytesIO(data))
+    metadata_length = (header.size + header.manifest_len +
+                       header.metadata_signature_len)
+    if metadata_length > payload_size:
+      raise PayloadError('payload metadata (%d bytes) larger than the '
+                         'payload (%d bytes)' % (metadata_length, payload_size))
+    if metadata_length > len(data):
+      data += self._Fetch(fetcher, len(data),
+                          metadata_length - len(data))[0]
+    return data[:metadata_length], payload_size
+
+
+#
+# Download progress.
+#
+class _ChunkBitmap(object):
+  """An on-disk bitmap of the chunks of a payload already downloaded.
+
+  The bitmap is tied to a payload by its size and the hash of its metadata.
+  Chunks are recorded in memory, and the bitmap file is replaced atomically
+  every so many chunks and when checkpointing explicitly. The payload file
+  is synced to disk beforehand, so the bitmap never gets ahead of the data.
+  """
+
+  def __init__(self, file_name, payload_size, chunk_size, metadata_hash,
+               checkpoint_chunks=1):
+    """Initializes the bitmap, picking up the chunks recorded in the file.
+
+    A bitmap file for another payload or chunk size is ignored.
+
+    Args:
+      file_name: the bitmap file name
+      payload_size: the payload size
+      chunk_size: the size of chunks
+      metadata_hash: the SHA256 hash of the payload metadata
+      checkpoint_chunks: the number of chunks recorded between updates of
+                         the bitmap file (optional)
+    """
+    self.file_name = file_name
+    self.checkpoint_chunks = checkpoint_chunks
+    self._num_unsaved = 0
+    self.num_chunks = (payload_size + chunk_size - 1) // chunk_size
+    self._header = struct.pack(_BITMAP_HEADER_FMT, _BITMAP_MAGIC,
+                               _BITMAP_VERSION, payload_size, chunk_size,
+                               metadata_hash)
+    self._bits = bytearray((self.num_chunks + 7) // 8)
+    self._lock = threading.Lock()
+    try:
+      with open(file_name, 'rb') as bitmap_file:
+        content = bitmap_file.read()
+    except IOError:
+      return
+    if (content[:len(self._header)] == self._header and
+        len(content) == len(self._header) + len(self._bits)):
+      self._bits = bytearray(content[len(self._header):])
+
+  def IsDone(self, idx):
+    """Returns whether a chunk is recorded as downloaded."""
+    return bool(self._bits[idx // 8] & (1 << (idx % 8)))
+
+  def Record(self, indexes, data_file):
+    """Records chunks as downloaded, checkpointing every so many chunks.
+
+    Args:
+      indexes: the indexes of the chunks
+      data_file: the payload file object, synced before checkpointing
+    """
+    with self._lock:
+      for idx in indexes:
+        self._bits[idx // 8] |= 1 << (idx % 8)
+        self._num_unsaved += 1
+      if self._num_unsaved >= self.checkpoint_chunks:
+        self._Checkpoint(data_file)
+
+  def Checkpoint(self, data_file):
+    """Replaces the bitmap file with the chunks recorded so far.
+
+    Args:
+      data_file: the payload file object, synced before checkpointing
+    """
+    with self._lock:
+      if self._num_unsaved:
+        self._Checkpoint(data_file)
+
+  def _Checkpoint(self, data_file):
+    """Syncs the payload file and replaces the bitmap file."""
+    self._num_unsaved = 0
+    data_file.flush()
+    os.fsync(data_file.fileno())
+    tmp_file_name = self.file_name + '.tmp'
+    with open(tmp_file_name, 'wb') as tmp_file:
+      tmp_file.write(self._header + bytes(self._bits))
+      tmp_file.flush()
+      os.fsync(tmp_file.fileno())
+    os.rename(tmp_file_name, self.file_name)
+
+
+#
+# Payload download.
+#
+class PayloadDownloader(_PayloadClient):
+  """Downloading an update payload over HTTP.
+
+  This is a short-lived object downloading one payload to a file, with a
+  number of concurrent range requests.
+  """
+
+  def __init__(self, url, file_name, chunk_size=DEFAULT_CHUNK_SIZE,
+               num_workers=DEFAULT_NUM_WORKERS,
+               max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF,
+               timeout=DEFAULT_TIMEOUT, blob_cache=None):
+    """Initialize the downloader.
+
+    Args:
+      url: the payload URL
+      file_name: the file to download the payload to
+      chunk_size: the size of the ranges fetched (optional)
+      num_workers: the number of ranges fetched concurrently (optional)
+      max_retries: the number of times fetching a range is retried before
+                   giving up (optional)
+      backoff: the delay before retrying, in seconds, doubled on every retry
+               of the same range (optional)
+      timeout: the timeout of connecting and reading, in seconds (optional)
+      blob_cache: a blob_cache.BlobCache to take chunks from when all of
+                  their data blobs are cached, and to add the downloaded
+                  data blobs to if populated (optional)
+    """
+    assert chunk_size > 0, 'chunk size must be positive'
+    assert num_workers > 0, 'number of workers must be positive'
+    super(PayloadDownloader, self).__init__(
+        url, max_retries=max_retries, backoff=backoff, timeout=timeout)
+    self.file_name = file_name
+    self.bitmap_file_name = file_name + '.chunks'
+    self.chunk_size = chunk_size
+    self.num_workers = num_workers
+    self.blob_cache = blob_cache
+    self.stats[STAT_RESUMED_BYTES] = 0
+    self.stats[STAT_CACHED_BYTES] = 0
+
+  @staticmethod
+  def _VerifyChunk(start, data, blobs, blob_starts):
+    """Verifies the data blobs lying wholly within a chunk.
+
+    Args:
+      start: the offset of the chunk in the payload
+      data: the chunk data
+      blobs: the (start, length, hash) of the hashed data blobs, in order
+      blob_starts: the start of each of the blobs
+
+    Raises:
+      _RetriableError if a blob does not match its hash.
+    """
+    end = start + len(data)
+    for blob_start, blob_length, blob_hash in blobs[
+        bisect.bisect_left(blob_starts, start):]:
+      if blob_start >= end:
+        break
+      if blob_start + blob_length > end:
+        continue
+      blob = memoryview(data)[blob_start - start:
+                              blob_start - start + blob_length]
+      if hashlib.sha256(blob).digest() != blob_hash:
+        raise _RetriableError('data blob at offset %d does not match its '
+                              'hash' % blob_start)
+
+  def _Worker(self, chunks, data_file, bitmap, payload_size, blobs, errors):
+    """Fetches chunks until there are none left or an error occurred.
+
+    Args:
+      chunks: a queue of indexes of the chunks to fetch
+      data_file: the payload file object, open for writing
+      bitmap: the _ChunkBitmap to record fetched chunks to
+      payload_size: the payload size
+      blobs: the (start, length, hash) of the hashed data blobs, in order,
+             verified when lying wholly within a chunk
+      errors: a list to add errors to, also stopping the other workers
+    """
+    blob_starts = [blob_start for blob_start, _, _ in blobs]
+    fetcher = self._NewFetcher()
+    try:
+      while not errors:
+        try:
+          idx = chunks.get_nowait()
+        except queue.Empty:
+          break
+        start = idx * self.chunk_size
+        length = min(self.chunk_size, payload_size - start)
+        data, _ = self._Fetch(
+            fetcher, start, length,
+            verify=lambda chunk, start=start: self._VerifyChunk(
+                start, chunk, blobs, blob_starts))
+        # Writes and checkpoints of the shared file object are serialized.
+        with self._lock:
+          data_file.seek(start)
+          data_file.write(data)
+          bitmap.Record([idx], data_file)
+    except PayloadError as e:
+      errors.append(e)
+    except Exception as e:  # pylint: disable=broad-except
+      # Anything else, e.g. failing to write, must stop the download too.
+      errors.append(PayloadError('error downloading to %s: %s' %
+                                 (self.file_name, e)))
+    finally:
+      fetcher.Close()
+
+  @staticmethod
+  def _HashedBlobs(metadata_payload):
+    """Returns the (start, length, hash) of the hashed data blobs, in order.
+
+    Args:
+      metadata_payload: the initialized metadata-only payload
+    """
+    blobs = {}
+    for part in metadata_payload.manifest.partitions:
+      for op in part.operations:
+        if op.data_length and op.HasField('data_sha256_hash'):
+          blobs[metadata_payload.data_offset + op.data_offset,
+                op.data_length] = op.data_sha256_hash
+    return sorted((start, length, blob_hash)
+                  for (start, length), blob_hash in blobs.items())
+
+  def _ReadCachedChunk(self, start, end, metadata, blobs, blob_starts):
+    """Assembles a chunk from the metadata and cached data blobs.
+
+    Args:
+      start: the offset of the chunk in the payload
+      end: the offset of the end of the chunk in the payload
+      metadata: the payload metadata
+      blobs: the (start, length, hash) of the hashed data blobs, in order
+      blob_starts: the start of each of the blobs
+
+    Returns:
+      The chunk data, or None unless all of it is at hand.
+    """
+    pos = max(start, min(end, len(metadata)))
+    pieces = [metadata[start:pos]]
+    idx = bisect.bisect_right(blob_starts, pos) - 1
+    while pos < end:
+      if idx < 0 or idx >= len(blobs):
+        return None
+      blob_start, blob_length, blob_hash = blobs[idx]
+      if not blob_start <= pos < blob_start + blob_length:
+        return None
+      data = self.blob_cache.Get(blob_hash)
+      if data is None:
+        return None
+      piece = memoryview(data)[pos - blob_start:
+                               min(end, blob_start + blob_length) -
+                               blob_start]
+      pieces.append(piece)
+      pos += len(piece)
+      idx += 1
+    return b''.join(pieces)
+
+  def _CopyCachedChunks(self, pending, metadata, blobs, data_file, bitmap,
+                        payload_size):
+    """Writes the chunks at hand in the blob cache to the payload file.
+
+    Args:
+      pending: the indexes of the chunks not downloaded yet
+      metadata: the payload metadata
+      blobs: the (start, length, hash) of the hashed data blobs, in order
+      data_file: the payload file object, open for writing
+      bitmap: the _ChunkBitmap to record written chunks to
+      payload_size: the payload size
+
+    Returns:
+      The indexes of the chunks still to download.
+    """
+    blob_starts = [start for start, _, _ in blobs]
+    still_pending = []
+    for idx in pending:
+      start = idx * self.chunk_size
+      end = min(start + self.chunk_size, payload_size)
+      data = self._ReadCachedChunk(start, end, metadata, blobs, blob_starts)
+      if data is None:
+        still_pending.append(idx)
+        continue
+      data_file.seek(start)
+      data_file.write(data)
+      bitmap.Record([idx], data_file)
+      self._AddStat(STAT_CACHED_BYTES, len(data))
+    return still_pending
+
+  def _CacheBlobs(self, blobs, data_file):
+    """Adds the data blobs of the downloaded payload to the blob cache.
+
+    Args:
+      blobs: the (start, length, hash) of the hashed data blobs, in order
+      data_file: the payload file object, open for reading
+    """
+    for start, length, blob_hash in blobs:
+      if not self.blob_cache.Contains(blob_hash):
+        data_file.seek(start)
+        self.blob_cache.Put(data_file.read(length))
+
+  def Download(self, payload_size=None, check_args=None):
+    """Downloads the payload, resuming a previous download if possible.
+
+    Args:
+      payload_size: the expected payload size (default: as reported by the
+                    server)
+      check_args: arguments to Payload.Check to check the payload metadata
+                  with before downloading the payload data, e.g. the public
+                  key and metadata signature, or None not to check it
+                  (optional)
+
+    Returns:
+      A dictionary of counters collected while downloading, including those
+      of the blob cache, if any.
+
+    Raises:
+      PayloadError if the payload metadata failed the check or the payload
+      could not be downloaded; a partial download can then be resumed.
+    """
+    fetcher = self._NewFetcher()
+    try:
+      metadata, payload_size = self._FetchMetadata(fetcher, payload_size)
+    finally:
+      fetcher.Close()
+
+    metadata_payload = payload_lib.Payload(io.BytesIO(metadata),
+                                           metadata_only=True)
+    metadata_payload.Init()
+    if check_args is not None:
+      metadata_payload.Check(payload_size=payload_size, **check_args)
+    blobs = self._HashedBlobs(metadata_payload)
+
+    # A bitmap is of no use without the data it records.
+    if (os.path.exists(self.bitmap_file_name) and
+        not os.path.exists(self.file_name)):
+      os.remove(self.bitmap_file_name)
+    bitmap = _ChunkBitmap(
+        self.bitmap_file_name, payload_size, self.chunk_size,
+        hashlib.sha256(metadata).digest(),
+        checkpoint_chunks=max(_CHECKPOINT_SIZE // self.chunk_size, 1))
+    pending = [idx for idx in range(bitmap.num_chunks)
+               if not bitmap.IsDone(idx)]
+    self.stats[STAT_RESUMED_BYTES] = sum(
+        min(self.chunk_size, payload_size - idx * self.chunk_size)
+        for idx in range(bitmap.num_chunks) if bitmap.IsDone(idx))
+
+    with open(self.file_name, 'ab') as data_file:
+      data_file.truncate(payload_size)
+    with open(self.file_name, 'r+b') as data_file:
+      # The metadata is in hand already, which completes the chunks it covers.
+      data_file.write(metadata)
+      bitmap.Record(range(len(metadata) // self.chunk_size), data_file)
+      pending = [idx for idx in pending
+                 if (idx + 1) * self.chunk_size > len(metadata)]
+      if self.blob_cache:
+        pending = self._CopyCachedChunks(pending, metadata, blobs, data_file,
+                                         bitmap, payload_size)
+
+      chunks = queue.Queue()
+      for idx in pending:
+        chunks.put(idx)
+      errors = []
+      workers = [
+          threading.Thread(target=self._Worker,
+                           args=(chunks, data_file, bitmap, payload_size,
+                                 blobs, errors))
+          for _ in range(min(self.num_workers, len(pending)))]
+      for worker in workers:
+        worker.start()
+      for worker in workers:
+        worker.join()
+      if not errors and not all(bitmap.IsDone(idx)
+                                for idx in range(bitmap.num_chunks)):
+        errors.append(PayloadError('not all of %s was downloaded' %
+                                   self.file_name))
+      if errors:
+        # Keep what was downloaded for resuming.
+        bitmap.Checkpoint(data_file)
+        raise errors[0]
+
+      if self.blob_cache:
+        if self.blob_cache.populate:
+          self._CacheBlobs(blobs, data_file)
+        self.stats.update(self.blob_cache.stats)
+
+    if os.path.exists(self.bitmap_file_name):
+      os.remove(self.bitmap_file_name)
+    return dict(self.stats)
+
+
+#
+# Applying remote payloads.
+#
+class _BlobPrefetcher(object):
+  """Fetches ranges of a payload in a given order, a bounded window ahead.
+
+  Ranges are fetched by a number of workers, as long as the ranges fetched
+  or being fetched past the one last read fit in the window; the next range
+  to be read is always fetched, whatever its size. Reading a range releases
+  all the ranges before it, so they must be read in order, although ranges
+  may be skipped.
+  """
+
+  def __init__(self, client, ranges, window_size, num_workers):
+    """Initializes the prefetcher and starts fetching.
+
+    Args:
+      client: the _PayloadClient to fetch with
+      ranges: the (start, length) ranges to fetch, in order
+      window_size: the maximum amount of data fetched ahead
+      num_workers: the number of ranges fetched concurrently
+    """
+    self._client = client
+    self._ranges = ranges
+    self._window_size = window_size
+    self._data = {}
+    self._next_fetch = 0
+    self._next_read = 0
+    self._held_bytes = 0
+    self._error = None
+    self._stopped = False
+    self._cond = threading.Condition()
+    self._workers = [threading.Thread(target=self._Worker)
+                     for _ in range(min(num_workers, len(ranges)))]
+    for worker in self._workers:
+      worker.daemon = True
+      worker.start()
+
+  def _Worker(self):
+    """Fetches the next range in order until done or stopped."""
+    fetcher = self._client._NewFetcher()  # pylint: disable=protected-access
+    try:
+      while True:
+        with self._cond:
+          while not self._stopped and self._next_fetch < len(self._ranges):
+            length = self._ranges[self._next_fetch][1]
+            if (self._next_fetch == self._next_read or
+                self._held_bytes + length <= self._window_size):
+              break
+            self._cond.wait()
+          if self._stopped or self._next_fetch >= len(self._ranges):
+            return
+          idx = self._next_fetch
+          self._next_fetch += 1
+          self._held_bytes += length
+
+        start, length = self._ranges[idx]
+        try:
+          data = self._client._Fetch(  # pylint: disable=protected-access
+              fetcher, start, length)[0]
+        except Exception as e:  # pylint: disable=broad-except
+          with self._cond:
+            self._error = (e if isinstance(e, PayloadError) else
+                           PayloadError('error fetching bytes %d-%d: %s' %
+                                        (start, start + length - 1, e)))
+            self._cond.notify_all()
+          return
+
+        with self._cond:
+          if idx >= self._next_read:
+            self._data[idx] = data
+          self._cond.notify_all()
+    finally:
+      fetcher.Close()
+
+  def Read(self, idx):
+    """Returns the content of a range, waiting for it to be fetched.
+
+    Args:
+      idx: the index of the range, at least that of the last range read
+
+    Returns:
+      The range content, or None if the range was already released.
+
+    Raises:
+      PayloadError if fetching failed.
+    """
+    with self._cond:
+      if idx < self._next_read:
+        return None
+      # Ranges skipped over are dropped, or never fetched at all.
+      for released_idx in range(self._next_read,
+                                min(idx, self._next_fetch)):
+        self._data.pop(released_idx, None)
+        self._held_bytes -= self._ranges[released_idx][1]
+      self._next_fetch = max(self._next_fetch, idx)
+      self._next_read = idx
+      self._cond.notify_all()
+      while idx not in self._data and self._error is None:
+        self._cond.wait()
+      if idx not in self._data:
+        raise self._error
+      return self._data[idx]
+
+  def Stop(self):
+    """Stops fetching and waits for the workers to exit."""
+    with self._cond:
+      self._stopped = True
+      self._cond.notify_all()
+    for worker in self._workers:
+      worker.join()
+
+
+class RemotePayload(payload_lib.Payload):
+  """Update payload applied straight from its URL.
+
+  Only the payload metadata is fetched by Init. When applying, the data
+  blobs are fetched in the order the operations use them, a bounded window
+  ahead of the applier, so applying starts as soon as the metadata arrived
+  and overlaps with downloading. Operations without data, e.g. SOURCE_COPY
+  and ZERO, cost nothing to download, and neither do data blobs in the blob
+  cache, if any. Data read otherwise, e.g. by the checker or for the payload
+  signatures, is fetched on demand.
+  """
+
+  def __init__(self, url, payload_size=None,
+               window_size=DEFAULT_PREFETCH_WINDOW,
+               num_workers=DEFAULT_NUM_WORKERS,
+               max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF,
+               timeout=DEFAULT_TIMEOUT, blob_cache=None):
+    """Initialize the payload object.
+
+    Args:
+      url: the payload URL
+      payload_size: the expected payload size (default: as reported by the
+                    server)
+      window_size: the maximum amount of data fetched ahead of the applier
+                   (optional)
+      num_workers: the number of ranges fetched concurrently (optional)
+      max_retries: the number of times fetching a range is retried before
+                   giving up (optional)
+      backoff: the delay before retrying, in seconds, doubled on every retry
+               of the same range (optional)
+      timeout: the timeout of connecting and reading, in seconds (optional)
+      blob_cache: a blob_cache.BlobCache to take data blobs from rather than
+                  fetching them, and to add the fetched ones to if populated
+                  (optional)
+    """
+    super(RemotePayload, self).__init__(io.BytesIO(), blob_cache=blob_cache)
+    self.url = url
+    self.payload_size = payload_size
+    self.window_size = window_size
+    self.num_workers = num_workers
+    self._client = _PayloadClient(url, max_retries=max_retries,
+                                  backoff=backoff, timeout=timeout)
+    self._fetcher = None
+    self._prefetcher = None
+    # Maps the offset of each blob fetched ahead to its range index.
+    self._blob_ranges = {}
+    self._range_starts = []
+
+  def Init(self):
+    """Fetches the payload metadata and initializes the payload object.
+
+    Raises:
+      PayloadError if the metadata could not be fetched or is invalid.
+    """
+    self._fetcher = self._client._NewFetcher()
+    try:
+      metadata, self.payload_size = self._client._FetchMetadata(
+          self._fetcher, self.payload_size)
+    except PayloadError:
+      self.Close()
+      raise
+    self.payload_file = io.BytesIO(metadata)
+    super(RemotePayload, self).Init()
+
+  def _ReadDataBlob(self, offset, length):
+    """Reads and returns a single data blob, without verifying it."""
+    if not length:
+      return b''
+    start = self.data_offset + offset
+    idx = self._blob_ranges.get(start)
+    if self._prefetcher and idx is not None:
+      data = self._prefetcher.Read(idx)
+      if data is not None:
+        range_start = self._range_starts[idx]
+        return data[start - range_start:start - range_start + length]
+
+    with self._read_lock:
+      self._client._AddStat(STAT_ON_DEMAND_BYTES, length)
+      return self._client._Fetch(self._fetcher, start, length)[0]
+
+  def _PlanRanges(self):
+    """Returns the ranges of data blobs in the order they are applied.
+
+    Adjacent blobs are coalesced into a single range. Cached blobs are left
+    out, as they are read from the cache.
+    """
+    ranges = []
+    self._blob_ranges = {}
+    for part in self.manifest.partitions:
+      for op in part.operations:
+        data_offset, data_length = op.data_offset, op.data_length
+        if not data_length:
+          continue
+        blob_hash = (self.blob_cache and
+                     self.GetBlobHash(data_offset, data_length))
+        if blob_hash and self.blob_cache.Contains(blob_hash):
+          continue
+        start = self.data_offset + data_offset
+        if ranges:
+          last_start, last_length = ranges[-1]
+          if (last_start + last_length == start and
+              last_length + data_length <= _MAX_COALESCED_SIZE):
+            ranges[-1] = (last_start, last_length + data_length)
+            self._blob_ranges[start] = len(ranges) - 1
+            continue
+        ranges.append((start, data_length))
+        self._blob_ranges[start] = len(ranges) - 1
+    self._range_starts = [start for start, _ in ranges]
+    return ranges
+
+  def Check(self, payload_size=None, **check_args):
+    """Checks the payload integrity; see Payload.Check.
+
+    Data blobs are fetched on demand, so checking beyond the metadata level
+    downloads the payload data.
+    """
+    return super(RemotePayload, self).Check(
+        payload_size=self.payload_size if payload_size is None
+        else payload_size, **check_args)
+
+  def VerifyAndApply(self, new_parts, payload_size=None, **dargs):
+    """Checks and applies the payload; see Payload.VerifyAndApply.
+
+    Returns:
+      A dictionary of counters collected while applying and downloading.
+    """
+    stats = super(RemotePayload, self).VerifyAndApply(
+        new_parts, payload_size=self.payload_size if payload_size is None
+        else payload_size, **dargs)
+    stats.update(self._client.stats)
+    return stats
+
+  def Apply(self, new_parts, part_workers=1, **apply_args):
+    """Applies the update payload, fetching data blobs ahead of applying.
+
+    See Payload.Apply for the arguments, except that partitions can only be
+    applied one at a time.
+
+    Returns:
+      A dictionary of counters collected while applying and downloading.
+    """
+    if part_workers > 1:
+      raise PayloadError('remote payloads must be applied one partition at '
+                         'a time')
+    self._AssertInit()
+    self._prefetcher = _BlobPrefetcher(self._client, self._PlanRanges(),
+                                       self.window_size, self.num_workers)
+    try:
+      stats = super(RemotePayload, self).Apply(
+          new_parts, part_workers=part_workers, **apply_args)
+    finally:
+      self._prefetcher.Stop()
+      self._prefetcher = None
+    stats.update(self._client.stats)
+    return stats
+
+  def Close(self):
+    """Closes the connection used for fetching data on demand."""
+    super(RemotePayload, self).Close()
+    if self._fetcher:
+      self._fetcher.Close()
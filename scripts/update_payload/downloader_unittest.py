@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Unit tests for downloader.py."""
+
+# Disable check for function names to avoid errors based on old code
+# pylint: disable-msg=invalid-name
+
+from __future__ import absolute_import
+
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock  # pylint: disable=import-error
+
+from update_payload import applier
+from update_payload import blob_cache
+from update_payload import common
+from update_payload import downloader
+from update_payload import test_utils
+from update_payload.error import PayloadError
+
+
+_BLOCK_SIZE = 4096
+_CHUNK_SIZE = 1000
+
+
+class PayloadDownloaderTest(unittest.TestCase):
+  """Tests the PayloadDownloader class."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.file_name = os.path.join(self.test_dir, 'payload.bin')
+
+    payload_gen = test_utils.EnhancedPayloadGenerator()
+    payload_gen.SetBlockSize(_BLOCK_SIZE)
+    payload_gen.SetMinorVersion(0)
+    for name in (common.KERNEL, common.ROOTFS):
+      data = hashlib.sha256(name.encode()).digest() * (_BLOCK_SIZE // 32)
+      payload_gen.SetPartInfo(name, True, _BLOCK_SIZE,
+                              hashlib.sha256(data).digest())
+      payload_gen.AddOperationWithData(name, common.OpType.REPLACE,
+                                       dst_extents=[(0, 1)], data_blob=data)
+    payload_file = io.BytesIO()
+    payload_gen.WriteToFileWithData(
+        payload_file, privkey_file_name=test_utils._PRIVKEY_FILE_NAME)
+    self.payload_data = payload_file.getvalue()
+    self.server = test_utils.PayloadHttpServer(self.payload_data)
+    # The local server is talked to directly, whatever the proxy settings.
+    env_patcher = mock.patch.dict(os.environ, {'no_proxy': '*'})
+    env_patcher.start()
+    self.addCleanup(env_patcher.stop)
+
+  def tearDown(self):
+    self.server.Stop()
+    shutil.rmtree(self.test_dir)
+
+  def _Download(self, num_workers=3, max_retries=0, cache=None, **dargs):
+    """Downloads the payload, returning the download counters."""
+    return downloader.PayloadDownloader(
+        self.server.url, self.file_name, chunk_size=_CHUNK_SIZE,
+        num_workers=num_workers, max_retries=max_retries, backoff=0,
+        blob_cache=cache).Download(**dargs)
+
+  def _AssertDownloaded(self):
+    with open(self.file_name, 'rb') as payload_file:
+      self.assertEqual(self.payload_data, payload_file.read())
+    self.assertFalse(os.path.exists(self.file_name + '.chunks'))
+
+  def testDownload(self):
+    """Tests downloading a payload with parallel range requests."""
+    stats = self._Download(
+        check_args={'pubkey_file_name': test_utils._PUBKEY_FILE_NAME})
+    self._AssertDownloaded()
+    self.assertEqual(0, stats[downloader.STAT_RESUMED_BYTES])
+    self.assertEqual(0, stats[downloader.STAT_RETRIES])
+    # Connections are reused: one for the metadata, and one per worker.
+    self.assertLessEqual(self.server.num_connections, 4)
+    self.assertGreater(self.server.num_requests, 4)
+
+  def testDownloadRetries(self):
+    """Tests retrying ranges that failed to download."""
+    self.server.num_failures = 3
+    stats = self._Download(num_workers=1, max_retries=3)
+    self._AssertDownloaded()
+    self.assertEqual(3, stats[downloader.STAT_RETRIES])
+
+  def testDownloadRedirect(self):
+    """Tests following redirects to the payload."""
+    self.server.redirects['/payload.bin'] = '/cdn/payload.bin'
+    self._Download(num_workers=1)
+    self._AssertDownloaded()
+    # Redirects are followed once per connection, for the metadata and the
+    # worker.
+    self.assertEqual(2, self.server.paths.count('/payload.bin'))
+
+    self.server.redirects['/cdn/payload.bin'] = 'http://%s:%d/payload.bin' % (
+        self.server.server.server_address)
+    with self.assertRaises(PayloadError) as cm:
+      self._Download()
+    self.assertIn('too many redirects', str(cm.exception))
+
+  def testDownloadProxy(self):
+    """Tests downloading through the proxy set in the environment."""
+    url = 'http://payload.invalid/payload.bin'
+    proxy = 'http://user:secret@%s:%d' % self.server.server.server_address
+    with mock.patch.dict(os.environ, {'http_proxy': proxy, 'no_proxy': ''}):
+      downloader.PayloadDownloader(url, self.file_name,
+                                   chunk_size=_CHUNK_SIZE, max_retries=0,
+                                   backoff=0).Download()
+    self._AssertDownloaded()
+    self.assertEqual({url}, set(self.server.paths))
+
+  def testDownloadVerifyBlobs(self):
+    """Tests fetching again chunks whose data blobs do not match."""
+    self.server.corrupt_offset = len(self.payload_data) - 1000
+    self.server.num_corruptions = 1
+    stats = downloader.PayloadDownloader(
+        self.server.url, self.file_name, chunk_size=len(self.payload_data),
+        max_retries=1, backoff=0).Download()
+    self._AssertDownloaded()
+    self.assertEqual(1, stats[downloader.STAT_RETRIES])
+
+    self.server.num_corruptions = 2
+    with self.assertRaises(PayloadError) as cm:
+      downloader.PayloadDownloader(
+          self.server.url, self.file_name, chunk_size=len(self.payload_data),
+          max_retries=1, backoff=0).Download()
+    self.assertIn('does not match its hash', str(cm.exception))
+
+  def testDownloadCheckpoints(self):
+    """Tests that the bitmap is only written every so many chunks."""
+    checkpoint = downloader._ChunkBitmap._Checkpoint
+    with mock.patch.object(downloader, '_CHECKPOINT_SIZE', 3 * _CHUNK_SIZE), \
+         mock.patch.object(downloader._ChunkBitmap, '_Checkpoint',
+                           autospec=True, side_effect=checkpoint) as spy:
+      self._Download()
+    self._AssertDownloaded()
+    num_chunks = (len(self.payload_data) + _CHUNK_SIZE - 1) // _CHUNK_SIZE
+    self.assertEqual(num_chunks // 3, spy.call_count)
+
+  def testDownloadResume(self):
+    """Tests resuming an interrupted download."""
+    downloader_obj = downloader.PayloadDownloader(
+        self.server.url, self.file_name, chunk_size=_CHUNK_SIZE,
+        num_workers=1, max_retries=0, backoff=0)
+    fetch = downloader_obj._Fetch
+    num_fetches = [0]
+
+    def _InterruptedFetch(fetcher, start, length, **kwargs):
+      # Fetches the header, the rest of the metadata and two chunks.
+      num_fetches[0] += 1
+      if num_fetches[0] > 4:
+        raise PayloadError('interrupted')
+      return fetch(fetcher, start, length, **kwargs)
+
+    downloader_obj._Fetch = _InterruptedFetch
+    self.assertRaises(PayloadError, downloader_obj.Download)
+    self.assertTrue(os.path.exists(self.file_name + '.chunks'))
+
+    stats = self._Download()
+    self._AssertDownloaded()
+    self.assertEqual(2 * _CHUNK_SIZE, stats[downloader.STAT_RESUMED_BYTES])
+
+    # A bitmap without the data it records is not resumed from.
+    os.remove(self.file_name)
+    num_fetches[0] = 0
+    self.assertRaises(PayloadError, downloader_obj.Download)
+    self.assertTrue(os.path.exists(self.file_name + '.chunks'))
+    os.remove(self.file_name)
+    stats = self._Download()
+    self._AssertDownloaded()
+    self.assertEqual(0, stats[downloader.STAT_RESUMED_BYTES])
+
+  def testDownloadBlobCache(self):
+    """Tests skipping chunks made up of cached data blobs."""
+    cache = blob_cache.BlobCache(os.path.join(self.test_dir, 'cache'),
+                                 populate=True)
+    stats = self._Download(cache=cache)
+    self._AssertDownloaded()
+    self.assertEqual(0, stats[downloader.STAT_CACHED_BYTES])
+    self.assertEqual(2 * _BLOCK_SIZE, stats[blob_cache.STAT_STORED_BYTES])
+    downloaded_bytes = stats[downloader.STAT_DOWNLOADED_BYTES]
+
+    # Chunks overlapping the signature blob are still downloaded.
+    os.remove(self.file_name)
+    stats = self._Download(cache=cache)
+    self._AssertDownloaded()
+    self.assertGreater(stats[downloader.STAT_CACHED_BYTES], _BLOCK_SIZE)
+    self.assertEqual(downloaded_bytes - stats[downloader.STAT_CACHED_BYTES],
+                     stats[downloader.STAT_DOWNLOADED_BYTES])
+
+  def testDownloadWriteError(self):
+    """Tests that workers failing other than to fetch fail the download."""
+    record = downloader._ChunkBitmap.Record
+    num_records = [0]
+
+    def _FailingRecord(bitmap, indexes, data_file):
+      num_records[0] += 1
+      if num_records[0] == 3:
+        raise IOError('No space left on device')
+      return record(bitmap, indexes, data_file)
+
+    with mock.patch.object(downloader._ChunkBitmap, 'Record', autospec=True,
+                           side_effect=_FailingRecord):
+      with self.assertRaises(PayloadError) as cm:
+        self._Download()
+    self.assertIn('No space left on device', str(cm.exception))
+    self.assertTrue(os.path.exists(self.file_name + '.chunks'))
+
+    # Chunks left over by workers are not taken as downloaded.
+    with mock.patch.object(downloader.PayloadDownloader, '_Worker'):
+      with self.assertRaises(PayloadError) as cm:
+        self._Download()
+    self.assertIn('not all of', str(cm.exception))
+    self.assertTrue(os.path.exists(self.file_name + '.chunks'))
+
+    stats = self._Download()
+    self._AssertDownloaded()
+    self.assertGreater(stats[downloader.STAT_RESUMED_BYTES], 0)
+
+  def testDownloadRejectMetadata(self):
+    """Tests rejecting a payload from its metadata alone."""
+    with self.assertRaises(PayloadError) as cm:
+      self._Download(check_args={'metadata_size': 1})
+    self.assertIn('metadata size', str(cm.exception))
+    self.assertFalse(os.path.exists(self.file_name))
+
+    self.assertRaises(PayloadError, self._Download,
+                      payload_size=len(self.payload_data) + 1)
+    self.assertFalse(os.path.exists(self.file_name))
+
+  def testDownloadErrors(self):
+    """Tests failures to download."""
+    self.server.num_failures = 2
+    self.assertRaises(PayloadError, self._Download, max_retries=1)
+
+    self.server.support_ranges = False
+    with self.assertRaises(PayloadError) as cm:
+      self._Download()
+    self.assertIn('range requests not supported', str(cm.exception))
+
+    self.assertRaises(PayloadError, downloader.PayloadDownloader(
+        'ftp://127.0.0.1/payload.bin', self.file_name).Download)
+
+
+class _FakeFetcher(object):
+  """A stand-in for _RangeFetcher."""
+
+  def Close(self):
+    pass
+
+
+class _FakeClient(object):
+  """A stand-in for _PayloadClient recording the ranges fetched."""
+
+  def __init__(self):
+    self.fetched = []
+    self.cond = threading.Condition()
+
+  def _NewFetcher(self):
+    return _FakeFetcher()
+
+  def _Fetch(self, fetcher, start, length):
+    del fetcher
+    with self.cond:
+      self.fetched.append(start)
+      self.cond.notify_all()
+    return b'%d' % start * length, None
+
+  def WaitFetched(self, count):
+    with self.cond:
+      while len(self.fetched) < count:
+        self.cond.wait()
+
+
+class BlobPrefetcherTest(unittest.TestCase):
+  """Tests the _BlobPrefetcher class."""
+
+  def testReadAhead(self):
+    """Tests that ranges are fetched in order, within the window."""
+    client = _FakeClient()
+    ranges = [(idx, 10) for idx in range(10)]
+    prefetcher = downloader._BlobPrefetcher(client, ranges, 20, 1)
+    try:
+      # The window holds the range read last and the one after.
+      client.WaitFetched(2)
+      self.assertEqual(b'0' * 10, prefetcher.Read(0))
+      self.assertEqual(b'1' * 10, prefetcher.Read(1))
+      client.WaitFetched(3)
+      self.assertEqual([0, 1, 2], client.fetched)
+      # Skipping ranges drops them, or does not fetch them at all.
+      self.assertEqual(b'6' * 10, prefetcher.Read(6))
+      self.assertIsNone(prefetcher.Read(5))
+      self.assertEqual(b'9' * 10, prefetcher.Read(9))
+    finally:
+      prefetcher.Stop()
+    self.assertEqual([0, 1, 2, 6, 7, 9], client.fetched)
+
+  def testReadLargeRange(self):
+    """Tests that a range larger than the window is still fetched."""
+    client = _FakeClient()
+    prefetcher = downloader._BlobPrefetcher(client, [(0, 30), (1, 30)], 20,
+                                            2)
+    try:
+      self.assertEqual(b'0' * 30, prefetcher.Read(0))
+      self.assertEqual(b'1' * 30, prefetcher.Read(1))
+    finally:
+      prefetcher.Stop()
+
+
+class RemotePayloadTest(unittest.TestCase):
+  """Tests the RemotePayload class."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.new_data = {}
+    payload_gen = test_utils.EnhancedPayloadGenerator()
+    payload_gen.SetBlockSize(_BLOCK_SIZE)
+    payload_gen.SetMinorVersion(0)
+    for name in (common.KERNEL, common.ROOTFS):
+      blocks = [hashlib.sha256(b'%s %d' % (name.encode(), idx)).digest() *
+                (_BLOCK_SIZE // 32) for idx in range(4)]
+      self.new_data[name] = b''.join(blocks)
+      payload_gen.SetPartInfo(name, True, len(self.new_data[name]),
+                              hashlib.sha256(self.new_data[name]).digest())
+      for idx, block in enumerate(blocks):
+        payload_gen.AddOperationWithData(
+            name, common.OpType.REPLACE, dst_extents=[(idx, 1)],
+            data_blob=block)
+    payload_file = io.BytesIO()
+    payload_gen.WriteToFileWithData(
+        payload_file, privkey_file_name=test_utils._PRIVKEY_FILE_NAME)
+    self.payload_data = payload_file.getvalue()
+    self.server = test_utils.PayloadHttpServer(self.payload_data)
+    # The local server is talked to directly, whatever the proxy settings.
+    env_patcher = mock.patch.dict(os.environ, {'no_proxy': '*'})
+    env_patcher.start()
+    self.addCleanup(env_patcher.stop)
+
+  def tearDown(self):
+    self.server.Stop()
+    shutil.rmtree(self.test_dir)
+
+  def _Apply(self, payload, verify=False, **dargs):
+    """Applies a payload, returning the applier counters."""
+    new_parts = dict((name, os.path.join(self.test_dir, name + '.img'))
+                     for name in self.new_data)
+    if verify:
+      stats = payload.VerifyAndApply(
+          new_parts, pubkey_file_name=test_utils._PUBKEY_FILE_NAME,
+          assert_type='full', **dargs)
+    else:
+      stats = payload.Apply(new_parts, **dargs)
+    for name, file_name in new_parts.items():
+      with open(file_name, 'rb') as part_file:
+        self.assertEqual(self.new_data[name], part_file.read())
+    return stats
+
+  def testApply(self):
+    """Tests applying a payload as its data blobs are fetched."""
+    payload = downloader.RemotePayload(self.server.url,
+                                       window_size=2 * _BLOCK_SIZE,
+                                       num_workers=2, backoff=0)
+    payload.Init()
+    num_requests = self.server.num_requests
+    stats = self._Apply(payload, verify=True)
+    payload.Close()
+    sigs_size = payload.manifest.signatures_size
+
+    # The adjacent blobs were fetched as a single range, and only the
+    # signature blob on demand.
+    self.assertEqual(sigs_size, stats[downloader.STAT_ON_DEMAND_BYTES])
+    self.assertEqual(len(self.payload_data),
+                     stats[downloader.STAT_DOWNLOADED_BYTES])
+    self.assertEqual(num_requests + 2, self.server.num_requests)
+    self.assertIn(applier.STAT_VERIFIED_WHILE_WRITING_BYTES, stats)
+
+  def testApplyBlobCache(self):
+    """Tests taking data blobs from a blob cache rather than fetching them."""
+    cache = blob_cache.BlobCache(os.path.join(self.test_dir, 'cache'),
+                                 populate=True)
+    for _ in range(2):
+      payload = downloader.RemotePayload(self.server.url, backoff=0,
+                                         blob_cache=cache)
+      payload.Init()
+      num_requests = self.server.num_requests
+      stats = self._Apply(payload, verify=True)
+      payload.Close()
+
+    # Only the signature blob was fetched.
+    self.assertEqual(num_requests + 1, self.server.num_requests)
+    self.assertEqual(8 * _BLOCK_SIZE, stats[blob_cache.STAT_HIT_BYTES])
+
+  def testApplyWithinWindow(self):
+    """Tests applying with a window smaller than the data blobs."""
+    payload = downloader.RemotePayload(self.server.url,
+                                       payload_size=len(self.payload_data),
+                                       window_size=1, num_workers=3,
+                                       backoff=0)
+    payload.Init()
+    self._Apply(payload, verify=True)
+    payload.Close()
+
+  def testApplyErrors(self):
+    """Tests failing to apply remote payloads."""
+    payload = downloader.RemotePayload(self.server.url, max_retries=0)
+    payload.Init()
+    self.assertRaises(PayloadError, self._Apply, payload, part_workers=2)
+    self.server.num_failures = 1
+    self.assertRaises(PayloadError, self._Apply, payload)
+    payload.Close()
+
+    self.assertRaises(PayloadError, downloader.RemotePayload(
+        self.server.url, payload_size=len(self.payload_data) - 1).Init)
+
+
+if __name__ == '__main__':
+  unittest.main()
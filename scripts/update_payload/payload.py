@@ -20,7 +20,10 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import hashlib
+import io
+import mmap
 import struct
+import threading
 
 from update_payload import applier
 from update_payload import checker
@@ -55,6 +58,105 @@ def _ReadInt(file_obj, size, is_unsigned, hasher=None):
                        common.Read(file_obj, size, hasher=hasher))[0]
 
 
+#
+# Verifying data while applying.
+#
+STAT_SIG_HASHED_WHILE_APPLYING_BYTES = 'sig_hashed_while_applying_bytes'
+STAT_SIG_HASHED_BY_READING_BYTES = 'sig_hashed_by_reading_bytes'
+
+
+class _DataVerifier(object):
+  """Verifies data blobs as they are read and hashes the data section.
+
+  Each blob read is checked against the data_sha256_hash of its operation.
+  The payload signature covers the metadata and all the data preceding the
+  signature blob; blobs are normally read in order, in which case they feed
+  the signature hash directly. Data that is skipped over, e.g. blobs of
+  operations applied before resuming, is read separately, so the hash is
+  correct whatever the order of reads.
+  """
+
+  _GAP_CHUNK_SIZE = 1024 * 1024
+
+  def __init__(self, payload):
+    """Initializes the verifier.
+
+    Args:
+      payload: the (initialized) payload whose blobs are verified
+    """
+    self.payload = payload
+    manifest = payload.manifest
+    self.sigs_offset = (manifest.signatures_offset
+                        if manifest.HasField('signatures_offset') else None)
+    self.payload_hasher = payload.manifest_hasher.copy()
+    self.hashed_offset = 0
+    self.stats = {STAT_SIG_HASHED_WHILE_APPLYING_BYTES: 0,
+                  STAT_SIG_HASHED_BY_READING_BYTES: 0}
+    # Maps the (offset, length) of each hashed blob to its hash and the name
+    # of its operation.
+    self.blob_hashes = {}
+    for part in manifest.partitions:
+      for op, op_name in common.OperationIter(
+          part.operations, '%s_install_operations' % part.partition_name):
+        if op.HasField('data_sha256_hash'):
+          self.blob_hashes[(op.data_offset, op.data_length)] = (
+              op.data_sha256_hash, op_name)
+    self._lock = threading.Lock()
+
+  def _HashUpTo(self, offset):
+    """Reads and hashes the data section up to a given offset."""
+    offset = min(offset, self.sigs_offset)
+    while self.hashed_offset < offset:
+      length = min(offset - self.hashed_offset, self._GAP_CHUNK_SIZE)
+      self.payload_hasher.update(
+          self.payload._ReadDataBlob(self.hashed_offset, length))
+      self.hashed_offset += length
+      self.stats[STAT_SIG_HASHED_BY_READING_BYTES] += length
+
+  def BlobRead(self, offset, length, data):
+    """Verifies a data blob that was read and passes it to the payload hash.
+
+    Args:
+      offset: offset to the beginning of the blob from the end of the manifest
+      length: the blob's length
+      data: the blob's content
+
+    Raises:
+      PayloadError if the blob does not match its hash.
+    """
+    with self._lock:
+      expected = self.blob_hashes.get((offset, length))
+      if expected:
+        expected_hash, op_name = expected
+        actual_hash = hashlib.sha256(data).digest()
+        if actual_hash != expected_hash:
+          raise PayloadError(
+              '%s: data_sha256_hash (%s) does not match actual hash (%s).' %
+              (op_name, common.FormatSha256(expected_hash),
+               common.FormatSha256(actual_hash)))
+
+      if self.sigs_offset is None:
+        return
+      self._HashUpTo(offset)
+      if (offset == self.hashed_offset and
+          offset + length <= self.sigs_offset):
+        self.payload_hasher.update(data)
+        self.hashed_offset += length
+        self.stats[STAT_SIG_HASHED_WHILE_APPLYING_BYTES] += length
+
+  def Digest(self):
+    """Hashes any remaining data and returns the payload hash digest.
+
+    Returns:
+      The digest, or None if the payload has no signatures.
+    """
+    if self.sigs_offset is None:
+      return None
+    with self._lock:
+      self._HashUpTo(self.sigs_offset)
+    return self.payload_hasher.digest()
+
+
 #
 # Update payload.
 #
@@ -112,15 +214,32 @@ class Payload(object):
             payload_file, self._METADATA_SIGNATURE_LEN_SIZE, True,
             hasher=hasher)
 
-  def __init__(self, payload_file, payload_file_offset=0):
+  def __init__(self, payload_file, payload_file_offset=0, use_mmap=False,
+               metadata_only=False, blob_cache=None):
     """Initialize the payload object.
 
     Args:
       payload_file: update payload file object open for reading
       payload_file_offset: the offset of the actual payload
+      use_mmap: whether to map the payload file into memory and return data
+                blobs as views into it, rather than reading them; ignored if
+                the file cannot be mapped (optional)
+      metadata_only: whether the payload file holds only the payload metadata,
+                     i.e. its header and manifest, optionally followed by the
+                     metadata signature, e.g. as fetched with an HTTP range
+                     request ahead of the whole payload (optional)
+      blob_cache: a blob_cache.BlobCache to take data blobs from when cached,
+                  and to add the data blobs read to if populated (optional)
     """
     self.payload_file = payload_file
     self.payload_file_offset = payload_file_offset
+    self.use_mmap = use_mmap and not metadata_only
+    self.metadata_only = metadata_only
+    self._mmap = None
+    self._mmap_view = None
+    self.blob_cache = blob_cache
+    self._blob_hashes = None
+    self._data_verifier = None
     self.manifest_hasher = None
     self.is_init = False
     self.header = None
@@ -128,6 +247,8 @@ class Payload(object):
     self.data_offset = None
     self.metadata_signature = None
     self.metadata_size = None
+    # Serializes the seek/read pairs of data blob readers running in parallel.
+    self._read_lock = threading.Lock()
 
   def _ReadHeader(self):
     """Reads and returns the payload header.
@@ -182,15 +303,45 @@ class Payload(object):
       offset: offset to the beginning of the blob from the end of the manifest
       length: the blob's length
 
+    Blobs with a hash are taken from the blob cache if there is one and they
+    are cached, and added to it otherwise if it is populated.
+
     Returns:
-      A string containing the raw blob data.
+      A string containing the raw blob data, or a memoryview of it if the
+      payload file is mapped into memory.
 
     Raises:
-      PayloadError if a read error occurred.
+      PayloadError if a read error occurred, the blob is not part of the
+      metadata of a metadata-only payload, or the blob does not match its
+      hash while verifying data (see VerifyAndApply).
     """
-    return common.Read(self.payload_file, length,
-                       offset=self.payload_file_offset + self.data_offset +
-                       offset)
+    if self.metadata_only and offset + length > 0:
+      raise PayloadError('data blob at offset %d not available in payload '
+                         'metadata' % offset)
+    blob_hash = self.blob_cache and self.GetBlobHash(offset, length)
+    data = self.blob_cache.Get(blob_hash) if blob_hash else None
+    if data is None:
+      data = self._ReadDataBlob(offset, length)
+      if blob_hash:
+        self.blob_cache.Put(data)
+    if self._data_verifier:
+      self._data_verifier.BlobRead(offset, length, data)
+    return data
+
+  def _ReadDataBlob(self, offset, length):
+    """Reads and returns a single data blob, without verifying it."""
+    if self._mmap_view is not None:
+      start = self.payload_file_offset + self.data_offset + offset
+      if start < 0 or start + length > len(self._mmap_view):
+        raise PayloadError(
+            'reading from mapped file too short (%d instead of %d bytes)' %
+            (min(max(len(self._mmap_view) - start, 0), length), length))
+      return self._mmap_view[start:start + length]
+
+    with self._read_lock:
+      return common.Read(self.payload_file, length,
+                         offset=self.payload_file_offset + self.data_offset +
+                         offset)
 
   def Init(self):
     """Initializes the payload object.
@@ -215,17 +366,89 @@ class Payload(object):
     self.manifest = update_metadata_pb2.DeltaArchiveManifest()
     self.manifest.ParseFromString(manifest_raw)
 
-    # Read the metadata signature (if any).
-    metadata_signature_raw = self._ReadMetadataSignature()
+    self.metadata_size = self.header.size + self.header.manifest_len
+    self.data_offset = self.metadata_size + self.header.metadata_signature_len
+
+    # Read the metadata signature (if any). It may be missing from payload
+    # metadata, which is then usually verified with a separate signature.
+    if self.metadata_only:
+      self.payload_file.seek(0, 2)
+      has_metadata_signature = (self.payload_file.tell() >=
+                                self.payload_file_offset + self.data_offset)
+    else:
+      has_metadata_signature = True
+    metadata_signature_raw = (has_metadata_signature and
+                              self._ReadMetadataSignature())
     if metadata_signature_raw:
       self.metadata_signature = update_metadata_pb2.Signatures()
       self.metadata_signature.ParseFromString(metadata_signature_raw)
 
-    self.metadata_size = self.header.size + self.header.manifest_len
-    self.data_offset = self.metadata_size + self.header.metadata_signature_len
+    if self.use_mmap:
+      self._MapFile()
 
     self.is_init = True
 
+  def _MapFile(self):
+    """Maps the payload file into memory.
+
+    The file is left unmapped if it cannot be mapped, e.g. because it is not
+    backed by a file descriptor.
+    """
+    try:
+      self._mmap = mmap.mmap(self.payload_file.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+    except (AttributeError, io.UnsupportedOperation, ValueError, OSError,
+            mmap.error):
+      return
+    self._mmap_view = memoryview(self._mmap)
+
+  def Close(self):
+    """Releases the memory mapping of the payload file, if any.
+
+    Data blobs are read from the file from then on. The payload file itself is
+    left open, as it is owned by the caller. A mapping still referenced by
+    blobs returned earlier is released once they are gone.
+    """
+    self._mmap_view = None
+    if self._mmap is not None:
+      try:
+        self._mmap.close()
+      except BufferError:
+        pass
+      self._mmap = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.Close()
+
+  def GetBlobHash(self, offset, length):
+    """Returns the hash of a data blob, as given by its operations.
+
+    Args:
+      offset: offset to the beginning of the blob from the end of the manifest
+      length: the blob's length
+
+    Returns:
+      The SHA-256 digest of the blob, or None if its operations have none.
+    """
+    self._AssertInit()
+    if self._blob_hashes is None:
+      blob_hashes = {}
+      for part in self.manifest.partitions:
+        for op in part.operations:
+          if op.HasField('data_sha256_hash'):
+            blob_hashes[(op.data_offset, op.data_length)] = (
+                op.data_sha256_hash)
+      # Mark the cached blobs of the payload as in use up front, so that
+      # adding the others does not evict them before they are read.
+      if self.blob_cache:
+        for blob_hash in blob_hashes.values():
+          self.blob_cache.Contains(blob_hash)
+      self._blob_hashes = blob_hashes
+    return self._blob_hashes.get((offset, length))
+
   def Describe(self):
     """Emits the payload embedded description data to standard output."""
     def _DescribeImageInfo(description, image_info):
@@ -256,6 +479,11 @@ class Payload(object):
     if not self.is_init:
       raise PayloadError('payload object not initialized')
 
+  def _AssertData(self):
+    """Raises an exception if the payload data is not available."""
+    if self.metadata_only:
+      raise PayloadError('payload data not available in payload metadata')
+
   def ResetFile(self):
     """Resets the offset of the payload file to right past the manifest."""
     self.payload_file.seek(self.payload_file_offset + self.data_offset)
@@ -273,7 +501,10 @@ class Payload(object):
   def Check(self, pubkey_file_name=None, metadata_sig_file=None,
             metadata_size=0, report_out_file=None, assert_type=None,
             block_size=0, part_sizes=None, allow_unhashed=False,
-            disabled_tests=()):
+            disabled_tests=(), check_level=None,
+            sample_fraction=checker.DEFAULT_SAMPLE_FRACTION, sample_seed=None,
+            payload_size=None, hash_workers=0,
+            report_format=checker.REPORT_FORMAT_TEXT):
     """Checks the payload integrity.
 
     Args:
@@ -286,25 +517,129 @@ class Payload(object):
       part_sizes: map of partition label to (physical) size in bytes
       allow_unhashed: allow unhashed operation blobs
       disabled_tests: list of tests to disable
+      check_level: one of checker.CHECK_LEVELS; the metadata level reads no
+                   data blobs, the sampled level verifies a random subset of
+                   them, and the full level all of them and the signatures
+                   (default: metadata for metadata-only payloads, full
+                   otherwise)
+      sample_fraction: fraction of data blobs verified at the sampled level
+      sample_seed: seed for sampling data blobs (optional)
+      payload_size: expected payload size, if only part of the payload file
+                    is available; required for metadata-only payloads
+      hash_workers: number of threads hashing data blobs in parallel
+                    (optional)
+      report_format: one of checker.REPORT_FORMATS (optional)
 
     Raises:
       PayloadError if payload verification failed.
     """
     self._AssertInit()
+    if self.metadata_only:
+      if check_level not in (None, checker.CHECK_LEVEL_METADATA):
+        self._AssertData()
+      if payload_size is None:
+        raise PayloadError('checking payload metadata requires the payload '
+                           'size')
+      check_level = checker.CHECK_LEVEL_METADATA
+    elif check_level is None:
+      check_level = checker.CHECK_LEVEL_FULL
 
     # Create a short-lived payload checker object and run it.
     helper = checker.PayloadChecker(
         self, assert_type=assert_type, block_size=block_size,
-        allow_unhashed=allow_unhashed, disabled_tests=disabled_tests)
+        allow_unhashed=allow_unhashed, disabled_tests=disabled_tests,
+        check_level=check_level, sample_fraction=sample_fraction,
+        sample_seed=sample_seed, hash_workers=hash_workers)
     helper.Run(pubkey_file_name=pubkey_file_name,
                metadata_sig_file=metadata_sig_file,
                metadata_size=metadata_size,
                part_sizes=part_sizes,
-               report_out_file=report_out_file)
+               report_out_file=report_out_file,
+               payload_size=payload_size,
+               report_format=report_format)
+
+  def VerifyAndApply(self, new_parts, old_parts=None, pubkey_file_name=None,
+                     metadata_sig_file=None, metadata_size=0,
+                     report_out_file=None, assert_type=None, block_size=0,
+                     part_sizes=None, allow_unhashed=False, disabled_tests=(),
+                     payload_size=None,
+                     report_format=checker.REPORT_FORMAT_TEXT, **apply_args):
+    """Checks and applies the update payload, reading each data blob once.
+
+    Checking and then applying a payload reads its data three times: to
+    verify the hash of each blob, to compute the hash of the whole payload
+    for its signature, and to apply it. Instead, this checks everything but
+    the data up front, then verifies each blob against its hash as it is read
+    for applying, right before it is applied, and feeds it to the payload
+    hash at the same time. The payload signatures are checked once all
+    partitions are applied, so they must not be trusted before this returns.
+    Partitions are applied one at a time, in order.
+
+    Args:
+      new_parts: map of partition name to dest partition file
+      old_parts: map of partition name to partition file (optional)
+      pubkey_file_name: public key used for signature verification
+      metadata_sig_file: metadata signature, if verification is desired
+      metadata_size: metadata size, if verification is desired
+      report_out_file: file object to dump the report to
+      assert_type: assert that payload is either 'full' or 'delta'
+      block_size: expected filesystem / payload block size
+      part_sizes: map of partition label to (physical) size in bytes
+      allow_unhashed: allow unhashed operation blobs
+      disabled_tests: list of tests to disable
+      payload_size: expected payload size (default: the size of the payload
+                    file); required for payload streams
+      report_format: one of checker.REPORT_FORMATS (optional)
+      apply_args: further arguments to Apply (optional)
+
+    Returns:
+      A dictionary of counters collected while applying, including the
+      number of bytes of the payload hash computed from the blobs applied vs
+      by reading the payload.
+
+    Raises:
+      PayloadError if payload verification or application failed.
+    """
+    self._AssertInit()
+    self._AssertData()
+    if apply_args.get('part_workers', 1) > 1:
+      raise PayloadError('verifying while applying requires applying '
+                         'partitions serially')
+
+    helper = checker.PayloadChecker(
+        self, assert_type=assert_type, block_size=block_size,
+        allow_unhashed=allow_unhashed, disabled_tests=disabled_tests,
+        check_level=checker.CHECK_LEVEL_METADATA)
+    helper.Run(pubkey_file_name=pubkey_file_name,
+               metadata_sig_file=metadata_sig_file,
+               metadata_size=metadata_size,
+               part_sizes=part_sizes,
+               report_out_file=report_out_file,
+               payload_size=payload_size,
+               report_format=report_format)
+
+    self._data_verifier = _DataVerifier(self)
+    try:
+      stats = self.Apply(new_parts, old_parts=old_parts, **apply_args)
+      payload_hash = self._data_verifier.Digest()
+      stats.update(self._data_verifier.stats)
+    finally:
+      self._data_verifier = None
+
+    if helper.check_payload_sig and helper.sigs_size:
+      helper.CheckPayloadSignatures(payload_hash,
+                                    pubkey_file_name=pubkey_file_name,
+                                    report_out_file=report_out_file,
+                                    report_format=report_format)
+    return stats
 
   def Apply(self, new_parts, old_parts=None, bsdiff_in_place=True,
             bspatch_path=None, puffpatch_path=None,
-            truncate_to_expected_size=True):
+            truncate_to_expected_size=True, part_workers=1,
+            part_worker_type='thread', decompress_workers=0,
+            decompress_buffer_size=0, use_copy_file_range=True,
+            patch_backend='auto', journal_file_name=None, resume=False,
+            source_verification='before'):
     """Applies the update payload.
 
     Args:
@@ -316,15 +651,154 @@ class Payload(object):
       truncate_to_expected_size: whether to truncate the resulting partitions
                                  to their expected sizes, as specified in the
                                  payload (optional)
+      part_workers: number of partitions to apply concurrently (optional)
+      part_worker_type: 'thread' or 'process' partition workers (optional)
+      decompress_workers: number of processes decompressing full partition
+                          update data in parallel (optional)
+      decompress_buffer_size: maximum size of data chunks decompressed at once
+                              when decompressing inline (optional)
+      use_copy_file_range: whether to let the kernel copy SOURCE_COPY data,
+                           where supported (optional)
+      patch_backend: 'python', 'external' or 'auto' bsdiff patching (optional)
+      journal_file_name: file to checkpoint progress to (optional)
+      resume: whether to resume from the progress recorded in the journal
+              (optional)
+      source_verification: whether to verify source partitions 'before' or
+                           'concurrent'ly with applying, or only the source
+                           data of 'operations' (optional)
+
+    Returns:
+      A dictionary of counters collected while applying, including those of
+      the blob cache, if any.
 
     Raises:
       PayloadError if payload application failed.
     """
     self._AssertInit()
+    self._AssertData()
 
     # Create a short-lived payload applier object and run it.
     helper = applier.PayloadApplier(
         self, bsdiff_in_place=bsdiff_in_place, bspatch_path=bspatch_path,
         puffpatch_path=puffpatch_path,
-        truncate_to_expected_size=truncate_to_expected_size)
-    helper.Run(new_parts, old_parts=old_parts)
+        truncate_to_expected_size=truncate_to_expected_size,
+        part_workers=part_workers, part_worker_type=part_worker_type,
+        decompress_workers=decompress_workers,
+        decompress_buffer_size=decompress_buffer_size,
+        use_copy_file_range=use_copy_file_range,
+        patch_backend=patch_backend, journal_file_name=journal_file_name,
+        resume=resume, source_verification=source_verification)
+    stats = helper.Run(new_parts, old_parts=old_parts)
+    if self.blob_cache:
+      stats.update(self.blob_cache.stats)
+    return stats
+
+
+#
+# Streamed update payload.
+#
+class _StreamReader(object):
+  """A file-like object reading a non-seekable stream front to back.
+
+  Seeking is only allowed to the current position, which is all that reading
+  a payload in order requires.
+  """
+
+  def __init__(self, stream):
+    """Initializes the reader.
+
+    Args:
+      stream: the stream object, e.g. an HTTP response or a pipe
+    """
+    self.stream = stream
+    self.name = getattr(stream, 'name', '<stream>')
+    self.pos = 0
+
+  def read(self, length):
+    """Reads up to length bytes, fewer only at the end of the stream."""
+    chunks = []
+    remaining = length
+    while remaining > 0:
+      chunk = self.stream.read(remaining)
+      if not chunk:
+        break
+      chunks.append(chunk)
+      remaining -= len(chunk)
+    data = b''.join(chunks)
+    self.pos += len(data)
+    return data
+
+  def tell(self):
+    return self.pos
+
+  def seek(self, offset, whence=0):
+    if whence == 2:
+      raise PayloadError('cannot seek to the end of a payload stream; its '
+                         'size must be given')
+    if whence == 1:
+      offset += self.pos
+    if offset != self.pos:
+      raise PayloadError('cannot seek in a payload stream (from %d to %d)' %
+                         (self.pos, offset))
+
+
+class StreamingPayload(Payload):
+  """Update payload read from a non-seekable stream as it arrives.
+
+  The header, manifest and metadata signature are read by Init, after which
+  data blobs must be read in ascending offset order, as applying a payload
+  whose data is contiguous does (which the checker enforces). This way, a
+  payload can be applied while it is being downloaded, without storing it.
+  Data skipped over, e.g. blobs of operations applied before resuming, is
+  still read and hashed. Use VerifyAndApply with the payload size to check
+  the payload as it is applied; its signatures are checked once the whole
+  stream was read.
+  """
+
+  _SKIP_CHUNK_SIZE = 1024 * 1024
+
+  def __init__(self, payload_stream):
+    """Initialize the payload object.
+
+    Args:
+      payload_stream: the update payload stream, open for reading
+    """
+    super(StreamingPayload, self).__init__(_StreamReader(payload_stream))
+
+  def ReadDataBlob(self, offset, length):
+    """Reads and returns the next data blob from the update payload stream.
+
+    Args:
+      offset: offset to the beginning of the blob from the end of the manifest
+      length: the blob's length
+
+    Returns:
+      A string containing the raw blob data.
+
+    Raises:
+      PayloadError if a read error occurred, the blob precedes data already
+      read, or the blob does not match its hash while verifying data.
+    """
+    if not length:
+      return b''
+    pos = self.payload_file.tell() - self.data_offset
+    if offset < pos:
+      raise PayloadError('data blob at offset %d already streamed past '
+                         '(at offset %d)' % (offset, pos))
+    while pos < offset:
+      skip_length = min(offset - pos, self._SKIP_CHUNK_SIZE)
+      super(StreamingPayload, self).ReadDataBlob(pos, skip_length)
+      pos += skip_length
+    return super(StreamingPayload, self).ReadDataBlob(offset, length)
+
+  def Apply(self, new_parts, part_workers=1, **apply_args):
+    """Applies the update payload as it is read from the stream.
+
+    See Payload.Apply for the arguments, except that partitions can only be
+    applied one at a time.
+    """
+    if part_workers > 1:
+      raise PayloadError('payload streams must be applied one partition at '
+                         'a time')
+    return super(StreamingPayload, self).Apply(
+        new_parts, part_workers=part_workers, **apply_args)
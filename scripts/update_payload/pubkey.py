@@ -0,0 +1,235 @@
+#
+# Copyright (C) 2013 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""In-process verification of RSA signatures against PEM public keys.
+
+Recovers the data signed with PKCS#1 v1.5 padding, as `openssl rsautl
+-verify' does. Uses the optional cryptography module if available, or else a
+plain modular exponentiation, which is cheap enough for the few signatures
+of a payload.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import binascii
+import re
+
+try:
+  # pylint: disable=import-error
+  from cryptography import exceptions as crypto_exceptions
+  from cryptography.hazmat.backends import default_backend
+  from cryptography.hazmat.primitives import serialization
+  from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:
+  serialization = None
+
+from update_payload.error import PayloadError
+
+
+#
+# Constants.
+#
+_PEM_RE = re.compile(
+    br'-----BEGIN ([A-Z ]+)-----\s*(.*?)\s*-----END \1-----', re.DOTALL)
+_PEM_PUBLIC_KEY = b'PUBLIC KEY'
+_PEM_RSA_PUBLIC_KEY = b'RSA PUBLIC KEY'
+
+# DER tags.
+_DER_INTEGER = 0x02
+_DER_BIT_STRING = 0x03
+_DER_OID = 0x06
+_DER_SEQUENCE = 0x30
+
+# The rsaEncryption algorithm identifier (1.2.840.113549.1.1.1).
+_RSA_ENCRYPTION_OID = b'\x2a\x86\x48\x86\xf7\x0d\x01\x01\x01'
+
+# Minimum number of 0xff padding bytes of PKCS#1 v1.5 signatures.
+_MIN_PADDING_SIZE = 8
+
+
+#
+# Helper functions.
+#
+def _ReadDer(der, pos, tag):
+  """Reads a DER element header.
+
+  Args:
+    der: the DER-encoded data, as a bytearray
+    pos: the position of the element
+    tag: the expected tag of the element
+
+  Returns:
+    A pair consisting of the start and end positions of the element content.
+
+  Raises:
+    PayloadError if the element is malformed or has another tag.
+  """
+  if pos + 2 > len(der) or der[pos] != tag:
+    raise PayloadError('unexpected public key DER element at %d' % pos)
+  length = der[pos + 1]
+  pos += 2
+  if length & 0x80:
+    num_bytes = length & 0x7f
+    if not num_bytes or pos + num_bytes > len(der):
+      raise PayloadError('invalid public key DER length at %d' % pos)
+    length = 0
+    for byte in der[pos:pos + num_bytes]:
+      length = (length << 8) | byte
+    pos += num_bytes
+  if pos + length > len(der):
+    raise PayloadError('truncated public key DER element at %d' % pos)
+  return pos, pos + length
+
+
+def _ReadDerInteger(der, pos):
+  """Reads a non-negative DER integer, returning it and the next position."""
+  start, end = _ReadDer(der, pos, _DER_INTEGER)
+  if start == end:
+    raise PayloadError('empty public key DER integer at %d' % pos)
+  return int(binascii.hexlify(der[start:end]), 16), end
+
+
+def _ParseRsaPublicKey(der):
+  """Parses a PKCS#1 RSAPublicKey, returning its modulus and exponent."""
+  der = bytearray(der)
+  start, end = _ReadDer(der, 0, _DER_SEQUENCE)
+  modulus, pos = _ReadDerInteger(der, start)
+  exponent, pos = _ReadDerInteger(der, pos)
+  if pos != end:
+    raise PayloadError('trailing data in RSA public key')
+  return modulus, exponent
+
+
+def _ParseSubjectPublicKeyInfo(der):
+  """Parses an X.509 SubjectPublicKeyInfo, returning the RSA key in it."""
+  der = bytearray(der)
+  start, _ = _ReadDer(der, 0, _DER_SEQUENCE)
+  algorithm_start, algorithm_end = _ReadDer(der, start, _DER_SEQUENCE)
+  oid_start, oid_end = _ReadDer(der, algorithm_start, _DER_OID)
+  if der[oid_start:oid_end] != _RSA_ENCRYPTION_OID:
+    raise PayloadError('public key is not an RSA key')
+  key_start, key_end = _ReadDer(der, algorithm_end, _DER_BIT_STRING)
+  # The first byte of a bit string is the number of unused bits.
+  if key_start == key_end or der[key_start]:
+    raise PayloadError('invalid public key bit string')
+  return _ParseRsaPublicKey(der[key_start + 1:key_end])
+
+
+#
+# Public keys.
+#
+class PublicKey(object):
+  """An RSA public key verifying PKCS#1 v1.5 signatures."""
+
+  def __init__(self, modulus, exponent, crypto_key=None):
+    """Initializes the key.
+
+    Args:
+      modulus: the RSA modulus
+      exponent: the RSA public exponent
+      crypto_key: an equivalent key of the cryptography module, to verify
+                  signatures with (optional)
+    """
+    self.modulus = modulus
+    self.exponent = exponent
+    self.size = (modulus.bit_length() + 7) // 8
+    self._crypto_key = crypto_key
+
+  def Recover(self, sig_data):
+    """Recovers the data signed by a signature.
+
+    Args:
+      sig_data: the raw signature
+
+    Returns:
+      The signed data, stripped of its padding.
+
+    Raises:
+      PayloadError if the signature was not made with the matching private
+      key.
+    """
+    sig_data = bytes(sig_data)
+    if len(sig_data) != self.size:
+      raise PayloadError('signature size (%d) not matching key size (%d)' %
+                         (len(sig_data), self.size))
+
+    if self._crypto_key:
+      try:
+        return self._crypto_key.recover_data_from_signature(
+            sig_data, padding.PKCS1v15(), None)
+      except crypto_exceptions.InvalidSignature:
+        raise PayloadError('signature verification failed')
+
+    sig = int(binascii.hexlify(sig_data), 16)
+    if sig >= self.modulus:
+      raise PayloadError('signature verification failed')
+    padded = bytearray(binascii.unhexlify(
+        '%0*x' % (2 * self.size, pow(sig, self.exponent, self.modulus))))
+
+    # Strip the 0x00 0x01 0xff ... 0xff 0x00 padding.
+    sep = padded.find(b'\0', 2)
+    if (padded[:2] != b'\0\1' or sep < 2 + _MIN_PADDING_SIZE or
+        padded[2:sep].strip(b'\xff')):
+      raise PayloadError('signature verification failed')
+    return bytes(padded[sep + 1:])
+
+
+def LoadPublicKey(file_name):
+  """Loads an RSA public key from a PEM file.
+
+  Both X.509 SubjectPublicKeyInfo (BEGIN PUBLIC KEY) and PKCS#1 (BEGIN RSA
+  PUBLIC KEY) encodings are supported.
+
+  Args:
+    file_name: the name of the PEM file
+
+  Returns:
+    A PublicKey object.
+
+  Raises:
+    PayloadError if the file cannot be read or has no valid RSA public key.
+  """
+  try:
+    with open(file_name, 'rb') as pem_file:
+      pem_data = pem_file.read()
+  except IOError as e:
+    raise PayloadError('error reading public key (%s): %s' % (file_name, e))
+
+  match = _PEM_RE.search(pem_data)
+  if not match or match.group(1) not in (_PEM_PUBLIC_KEY,
+                                         _PEM_RSA_PUBLIC_KEY):
+    raise PayloadError('no PEM public key found in %s' % file_name)
+  try:
+    der = base64.b64decode(match.group(2))
+  except (TypeError, ValueError, binascii.Error) as e:
+    raise PayloadError('invalid PEM public key in %s: %s' % (file_name, e))
+
+  if match.group(1) == _PEM_PUBLIC_KEY:
+    modulus, exponent = _ParseSubjectPublicKeyInfo(der)
+  else:
+    modulus, exponent = _ParseRsaPublicKey(der)
+
+  # Keys the cryptography module cannot load, e.g. because of its version or
+  # backend, are still verified with the plain modular exponentiation.
+  crypto_key = None
+  if serialization:
+    try:
+      crypto_key = serialization.load_pem_public_key(
+          match.group(0), backend=default_backend())
+    except (ValueError, TypeError, crypto_exceptions.UnsupportedAlgorithm):
+      pass
+  return PublicKey(modulus, exponent, crypto_key=crypto_key)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Unit tests for pubkey.py."""
+
+# Disable check for function names to avoid errors based on old code
+# pylint: disable-msg=invalid-name
+
+from __future__ import absolute_import
+
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock  # pylint: disable=import-error
+
+from update_payload import common
+from update_payload import pubkey
+from update_payload import test_utils
+from update_payload.error import PayloadError
+
+
+class PublicKeyTest(unittest.TestCase):
+  """Tests loading public keys and verifying signatures with them."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.signed_data = (common.SIG_ASN1_HEADER +
+                        hashlib.sha256(b'fake-data').digest())
+    self.sig_data = test_utils.SignSha256(b'fake-data',
+                                          test_utils._PRIVKEY_FILE_NAME)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _WritePem(self, label, der):
+    """Writes DER data to a PEM file, returning its name."""
+    file_name = os.path.join(self.test_dir, 'key.pem')
+    with open(file_name, 'wb') as pem_file:
+      pem_file.write(b'-----BEGIN %s-----\n%s\n-----END %s-----\n' %
+                     (label, base64.b64encode(der), label))
+    return file_name
+
+  @staticmethod
+  def _ReadDer(file_name):
+    """Returns the DER data of a PEM file."""
+    with open(file_name, 'rb') as pem_file:
+      return base64.b64decode(b''.join(pem_file.read().splitlines()[1:-1]))
+
+  def testRecover(self):
+    """Tests recovering signed data with a SubjectPublicKeyInfo key."""
+    key = pubkey.LoadPublicKey(test_utils._PUBKEY_FILE_NAME)
+    self.assertEqual(256, key.size)
+    self.assertEqual(65537, key.exponent)
+    self.assertEqual(self.signed_data, key.Recover(self.sig_data))
+
+  def testRecoverRsaPublicKey(self):
+    """Tests recovering signed data with a PKCS#1 key."""
+    # The RSAPublicKey is the bit string at the end of the
+    # SubjectPublicKeyInfo, past its unused bits byte.
+    der = self._ReadDer(test_utils._PUBKEY_FILE_NAME)
+    key = pubkey.LoadPublicKey(self._WritePem(b'RSA PUBLIC KEY', der[-270:]))
+    self.assertEqual(self.signed_data, key.Recover(self.sig_data))
+
+  def testRecoverErrors(self):
+    """Tests that signatures not matching the key are rejected."""
+    key = pubkey.LoadPublicKey(test_utils._PUBKEY_FILE_NAME)
+    other_key = pubkey.LoadPublicKey(
+        os.path.join(os.path.dirname(pubkey.__file__),
+                     'update-payload-key.pub.pem'))
+    bad_sig_data = (self.sig_data[:100] +
+                    bytes(bytearray([self.sig_data[100:101][0] ^ 1])) +
+                    self.sig_data[101:])
+    for bad_key, bad_sig in ((other_key, self.sig_data),
+                             (key, bad_sig_data),
+                             (key, self.sig_data[1:]),
+                             (key, b'\xff' * 256)):
+      self.assertRaises(PayloadError, bad_key.Recover, bad_sig)
+
+  def testLoadPublicKeyErrors(self):
+    """Tests that invalid key files are rejected."""
+    der = self._ReadDer(test_utils._PUBKEY_FILE_NAME)
+    bad_key_files = [
+        os.path.join(self.test_dir, 'missing.pem'),
+        self._WritePem(b'PRIVATE KEY', der),
+        self._WritePem(b'PUBLIC KEY', der[:-1]),
+        # Not an rsaEncryption algorithm identifier.
+        self._WritePem(b'PUBLIC KEY', der[:16] + b'\x02' + der[17:]),
+    ]
+    for file_name in bad_key_files:
+      self.assertRaises(PayloadError, pubkey.LoadPublicKey, file_name)
+
+  def testCryptographyBackend(self):
+    """Tests verifying signatures with the cryptography module."""
+    with mock.patch.object(pubkey, 'serialization', create=True) \
+         as serialization, \
+         mock.patch.object(pubkey, 'padding', create=True), \
+         mock.patch.object(pubkey, 'default_backend', create=True), \
+         mock.patch.object(pubkey, 'crypto_exceptions', create=True) \
+         as crypto_exceptions:
+      crypto_exceptions.InvalidSignature = ValueError
+      crypto_exceptions.UnsupportedAlgorithm = NotImplementedError
+      crypto_key = serialization.load_pem_public_key.return_value
+      crypto_key.recover_data_from_signature.return_value = self.signed_data
+      key = pubkey.LoadPublicKey(test_utils._PUBKEY_FILE_NAME)
+      self.assertEqual(self.signed_data, key.Recover(self.sig_data))
+
+      crypto_key.recover_data_from_signature.side_effect = ValueError
+      self.assertRaises(PayloadError, key.Recover, self.sig_data)
+
+      # Keys the module fails to load are verified without it.
+      crypto_key.recover_data_from_signature.side_effect = None
+      serialization.load_pem_public_key.side_effect = NotImplementedError
+      key = pubkey.LoadPublicKey(test_utils._PUBKEY_FILE_NAME)
+      self.assertIsNone(key._crypto_key)
+      self.assertEqual(self.signed_data, key.Recover(self.sig_data))
+
+
+if __name__ == '__main__':
+  unittest.main()
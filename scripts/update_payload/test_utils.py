@@ -19,11 +19,17 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import bz2
 import io
 import hashlib
 import os
+import re
 import struct
 import subprocess
+import threading
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
 
 from update_payload import common
 from update_payload import payload
@@ -109,6 +115,62 @@ def SignSha256(data, privkey_file_name):
   return sig
 
 
+def _EncodeBsdiffInt(val):
+  """Encodes an integer as a sign-magnitude 64-bit bsdiff patch field."""
+  if val < 0:
+    return struct.pack('<Q', -val | (1 << 63))
+  return struct.pack('<Q', val)
+
+
+def EncodeBsdiffPatch(ctrl_entries, diff, extra, new_length,
+                      compressors=None):
+  """Encodes the streams of a bsdiff patch.
+
+  Args:
+    ctrl_entries: sequence of (add length, copy length, seek length) tuples
+    diff: the diff stream
+    extra: the extra stream
+    new_length: the length of the patched data
+    compressors: BSDF2 compressor types of the control, diff and extra
+                 streams, where 0 is none and 1 is bzip2 (optional; a
+                 BSDIFF40 patch is made if not given)
+
+  Returns:
+    The patch content.
+  """
+  if compressors is None:
+    header = b'BSDIFF40'
+    compressors = (1, 1, 1)
+  else:
+    header = b'BSDF2' + bytes(bytearray(compressors))
+  ctrl = b''.join(_EncodeBsdiffInt(val) for entry in ctrl_entries
+                  for val in entry)
+  streams = [bz2.compress(stream) if compressor == 1 else stream
+             for stream, compressor in zip((ctrl, diff, extra), compressors)]
+  return b''.join([header, _EncodeBsdiffInt(len(streams[0])),
+                   _EncodeBsdiffInt(len(streams[1])),
+                   _EncodeBsdiffInt(new_length)] + streams)
+
+
+def MakeBsdiffPatch(old_data, new_data, compressors=None):
+  """Makes a (poorly compressing) bsdiff patch turning old data into new.
+
+  Args:
+    old_data: the data to patch
+    new_data: the patched data
+    compressors: see EncodeBsdiffPatch (optional)
+
+  Returns:
+    The patch content.
+  """
+  add_length = min(len(old_data), len(new_data))
+  diff = bytes(bytearray((new - old) & 0xff for old, new in
+                         zip(bytearray(old_data), bytearray(new_data))))
+  return EncodeBsdiffPatch([(add_length, len(new_data) - add_length, 0)],
+                           diff, new_data[add_length:], len(new_data),
+                           compressors=compressors)
+
+
 class SignaturesGenerator(object):
   """Generates a payload signatures data block."""
 
@@ -196,7 +258,8 @@ class PayloadGenerator(object):
 
   def AddOperation(self, part_name, op_type, data_offset=None,
                    data_length=None, src_extents=None, src_length=None,
-                   dst_extents=None, dst_length=None, data_sha256_hash=None):
+                   dst_extents=None, dst_length=None, data_sha256_hash=None,
+                   src_sha256_hash=None):
     """Adds an InstallOperation entry."""
     partition = next((x for x in self.manifest.partitions
                       if x.partition_name == part_name), None)
@@ -218,6 +281,7 @@ class PayloadGenerator(object):
     _SetMsgField(op, 'dst_length', dst_length)
 
     _SetMsgField(op, 'data_sha256_hash', data_sha256_hash)
+    _SetMsgField(op, 'src_sha256_hash', src_sha256_hash)
 
   def SetSignatures(self, sigs_offset, sigs_size):
     """Set the payload's signature block descriptors."""
@@ -286,7 +350,8 @@ class EnhancedPayloadGenerator(PayloadGenerator):
 
   def AddOperationWithData(self, part_name, op_type, src_extents=None,
                            src_length=None, dst_extents=None, dst_length=None,
-                           data_blob=None, do_hash_data_blob=True):
+                           data_blob=None, do_hash_data_blob=True,
+                           src_sha256_hash=None):
     """Adds an install operation and associated data blob.
 
     This takes care of obtaining a hash of the data blob (if so instructed)
@@ -302,6 +367,7 @@ class EnhancedPayloadGenerator(PayloadGenerator):
       dst_length: size of the dst data in bytes (needed for diff operations)
       data_blob: a data blob associated with this operation
       do_hash_data_blob: whether or not to compute and add a data blob hash
+      src_sha256_hash: the hash of the data in the src extents (optional)
     """
     data_offset = data_length = data_sha256_hash = None
     if data_blob is not None:
@@ -312,7 +378,8 @@ class EnhancedPayloadGenerator(PayloadGenerator):
     self.AddOperation(part_name, op_type, data_offset=data_offset,
                       data_length=data_length, src_extents=src_extents,
                       src_length=src_length, dst_extents=dst_extents,
-                      dst_length=dst_length, data_sha256_hash=data_sha256_hash)
+                      dst_length=dst_length, data_sha256_hash=data_sha256_hash,
+                      src_sha256_hash=src_sha256_hash)
 
   def WriteToFileWithData(self, file_obj, sigs_data=None,
                           privkey_file_name=None, padding=None):
@@ -357,3 +424,117 @@ class EnhancedPayloadGenerator(PayloadGenerator):
     # Dump the whole thing, complete with data and signature blob, to a file.
     self.WriteToFile(file_obj, data_blobs=self.data_blobs, sigs_data=sigs_data,
                      padding=padding)
+
+
+class PayloadHttpServer(object):
+  """A local HTTP server serving a payload, standing in for an update server.
+
+  The payload is sent in small pieces, so that clients see partial reads.
+  Connections are kept alive between requests.
+
+  Attributes:
+    support_ranges: whether to honor range requests
+    num_failures: the number of upcoming requests to fail with status 503
+    corrupt_offset: the offset of a payload byte to corrupt, or None
+    num_corruptions: the number of upcoming responses sending the byte at
+                     corrupt_offset to corrupt it in
+    redirects: a dictionary mapping request paths to the locations they are
+               redirected to with status 302
+    paths: the paths of the requests served, in order
+    num_requests: the number of requests served
+    num_connections: the number of connections accepted
+  """
+
+  _PIECE_SIZE = 100
+  _RANGE_RE = re.compile(r'bytes=(\d+)-(\d+)$')
+
+  def __init__(self, payload_data):
+    """Initializes and starts the server.
+
+    Args:
+      payload_data: the payload content to serve
+    """
+    self.support_ranges = True
+    self.num_failures = 0
+    self.corrupt_offset = None
+    self.num_corruptions = 0
+    self.redirects = {}
+    self.paths = []
+    self.num_requests = 0
+    self.num_connections = 0
+    self._lock = threading.Lock()
+    server = self
+
+    class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      """Serves the payload for any path."""
+
+      protocol_version = 'HTTP/1.1'
+
+      def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with server._lock:
+          server.num_connections += 1
+
+      def do_GET(self):
+        with server._lock:
+          server.num_requests += 1
+          server.paths.append(self.path)
+          fail = server.num_failures > 0
+          if fail:
+            server.num_failures -= 1
+          location = server.redirects.get(self.path)
+        if fail:
+          self.send_error(503)
+          return
+        if location:
+          self.send_response(302)
+          self.send_header('Location', location)
+          self.send_header('Content-Length', '0')
+          self.end_headers()
+          return
+
+        match = server._RANGE_RE.match(self.headers.get('Range', ''))
+        start, end = 0, len(payload_data) - 1
+        if match and server.support_ranges:
+          start = int(match.group(1))
+          end = min(int(match.group(2)), end)
+          self.send_response(206)
+          self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                           (start, end, len(payload_data)))
+        else:
+          self.send_response(200)
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.end_headers()
+
+        data = payload_data[start:end + 1]
+        with server._lock:
+          offset = server.corrupt_offset
+          if (offset is not None and start <= offset <= end and
+              server.num_corruptions > 0):
+            server.num_corruptions -= 1
+            data = bytearray(data)
+            data[offset - start] ^= 0xff
+            data = bytes(data)
+        for piece_start in range(0, len(data), server._PIECE_SIZE):
+          self.wfile.write(data[piece_start:piece_start + server._PIECE_SIZE])
+          self.wfile.flush()
+
+      def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+      """Serves each connection on its own thread."""
+
+      daemon_threads = True
+
+    self.server = _Server(('127.0.0.1', 0), _Handler)
+    self.url = 'http://127.0.0.1:%d/payload.bin' % self.server.server_port
+    self._thread = threading.Thread(target=self.server.serve_forever)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def Stop(self):
+    """Stops the server."""
+    self.server.shutdown()
+    self.server.server_close()
+    self._thread.join()